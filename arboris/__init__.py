@@ -18,7 +18,9 @@ def optional_modules():
         pass
     return mods
 
-__all__ = ['adjointmatrix', 'collisions', 'constraints', 'controllers',
-           'core', 'homogeneousmatrix', 'joints', 'massmatrix',
-           'observers', 'rigidmotion', 'robots', 'shapes', 'twistvector']
+__all__ = ['adjointmatrix', 'batch', 'benchmarks', 'collisions',
+           'constraints', 'controllers', 'core', 'engines',
+           'homogeneousmatrix', 'integrators', 'joints', 'massmatrix',
+           'observers', 'parallel', 'rigidmotion', 'robots', 'shapes',
+           'twistvector']
 __all__.extend(optional_modules())
@@ -25,11 +25,11 @@ def isadjointmatrix(a):
 
 def inv(Ad):
     """
-    Invert an adjoint matrix
+    Invert an adjoint matrix (or a (N,6,6) stack of them)
     """
-    R = Ad[0:3,0:3].transpose()
-    pxR = Ad[3:6,0:3].transpose()
-    return np.vstack((
-        np.hstack((R  , np.zeros((3,3)))),
-        np.hstack((pxR, R))))
+    iAd = np.zeros(Ad.shape)
+    iAd[...,0:3,0:3] = Ad[...,0:3,0:3].swapaxes(-1,-2)
+    iAd[...,3:6,3:6] = iAd[...,0:3,0:3]
+    iAd[...,3:6,0:3] = Ad[...,3:6,0:3].swapaxes(-1,-2)
+    return iAd
 
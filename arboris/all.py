@@ -10,7 +10,10 @@ from arboris import *
 from controllers import WeightController, ProportionalDerivativeController
 from core import World, Body, Joint, JointsList,\
     NamedObjectsList, Frame, SubFrame, MovingSubFrame, simulate, Constraint,\
-    Controller, Observer
+    Controller, Observer, Engine, DenseEngine, itersimulate, \
+    simulate_adaptive
+from engines import ArticulatedBodyEngine, TreeFactorizationEngine
+from batch import BatchWorld, simulate_batch
 from robots.human36 import add_human36
 from robots.simpleshapes import add_sphere, add_box, add_cylinder,\
     add_groundplane
@@ -0,0 +1,539 @@
+# coding=utf-8
+r"""Batched simulation of several copies of a world.
+
+A :class:`BatchWorld` simulates ``size`` copies (the batch members) of a
+world. They share the kinematic tree and the bodies of the world, but
+each one has its own state (the joints generalized positions and
+velocities) and may have its own controllers gains.
+
+The state is stored in stacked arrays, whose first axis is the batch
+axis. The time step is computed by looping over the joints and the
+bodies only, each operation being vectorized over the batch axis.
+Simulating 1000 members thus costs about one python loop, instead of
+1000.
+
+The batched time step follows the (constraint-free) model of
+:meth:`arboris.core.World.update_controllers` and
+:meth:`arboris.core.World.integrate`. Constraints are not supported,
+and the controllers must be instances of :class:`BatchController`.
+
+**Example:**
+
+>>> from arboris.core import World
+>>> from arboris.robots.simplearm import add_simplearm
+>>> w = World()
+>>> add_simplearm(w)
+>>> bw = BatchWorld(w, 100)
+>>> shoulder = w.getjoints()['Shoulder']
+>>> bw.joint_gpos(shoulder)[:,0] = linspace(0., 1., 100)
+>>> bw.register(BatchWeightController())
+>>> simulate_batch(bw, arange(0., 0.01, 0.001))
+>>> bw.gvel.shape
+(100, 3)
+
+"""
+__author__ = ("Sébastien BARTHÉLEMY <barthelemy@crans.org>")
+
+from abc import ABCMeta, abstractmethod
+from numpy import array, zeros, eye, einsum, tile, hstack, concatenate, sin, \
+    cos, linspace, arange, newaxis
+from numpy.linalg import solve
+from core import NamedObject, World, LinearConfigurationSpaceJoint
+from twistvector import adjacency, exp, _skew
+import homogeneousmatrix as Hg
+from joints import FreeJoint, RzRyRxJoint, RzRyJoint, RzRxJoint, RyRxJoint, \
+    RzJoint, RyJoint, RxJoint, TxTyTzJoint
+
+
+def _idadjoint(pose, twist):
+    """Batched version of :attr:`arboris.rigidmotion.RigidMotion.idadjoint`.
+    """
+    iAd = Hg.iadjoint(pose)
+    itwist = -einsum('bij,bj->bi', iAd, twist)
+    return einsum('bij,bjk->bik', iAd, adjacency(itwist))
+
+
+def _hinge_model(axis):
+    rotation = (Hg.rotx, Hg.roty, Hg.rotz)[axis]
+    def model(gpos, gvel):
+        n = len(gpos)
+        jac = zeros((n, 6, 1))
+        jac[:,axis,0] = 1.
+        return (rotation(gpos[:,0]), jac, zeros((n, 6, 1)))
+    return model
+
+def _free_model(gpos, gvel):
+    n = len(gpos)
+    return (gpos.copy(), tile(eye(6), (n, 1, 1)), zeros((n, 6, 6)))
+
+def _rzryrx_model(gpos, gvel):
+    n = len(gpos)
+    pose = Hg.rotzyx(gpos[:,0], gpos[:,1], gpos[:,2])
+    (sx, cx, dx) = (sin(gpos[:,2]), cos(gpos[:,2]), gvel[:,2])
+    (sy, cy, dy) = (sin(gpos[:,1]), cos(gpos[:,1]), gvel[:,1])
+    jac = zeros((n, 6, 3))
+    jac[:,0,0] = -sy
+    jac[:,1,0] = sx*cy
+    jac[:,2,0] = cx*cy
+    jac[:,1,1] = cx
+    jac[:,2,1] = -sx
+    jac[:,0,2] = 1.
+    djac = zeros((n, 6, 3))
+    djac[:,0,0] = -dy*cy
+    djac[:,1,0] = dx*cx*cy - dy*sx*sy
+    djac[:,2,0] = -dx*sx*cy - dy*cx*sy
+    djac[:,1,1] = -dx*sx
+    djac[:,2,1] = -dx*cx
+    return (pose, jac, djac)
+
+def _rzry_model(gpos, gvel):
+    n = len(gpos)
+    pose = Hg.rotzy(gpos[:,0], gpos[:,1])
+    (sy, cy, dy) = (sin(gpos[:,1]), cos(gpos[:,1]), gvel[:,1])
+    jac = zeros((n, 6, 2))
+    jac[:,0,0] = -sy
+    jac[:,2,0] = cy
+    jac[:,1,1] = 1.
+    djac = zeros((n, 6, 2))
+    djac[:,0,0] = -dy*cy
+    djac[:,2,0] = -dy*sy
+    return (pose, jac, djac)
+
+def _rzrx_model(gpos, gvel):
+    n = len(gpos)
+    pose = Hg.rotzx(gpos[:,0], gpos[:,1])
+    (sx, cx, dx) = (sin(gpos[:,1]), cos(gpos[:,1]), gvel[:,1])
+    jac = zeros((n, 6, 2))
+    jac[:,1,0] = sx
+    jac[:,2,0] = cx
+    jac[:,0,1] = 1.
+    djac = zeros((n, 6, 2))
+    djac[:,1,0] = dx*cx
+    djac[:,2,0] = -dx*sx
+    return (pose, jac, djac)
+
+def _ryrx_model(gpos, gvel):
+    n = len(gpos)
+    pose = Hg.rotyx(gpos[:,0], gpos[:,1])
+    (sx, cx, dx) = (sin(gpos[:,1]), cos(gpos[:,1]), gvel[:,1])
+    jac = zeros((n, 6, 2))
+    jac[:,1,0] = cx
+    jac[:,2,0] = -sx
+    jac[:,0,1] = 1.
+    djac = zeros((n, 6, 2))
+    djac[:,1,0] = -dx*sx
+    djac[:,2,0] = -dx*cx
+    return (pose, jac, djac)
+
+def _txtytz_model(gpos, gvel):
+    n = len(gpos)
+    pose = Hg.transl(gpos[:,0], gpos[:,1], gpos[:,2])
+    jac = zeros((n, 6, 3))
+    jac[:,3:6,:] = eye(3)
+    return (pose, jac, zeros((n, 6, 3)))
+
+# the vectorized models of the joints of the :mod:`arboris.joints` module,
+# they return the stacked pose, jacobian and djacobian of a joint
+_models = {
+    RxJoint: _hinge_model(0),
+    RyJoint: _hinge_model(1),
+    RzJoint: _hinge_model(2),
+    FreeJoint: _free_model,
+    RzRyRxJoint: _rzryrx_model,
+    RzRyJoint: _rzry_model,
+    RzRxJoint: _rzrx_model,
+    RyRxJoint: _ryrx_model,
+    TxTyTzJoint: _txtytz_model}
+
+def _joint_model(joint):
+    """Return a function computing the model of ``joint`` for a batch.
+
+    The function takes the stacked ``gpos`` and ``gvel`` of the joint
+    and returns its stacked pose, jacobian, djacobian, twist and
+    idadjoint. The joints of the :mod:`arboris.joints` module are
+    vectorized, the other joints are evaluated one batch member at a 
+    time.
+    """
+    if type(joint) in _models:
+        model = _models[type(joint)]
+        def batch_model(gpos, gvel):
+            (pose, jac, djac) = model(gpos, gvel)
+            twist = einsum('bij,bj->bi', jac, gvel)
+            return (pose, jac, djac, twist, _idadjoint(pose, twist))
+        return batch_model
+    def batch_model(gpos, gvel):
+        (gpos0, gvel0) = (joint.gpos, joint.gvel)
+        values = ([], [], [], [], [])
+        try:
+            for (q, dq) in zip(gpos, gvel):
+                (joint.gpos, joint.gvel) = (q, dq)
+                for (l, v) in zip(values, (joint.pose, joint.jacobian,
+                        joint.djacobian, joint.twist, joint.idadjoint)):
+                    l.append(v)
+        finally:
+            (joint.gpos, joint.gvel) = (gpos0, gvel0)
+        return tuple(array(l) for l in values)
+    return batch_model
+
+def _joint_integrator(joint):
+    """Return a function integrating the stacked ``gpos`` of ``joint``.
+
+    The function updates ``gpos`` in place.
+    """
+    if isinstance(joint, LinearConfigurationSpaceJoint):
+        def integrate(gpos, gvel, dt):
+            gpos += dt * gvel
+        return integrate
+    if type(joint) is FreeJoint:
+        def integrate(gpos, gvel, dt):
+            gpos[:] = einsum('bij,bjk->bik', gpos, exp(dt * gvel))
+        return integrate
+    def integrate(gpos, gvel, dt):
+        (gpos0, gvel0) = (joint.gpos, joint.gvel)
+        try:
+            for (i, dq) in enumerate(gvel):
+                joint.gpos = gpos[i].copy()
+                joint.integrate(dq, dt)
+                gpos[i] = joint.gpos
+        finally:
+            (joint.gpos, joint.gvel) = (gpos0, gvel0)
+    return integrate
+
+
+class BatchController(NamedObject):
+    """A generic class for the controllers of a :class:`BatchWorld`.
+
+    This is the batched counterpart of :class:`arboris.core.Controller`:
+    the :meth:`update` method returns the stacked generalized forces
+    ``(size, ndof)`` and impedances ``(size, ndof, ndof)`` of all the
+    batch members. The impedance may be ``None`` when it is zero.
+    """
+    __metaclass__ = ABCMeta
+
+    def __init__(self, name=None):
+        NamedObject.__init__(self, name)
+
+    @abstractmethod
+    def init(self, bworld):
+        pass
+
+    @abstractmethod
+    def update(self, dt):
+        pass
+
+
+class BatchWeightController(BatchController):
+    """The batched counterpart of
+    :class:`arboris.controllers.WeightController`.
+    """
+    def __init__(self, gravity=-9.81, name=None):
+        self.gravity = float(gravity)
+        BatchController.__init__(self, name=name)
+
+    def init(self, bworld):
+        assert isinstance(bworld, BatchWorld)
+        self._bworld = bworld
+        bodies = bworld._world._bodies
+        self._bodies = [i for i in range(1, len(bodies))
+                        if bodies[i].mass[3,3] > 0.]
+        gravity_dtwist = zeros(6)
+        gravity_dtwist[3:6] = self.gravity * bworld._world.up
+        self._gravity_dtwists = tile(gravity_dtwist, (bworld.size, 1))
+
+    def update(self, dt=None):
+        bw = self._bworld
+        gforce = zeros((bw.size, bw.ndof))
+        for i in self._bodies:
+            # gravity acceleration expressed in body frame
+            g = Hg.iadjoint_dot(bw._poses[i], self._gravity_dtwists)
+            gforce[:,bw._dofs[i]] += einsum('bji,bj->bi', bw._cjacobians[i],
+                einsum('jk,bk->bj', bw._world._bodies[i].mass, g))
+        # the impedance is zero
+        return (gforce, None)
+
+
+class BatchProportionalDerivativeController(BatchController):
+    r"""The batched counterpart of
+    :class:`arboris.controllers.ProportionalDerivativeController`.
+
+    The gains and the desired positions and velocities are either shared
+    by all the batch members, or given for each of them, with a leading
+    batch axis (``kp`` and ``kd`` are then ``(size, n, n)`` arrays,
+    where `n` is the number of dofs of the controlled joints).
+    """
+    def __init__(self, joints, kp=None, kd=None, gpos_des=None,
+                 gvel_des=None, name=None):
+        BatchController.__init__(self, name=name)
+        for j in joints:
+            if not isinstance(j, LinearConfigurationSpaceJoint):
+                raise ValueError('Joints must be LinearConfigurationSpaceJoint instances')
+        self.joints = joints
+        self._cndof = sum(j.ndof for j in joints)
+        (self.kp, self.kd, self.gpos_des, self.gvel_des) = \
+                (kp, kd, gpos_des, gvel_des)
+
+    def _stack(self, value, shape):
+        """Broadcast ``value`` over the batch axis."""
+        stacked = zeros((self._bworld.size,) + shape)
+        if value is not None:
+            stacked += array(value).reshape((-1,) + shape)
+        return stacked
+
+    def init(self, bworld):
+        assert isinstance(bworld, BatchWorld)
+        self._bworld = bworld
+        self._dof_map = hstack([bworld._world._joint_dofs[bworld._index[j]]
+                                for j in self.joints])
+        n = self._cndof
+        self._kp = self._stack(self.kp, (n, n))
+        self._kd = self._stack(self.kd, (n, n))
+        self._gpos_des = self._stack(self.gpos_des, (n,))
+        self._gvel_des = self._stack(self.gvel_des, (n,))
+        self._impedance = zeros((bworld.size, bworld.ndof, bworld.ndof))
+        self._impedance_dt = None
+
+    def update(self, dt):
+        bw = self._bworld
+        gpos = hstack([bw.joint_gpos(j) for j in self.joints])
+        gforce = zeros((bw.size, bw.ndof))
+        gforce[:,self._dof_map] = \
+                einsum('bij,bj->bi', self._kp, self._gpos_des - gpos) + \
+                einsum('bij,bj->bi', self._kd, self._gvel_des)
+        # the impedance only depends on the time step
+        if dt != self._impedance_dt:
+            self._impedance[:,self._dof_map[:,newaxis],self._dof_map] = \
+                    -(dt*self._kp + self._kd)
+            self._impedance_dt = dt
+        return (gforce, self._impedance)
+
+
+class BatchWorld(NamedObject):
+    """Several copies of a world, simulated in lockstep.
+
+    :param world: the world whose kinematic tree and bodies are shared
+        by the batch members. Each member state is initialized from
+        the world state. The world controllers and integrator are not
+        used, the batch members follow the default Euler scheme.
+    :type world: :class:`arboris.core.World`
+    :param size: the number of batch members
+    :type size: int
+
+    """
+    def __init__(self, world, size, name=None):
+        NamedObject.__init__(self, name)
+        assert isinstance(world, World)
+        if world._constraints or world._broad_phases:
+            raise ValueError('BatchWorld does not support constraints')
+        world.init()
+        self._world = world
+        self._size = int(size)
+        self._index = dict((j, k) for (k, j) in enumerate(world._joints))
+        self._body_index = dict((b, k) for (k, b) in enumerate(world._bodies))
+        self._controllers = []
+        self._current_time = world.current_time
+        self._gvel = tile(world._gvel, (self._size, 1))
+        self._gpos = [array([j.gpos] * self._size) for j in world._joints]
+        self._init_kinematics()
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def ndof(self):
+        return self._world.ndof
+
+    @property
+    def current_time(self):
+        return self._current_time
+
+    @property
+    def gvel(self):
+        """The stacked generalized velocities, a ``(size, ndof)`` array.
+        """
+        return self._gvel
+
+    def joint_gpos(self, joint):
+        """Return the stacked generalized positions of ``joint``.
+
+        The array is updated in place by the simulation, it can be
+        modified to set the members initial positions.
+        """
+        return self._gpos[self._index[joint]]
+
+    def joint_gvel(self, joint):
+        """Return a view of ``gvel`` on the dofs of ``joint``."""
+        return self._gvel[:,joint.dof]
+
+    def pose(self, body):
+        """Return the stacked poses of ``body``, a ``(size, 4, 4)`` array.
+
+        As for the world bodies, the poses are computed on demand when
+        the state changed since the last update.
+        """
+        if self._kinematics_are_stale:
+            self._update_kinematics()
+        return self._poses[self._body_index[body]]
+
+    def twist(self, body):
+        """Return the stacked twists of ``body``, a ``(size, 6)`` array.
+        """
+        if self._kinematics_are_stale:
+            self._update_kinematics()
+        return self._twists[self._body_index[body]]
+
+    def register(self, controller):
+        assert isinstance(controller, BatchController)
+        if not controller in self._controllers:
+            self._controllers.append(controller)
+
+    def init(self):
+        w = self._world
+        (size, ndof) = (self._size, w.ndof)
+        self._mass = zeros((size, ndof, ndof))
+        self._viscosity = zeros((size, ndof, ndof))
+        self._nleffects = zeros((size, ndof, ndof))
+        self._controller_impedance = zeros((size, ndof, ndof))
+        self._impedance = zeros((size, ndof, ndof))
+        self._gforce = zeros((size, ndof))
+        self._init_kinematics()
+        for c in self._controllers:
+            c.init(self)
+
+    def _init_kinematics(self):
+        """Allocate the stacked bodies models, and compile the joints."""
+        w = self._world
+        nbodies = len(w._bodies)
+        self._poses = [None] * nbodies
+        self._twists = [None] * nbodies
+        self._cjacobians = [None] * nbodies
+        self._cdjacobians = [None] * nbodies
+        # the ancestors dofs of each body, as in Body.jacobian_dofs
+        self._dofs = [arange(0)]
+        for (k, p) in enumerate(w._parents):
+            self._dofs.append(hstack((self._dofs[p], w._joint_dofs[k])))
+        self._rx = [None]
+        for b in w._bodies[1:]:
+            if b.mass[3,3] <= 1e-10:
+                self._rx.append(zeros((3,3)))
+            else:
+                self._rx.append(b.mass[0:3,3:6]/b.mass[3,3])
+        self._joint_models = [_joint_model(j) for j in w._joints]
+        self._joint_integrators = [_joint_integrator(j) for j in w._joints]
+        self._kinematics_are_stale = True
+
+    def update_dynamic(self):
+        """Compute the batched forward dynamic model.
+
+        This is the batched counterpart of
+        :meth:`arboris.core.World.update_dynamic`.
+        """
+        self._update_kinematics()
+        self._update_model()
+
+    def _update_kinematics(self):
+        """Compute the stacked poses, twists and jacobians of the bodies.
+        """
+        w = self._world
+        size = self._size
+        self._poses[0] = tile(eye(4), (size, 1, 1))
+        self._twists[0] = zeros((size, 6))
+        self._cjacobians[0] = zeros((size, 6, 0))
+        self._cdjacobians[0] = zeros((size, 6, 0))
+        w._update_moving_links()
+        for (k, j) in enumerate(w._joints):
+            (p, c) = (w._parents[k], k+1)
+            (H_pr, H_nc, Ad_cn, Ad_rp) = w._link_constants[k]
+            (H_rn, J_nr, dJ_nr, T_nr, dAd_nr) = self._joint_models[k](
+                self._gpos[k], self._gvel[:,j.dof])
+            H_pc = einsum('ij,bjk->bik', H_pr, einsum('bij,jk->bik', H_rn, H_nc))
+            Ad_cp = Hg.iadjoint(H_pc)
+            dAd_cp = einsum('ij,bjk->bik', Ad_cn, einsum('bij,jk->bik', dAd_nr, Ad_rp))
+            (J_pg, dJ_pg) = (self._cjacobians[p], self._cdjacobians[p])
+            self._poses[c] = einsum('bij,bjk->bik', self._poses[p], H_pc)
+            self._twists[c] = einsum('bij,bj->bi', Ad_cp, self._twists[p]) \
+                    + einsum('ij,bj->bi', Ad_cn, T_nr)
+            self._cjacobians[c] = concatenate((
+                einsum('bij,bjk->bik', Ad_cp, J_pg),
+                einsum('ij,bjk->bik', Ad_cn, J_nr)), axis=2)
+            self._cdjacobians[c] = concatenate((
+                einsum('bij,bjk->bik', dAd_cp, J_pg) +
+                einsum('bij,bjk->bik', Ad_cp, dJ_pg),
+                einsum('ij,bjk->bik', Ad_cn, dJ_nr)), axis=2)
+        self._kinematics_are_stale = False
+
+    def _update_model(self):
+        """Compute the stacked mass, viscosity and nleffects matrices."""
+        self._mass[:] = 0.
+        self._viscosity[:] = 0.
+        self._nleffects[:] = 0.
+        for (i, b) in enumerate(self._world._bodies):
+            if i == 0:
+                continue
+            dofs = (slice(None), self._dofs[i][:,newaxis], self._dofs[i])
+            (J, dJ) = (self._cjacobians[i], self._cdjacobians[i])
+            wx = _skew(self._twists[i][:,0:3])
+            rx = self._rx[i]
+            N = zeros((self._size, 6, 6))
+            N[:,0:3,0:3] = wx
+            N[:,3:6,3:6] = wx
+            N[:,0:3,3:6] = einsum('ij,bjk->bik', rx, wx) - \
+                    einsum('bij,jk->bik', wx, rx)
+            # the products are done two operands at a time, einsum is 
+            # much slower otherwise
+            MJ = einsum('kl,blj->bkj', b.mass, J)
+            BJ = einsum('kl,blj->bkj', b.viscosity, J)
+            NJ = einsum('bkl,blj->bkj', einsum('bkl,lm->bkm', N, b.mass), J)
+            MdJ = einsum('kl,blj->bkj', b.mass, dJ)
+            self._mass[dofs] += einsum('bki,bkj->bij', J, MJ)
+            self._viscosity[dofs] += einsum('bki,bkj->bij', J, BJ)
+            self._nleffects[dofs] += einsum('bki,bkj->bij', J, MdJ + NJ)
+
+    def update_controllers(self, dt):
+        """Sum the controllers contributions and compute the impedances.
+        """
+        assert dt > 0
+        self._gforce[:] = 0.
+        self._controller_impedance[:] = 0.
+        for a in self._controllers:
+            (gforce, impedance) = a.update(dt)
+            self._gforce += gforce
+            if impedance is not None:
+                self._controller_impedance += impedance
+        self._impedance[:] = self._mass/dt + self._viscosity + \
+                self._nleffects - self._controller_impedance
+
+    def integrate(self, dt):
+        """Compute the new generalized velocities and positions.
+
+        The impedance systems of all the batch members are solved at
+        once.
+        """
+        assert dt > 0
+        self._gvel[:] = solve(self._impedance,
+            einsum('bij,bj->bi', self._mass, self._gvel/dt) + self._gforce)
+        for (k, j) in enumerate(self._world._joints):
+            self._joint_integrators[k](self._gpos[k], self._gvel[:,j.dof],
+                                       dt)
+        self._current_time += dt
+        self._kinematics_are_stale = True
+
+
+def simulate_batch(bworld, timeline):
+    """Run a full batched simulation.
+
+    This is the batched counterpart of :func:`arboris.core.simulate`.
+
+    :param bworld: the batch of worlds to be simulated
+    :type bworld: :class:`BatchWorld`
+    :param time: a list of distinct times
+    :type time: iterable
+
+    """
+    bworld._current_time = timeline[0]
+    bworld.init()
+    for next_time in timeline[1:]:
+        dt = next_time - bworld._current_time
+        bworld.update_dynamic()
+        bworld.update_controllers(dt)
+        bworld.integrate(dt)
@@ -0,0 +1,357 @@
+# coding=utf-8
+"""Benchmarks of the simulation pipeline.
+
+Each benchmark times one phase of the simulation (the world
+:meth:`~arboris.core.World.update_geometric`,
+:meth:`~arboris.core.World.update_dynamic`,
+:meth:`~arboris.core.World.update_controllers`,
+:meth:`~arboris.core.World.update_constraints` and
+:meth:`~arboris.core.World.integrate` methods, or a full
+:func:`~arboris.core.simulate` run) on one of the bundled models.
+
+The results can be saved as a JSON file, and compared to the results of a
+previous run (the baseline) in order to detect performance regressions.
+
+The worlds use the default engine and integrator, unless others are
+selected (see :data:`engines` and :data:`integrators`). The results 
+record these settings, with the time step and the number of steps, and 
+are only compared to a baseline run with the same settings.
+
+When ran as a script, the module runs the benchmarks, prints the results
+and optionally saves them or compares them to a baseline::
+
+    python -m arboris.benchmarks -o baseline.json
+    (... change the code ...)
+    python -m arboris.benchmarks -c baseline.json
+    python -m arboris.benchmarks -e articulated_body -i rk4 simplearm
+
+The script exits with a non-zero status if a benchmark regressed, or if
+the baseline settings differ.
+
+**Example:**
+
+>>> results = run_benchmarks(['simplearm'], ['update_dynamic'], number=1,
+...                          repeat=1)
+>>> sorted(results['benchmarks'].keys())
+['simplearm/update_dynamic']
+>>> report = compare(results, results)
+>>> [status for (name, ratio, status) in report]
+['ok']
+>>> other = run_benchmarks(['simplearm'], ['update_dynamic'], number=1,
+...                        repeat=1, engine='articulated_body')
+>>> compare(other, results)
+Traceback (most recent call last):
+    ...
+ValueError: engine differs from the baseline: articulated_body != dense
+
+"""
+__author__ = ("Sébastien BARTHÉLEMY <barthelemy@crans.org>")
+
+import json
+from functools import partial
+import platform
+import sys
+from timeit import default_timer as _time
+from numpy import arange, dot
+import numpy
+from arboris.core import World, simulate, _step, _save_state, _restore_state
+from arboris.core import DenseEngine, EulerIntegrator
+from arboris.engines import ArticulatedBodyEngine, TreeFactorizationEngine, \
+    ReusedAdmittanceEngine
+from arboris.integrators import RungeKuttaIntegrator
+from arboris.controllers import WeightController
+from arboris.constraints import get_all_contacts, BroadPhase
+from arboris.robots.simplearm import add_simplearm
+from arboris.robots.snake import add_snake
+from arboris.robots.human36 import add_human36
+from arboris.robots.simpleshapes import add_groundplane, add_sphere
+import arboris.homogeneousmatrix as Hg
+
+
+def _simplearm(engine=None, integrator=None):
+    w = World(engine=engine, integrator=integrator)
+    add_simplearm(w)
+    w.register(WeightController())
+    return w
+
+def _snake(nbody):
+    def snake(engine=None, integrator=None):
+        w = World(engine=engine, integrator=integrator)
+        add_snake(w, nbody)
+        w.register(WeightController())
+        return w
+    return snake
+
+def _human36(lift):
+    def human36(engine=None, integrator=None):
+        w = World(engine=engine, integrator=integrator)
+        add_groundplane(w, half_extents=(3., 0.01, 2.))
+        add_human36(w)
+        w.ground.childrenjoints[0].gpos = dot(Hg.transl(0, lift, 0),
+                                              w.ground.childrenjoints[0].gpos)
+        w.register(WeightController())
+        for c in get_all_contacts(w, friction_coeff=.6):
+            w.register(c)
+        return w
+    return human36
+
+def _spheres(nspheres):
+    def spheres(engine=None, integrator=None):
+        w = World(engine=engine, integrator=integrator)
+        add_groundplane(w, half_extents=(3., 0.01, 3.))
+        for i in range(nspheres):
+            add_sphere(w, radius=.1, name='sphere{0}'.format(i))
+            (x, z) = divmod(i, 4)
+            w.getjoints()[-1].gpos[:] = Hg.transl(.5*x, .1, .5*z)
+        w.register(WeightController())
+        w.register(BroadPhase(friction_coeff=.6))
+        return w
+    return spheres
+
+scenarios = (
+    ('simplearm', _simplearm),
+    ('snake10', _snake(10)),
+    ('snake50', _snake(50)),
+    ('snake200', _snake(200)),
+    ('human36', _human36(0.03)),
+    ('human36_standing', _human36(0.)),
+    ('spheres16', _spheres(16)))
+"""The bundled models, as ``(name, factory)`` tuples.
+
+Each factory returns a new world, which is not initialized yet, and 
+takes the optional ``engine`` and ``integrator`` arguments of 
+:class:`~arboris.core.World`. The
+``human36`` robot falls from 3 cm above the ground, which it does not
+reach during the benchmarks, while ``human36_standing`` starts in
+resting contact, so that its ``update_constraints`` phase times the
+constraints solver. Its contacts are all coupled through the robot, so
+that they are solved one after the other, whereas the ``spheres16`` 
+contacts, between 16 free spheres and the ground (found by a 
+:class:`~arboris.constraints.BroadPhase`), are not coupled and are 
+solved at once (see :meth:`~arboris.core.World.update_constraints`).
+"""
+
+engines = {
+    'dense': DenseEngine,
+    'articulated_body': ArticulatedBodyEngine,
+    'tree_factorization': TreeFactorizationEngine,
+    'reused_admittance': ReusedAdmittanceEngine}
+"""The engines which can be benchmarked, mapping each name to a callable
+returning a new engine. ``'dense'`` is the default one.
+"""
+
+integrators = dict([('euler', EulerIntegrator)] + 
+                   [(method, partial(RungeKuttaIntegrator, method))
+                    for method in RungeKuttaIntegrator.methods])
+"""The integrators which can be benchmarked, mapping each name to a 
+callable returning a new integrator. ``'euler'`` is the default one, the
+others are the :class:`~arboris.integrators.RungeKuttaIntegrator` 
+methods, which do not support the scenarios with contacts.
+"""
+
+_settings = (('dt', None), ('steps', None), ('engine', 'dense'),
+             ('integrator', 'euler'))
+# the settings recorded in the results environment, with their value for
+# the results saved before they were recorded
+
+phases = ('update_geometric', 'update_dynamic', 'update_controllers',
+          'update_constraints', 'integrate', 'simulate')
+
+
+def _time_phase(factory, phase, number, dt, steps):
+    """Return the mean duration of ``number`` calls to a phase."""
+    if phase == 'simulate':
+        timeline = arange(0., (steps+.5)*dt, dt)
+        duration = 0.
+        for i in range(number):
+            world = factory()
+            start = _time()
+            simulate(world, timeline)
+            duration += _time() - start
+        return duration/number
+    world = factory()
+    world.init()
+    # a first step, so that the constraints forces are warm-started
+    _step(world, dt, ())
+    state = _save_state(world)
+    def run(phase):
+        if phase in ('update_geometric', 'update_dynamic'):
+            getattr(world, phase)()
+        else:
+            getattr(world, phase)(dt)
+    step = ['update_dynamic', 'update_controllers', 'update_constraints',
+            'integrate']
+    preceding = step[:step.index(phase)] if phase in step else []
+    duration = 0.
+    for i in range(number):
+        # each call starts from the same state, the phases which precede 
+        # it in a time step being run outside of the timed region
+        _restore_state(world, state)
+        for p in preceding:
+            run(p)
+        start = _time()
+        run(phase)
+        duration += _time() - start
+    return duration/number
+
+
+def run_benchmarks(names=None, selected_phases=None, number=10, repeat=3,
+                   dt=0.001, steps=20, engine='dense', integrator='euler'):
+    """Run the benchmarks.
+
+    :param names: the names of the scenarios to run, defaults to all of
+        them (see :data:`scenarios`)
+    :param selected_phases: the phases to time, defaults to all of them
+        (see :data:`phases`)
+    :param number: the number of calls per measurement
+    :param repeat: the number of measurements per benchmark
+    :param dt: the time step
+    :param steps: the number of time steps of the ``simulate`` phase
+    :param engine: the name of the engine (see :data:`engines`)
+    :param integrator: the name of the integrator (see 
+        :data:`integrators`)
+    :return: a dictionnary with an ``'environment'`` key, describing
+        the python and numpy versions and the benchmarks settings, and 
+        a ``'benchmarks'`` key,
+        mapping each ``'scenario/phase'`` benchmark name to the best
+        and mean durations (in seconds) of one call.
+
+    """
+    if names is None:
+        names = [name for (name, factory) in scenarios]
+    if selected_phases is None:
+        selected_phases = phases
+    if engine not in engines:
+        raise ValueError('unknown engine: {0}'.format(engine))
+    if integrator not in integrators:
+        raise ValueError('unknown integrator: {0}'.format(integrator))
+    factories = dict(scenarios)
+    benchmarks = {}
+    for name in names:
+        factory = lambda: factories[name](engine=engines[engine](),
+                                          integrator=integrators[integrator]())
+        for phase in selected_phases:
+            if phase not in phases:
+                raise ValueError('unknown phase: {0}'.format(phase))
+            n = max(1, number//10) if phase == 'simulate' else number
+            durations = [_time_phase(factory, phase, n, dt, steps)
+                         for i in range(repeat)]
+            benchmarks[name+'/'+phase] = {
+                'best': min(durations),
+                'mean': sum(durations)/len(durations),
+                'number': n,
+                'repeat': repeat}
+    return {'environment': {'python': platform.python_version(),
+                            'numpy': numpy.__version__,
+                            'machine': platform.machine(),
+                            'dt': dt,
+                            'steps': steps,
+                            'engine': engine,
+                            'integrator': integrator},
+            'benchmarks': benchmarks}
+
+
+def save_results(results, filename):
+    """Save benchmark results as a JSON file."""
+    with open(filename, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+
+
+def load_results(filename):
+    """Load benchmark results from a JSON file."""
+    with open(filename) as f:
+        return json.load(f)
+
+
+def compare(results, baseline, tolerance=0.1):
+    """Compare benchmark results to a baseline.
+
+    :param results: the results to check
+    :param baseline: the reference results
+    :param tolerance: the relative slowdown above which a benchmark is
+        deemed to have regressed
+    :return: a sorted list of ``(name, ratio, status)`` tuples, where
+        ``ratio`` is the ratio of the best durations (``None`` if the
+        benchmark is not in the baseline) and ``status`` is one of
+        ``'regression'``, ``'improvement'``, ``'ok'`` or ``'new'``.
+    :raise ValueError: if the results and the baseline were not run
+        with the same time step, number of steps, engine and integrator
+
+    """
+    for (key, default) in _settings:
+        (value, reference_value) = (results['environment'].get(key, default),
+                                    baseline['environment'].get(key, default))
+        if value != reference_value:
+            raise ValueError('{0} differs from the baseline: {1} != {2}'
+                             .format(key, value, reference_value))
+    report = []
+    reference = baseline['benchmarks']
+    for (name, result) in sorted(results['benchmarks'].items()):
+        if name not in reference:
+            report.append((name, None, 'new'))
+            continue
+        ratio = result['best']/reference[name]['best']
+        if ratio > 1. + tolerance:
+            status = 'regression'
+        elif ratio < 1./(1. + tolerance):
+            status = 'improvement'
+        else:
+            status = 'ok'
+        report.append((name, ratio, status))
+    return report
+
+
+def main(argv=None):
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog [options] [scenario ...]')
+    parser.add_option('-p', '--phase', action='append', dest='phases',
+                      help='time only this phase (can be repeated)')
+    parser.add_option('-n', '--number', type='int', default=10,
+                      help='number of calls per measurement')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help='number of measurements per benchmark')
+    parser.add_option('-e', '--engine', default='dense', 
+                      choices=sorted(engines),
+                      help='engine of the worlds: ' + 
+                           ', '.join(sorted(engines)))
+    parser.add_option('-i', '--integrator', default='euler', 
+                      choices=sorted(integrators),
+                      help='integrator of the worlds: ' + 
+                           ', '.join(sorted(integrators)))
+    parser.add_option('--dt', type='float', default=0.001, help='time step')
+    parser.add_option('--steps', type='int', default=20,
+                      help='number of time steps of the simulate phase')
+    parser.add_option('-o', '--output', help='save the results as JSON')
+    parser.add_option('-c', '--compare', metavar='BASELINE',
+                      help='compare the results to a saved baseline')
+    parser.add_option('-t', '--tolerance', type='float', default=0.1,
+                      help='relative slowdown deemed a regression')
+    (options, args) = parser.parse_args(argv)
+    results = run_benchmarks(args or None, options.phases,
+                             options.number, options.repeat, options.dt,
+                             options.steps, options.engine, 
+                             options.integrator)
+    if options.output:
+        save_results(results, options.output)
+    if options.compare:
+        try:
+            report = compare(results, load_results(options.compare),
+                             options.tolerance)
+        except ValueError, e:
+            print >> sys.stderr, e
+            return 2
+        for (name, ratio, status) in report:
+            if ratio is None:
+                print '{0:40} {1:>8} {2}'.format(name, '', status)
+            else:
+                print '{0:40} {1:8.3f} {2}'.format(name, ratio, status)
+        if any(status == 'regression' for (name, ratio, status) in report):
+            return 1
+    else:
+        for (name, result) in sorted(results['benchmarks'].items()):
+            print '{0:40} {1:12.6f}'.format(name, result['best'])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,7 +7,7 @@ __author__ = ("Sébastien BARTHÉLEMY <barthelemy@crans.org>")
 
 from numpy.linalg import norm
 from numpy import zeros, eye, dot, absolute, argsort, cross, argmin,\
-    hstack
+    hstack, ones, sqrt, maximum, searchsorted, logical_and
 import homogeneousmatrix as Hg
 from core import Shape
 from shapes import *
@@ -54,6 +54,90 @@ def choose_solver(shape0, shape1):
     return (shapes, solver)
 
 
+def bounding_box(shape):
+    """Return the axis-aligned bounding box of a shape.
+
+    :param shape: the shape, a point, a sphere, a box or a cylinder
+    :return: the lower and upper corners of the box, in the ground frame
+    :rtype: tuple of (3,) arrays
+
+    **Example:**
+
+    >>> from arboris.core import World, SubFrame
+    >>> w = World()
+    >>> w.update_geometric()
+    >>> bounding_box(Sphere(SubFrame(w.ground, Hg.transl(1., 0., 0.)), .5))
+    (array([ 0.5, -0.5, -0.5]), array([ 1.5,  0.5,  0.5]))
+
+    """
+    H = shape.frame.pose
+    (p, R) = (H[0:3,3], H[0:3,0:3])
+    if isinstance(shape, Point):
+        e = zeros(3)
+    elif isinstance(shape, Sphere):
+        e = shape.radius * ones(3)
+    elif isinstance(shape, Box):
+        e = dot(absolute(R), shape.half_extents)
+    elif isinstance(shape, Cylinder):
+        axis = R[:,2]
+        e = absolute(axis)*shape.length/2. + \
+            shape.radius*sqrt(maximum(1. - axis**2, 0.))
+    else:
+        raise NotImplementedError()
+    return (p - e, p + e)
+
+
+def bounding_radius(shape):
+    """Return the radius of a sphere bounding the shape.
+
+    The sphere is centered on the origin of the shape frame.
+    """
+    if isinstance(shape, Point):
+        return 0.
+    elif isinstance(shape, Sphere):
+        return shape.radius
+    elif isinstance(shape, Box):
+        return norm(shape.half_extents)
+    elif isinstance(shape, Cylinder):
+        return norm((shape.radius, shape.length/2.))
+    else:
+        raise NotImplementedError()
+
+
+def sweep_and_prune(lower, upper):
+    """Find the pairs of overlapping axis-aligned boxes.
+
+    :param lower: the lower corners of the boxes
+    :type lower: (n, 3) array
+    :param upper: the upper corners of the boxes
+    :type upper: (n, 3) array
+    :return: the ``(i, j)`` indices of the overlapping boxes, with 
+        ``i < j``
+    :rtype: list of tuples
+
+    The boxes are sorted along the x-axis, so that each box is only 
+    compared with those whose x-interval starts within its own.
+
+    **Example:**
+
+    >>> from numpy import array
+    >>> lower = array([[0., 0., 0.], [2., 0., 0.], [.5, .5, .5]])
+    >>> sweep_and_prune(lower, lower + 1.)
+    [(0, 2)]
+
+    """
+    order = argsort(lower[:,0], kind='mergesort')
+    starts = lower[order,0]
+    pairs = []
+    for (k, i) in enumerate(order):
+        others = order[k+1:searchsorted(starts, upper[i,0], 'right')]
+        overlap = logical_and((lower[others,1:] <= upper[i,1:]).all(1),
+                              (upper[others,1:] >= lower[i,1:]).all(1))
+        for j in others[overlap]:
+            pairs.append((min(i, j), max(i, j)))
+    return pairs
+
+
 def _normal_to_frame(vec):
     """Builds a direct frame whose z-axis is vec.
 
@@ -5,14 +5,55 @@
 __author__ = ("Sébastien BARTHÉLEMY <barthelemy@crans.org>")
 
 from abc import ABCMeta, abstractmethod
-from numpy import array, zeros, eye, dot, hstack, diag, logical_and
-from numpy.linalg import solve, eigvals, pinv
+from numpy import array, zeros, eye, dot, hstack, diag, logical_and, \
+    einsum, newaxis, flatnonzero, where, inf, maximum, cross, arange, \
+    union1d, searchsorted
+from numpy.linalg import solve, eigvals, pinv, svd, norm
 import arboris.homogeneousmatrix as Hg
 from arboris.core import MovingSubFrame, Constraint, Shape, NamedObject, World
+from arboris.collisions import bounding_box, bounding_radius, sweep_and_prune
 
 point_contact_proximity = 0.02
 joint_limits_proximity = 0.01
 
+def _pinv(a, rcond=1e-15):
+    """Compute the pseudo-inverses of a stack of matrices.
+
+    Same as :func:`numpy.linalg.pinv`, applied to each ``a[i]``.
+    """
+    (u, s, vt) = svd(a, full_matrices=False)
+    cutoff = rcond * s.max(-1)[:,newaxis]
+    s_inv = where(s > cutoff, 1./where(s > cutoff, s, 1.), 0.)
+    return einsum('nji,nkj->nik', vt * s_inv[:,:,newaxis], u)
+
+def _union(dofs0, dofs1):
+    """Return the sorted union of two sorted arrays of dofs."""
+    if not len(dofs0):
+        return dofs1
+    if not len(dofs1):
+        return dofs0
+    return union1d(dofs0, dofs1)
+
+def _relative_jacobian(frames, rows):
+    r"""Compute the compact jacobian of the relative twist of two frames.
+
+    The jacobian `( \Ad[0]_1 \; \pre[1]J_{1/g} - \pre[0]J_{0/g} )`, 
+    restricted to its ``rows`` and to the union of the frames
+    ``jacobian_dofs`` columns, is returned.
+    """
+    (f0, f1) = frames
+    H_01 = dot(Hg.inv(f0.pose), f1.pose)
+    jac1 = Hg.adjoint_dot(H_01, f1.compact_jacobian)[rows]
+    dofs0 = f0.jacobian_dofs
+    if not len(dofs0):
+        return jac1
+    dofs1 = f1.jacobian_dofs
+    dofs = _union(dofs0, dofs1)
+    jac = zeros((jac1.shape[0], len(dofs)))
+    jac[:, searchsorted(dofs, dofs1)] = jac1
+    jac[:, searchsorted(dofs, dofs0)] -= f0.compact_jacobian[rows]
+    return jac
+
 class JointLimits(Constraint):
     r"""This class describes and solves joint limits constraints.
 
@@ -55,10 +96,20 @@ class JointLimits(Constraint):
     def init(self, world):
         self._jacobian = zeros((1, world.ndof))
         self._jacobian[0, self._joint.dof] = 1
+        self._dofs = arange(self._joint.dof.start, self._joint.dof.stop)
+        self._compact_jacobian = self._jacobian[:, self._dofs]
 
     @property
     def jacobian(self):
         return self._jacobian
+
+    @property
+    def jacobian_dofs(self):
+        return self._dofs
+
+    @property
+    def compact_jacobian(self):
+        return self._compact_jacobian
     
     @property
     def ndol(self):
@@ -66,7 +117,6 @@ class JointLimits(Constraint):
 
     def update(self, dt):
         self._pos0 = self._joint.gpos
-        self._force[:] = 0.
     
     def is_active(self):
         return (self._pos0-self._min<self._proximity) or \
@@ -157,7 +207,7 @@ class BallAndSocketConstraint(Constraint):
         self._frames = frames
 
     def init(self, world):
-        pass
+        self._ndof = world.ndof
 
     @property
     def ndol(self):
@@ -188,9 +238,18 @@ class BallAndSocketConstraint(Constraint):
 
     @property
     def jacobian(self):
-        H_01 = dot(Hg.inv(self._frames[0].pose), self._frames[1].pose)
-        return (dot(Hg.adjoint(H_01)[3:6,:], self._frames[1].jacobian)
-                -self._frames[0].jacobian[3:6,:])
+        jac = zeros((3, self._ndof))
+        jac[:, self.jacobian_dofs] = self.compact_jacobian
+        return jac
+
+    @property
+    def jacobian_dofs(self):
+        return _union(self._frames[0].jacobian_dofs,
+                      self._frames[1].jacobian_dofs)
+
+    @property
+    def compact_jacobian(self):
+        return _relative_jacobian(self._frames, slice(3, 6))
 
     def solve(self, vel, admittance, dt):
         r"""
@@ -271,7 +330,7 @@ class PointContact(Constraint):
         self._proximity = proximity
 
     def init(self, world):
-        pass
+        self._ndof = world.ndof
 
     def update(self, dt):
         r"""
@@ -286,11 +345,10 @@ class PointContact(Constraint):
         self._frames[0].bpose = dot(H_b0g, H_gc0)
         self._frames[1].bpose = dot(H_b1g, H_gc1)
         H_c0c1 = dot(Hg.inv(H_gc0), H_gc1)
-        dsdist = (dot(Hg.adjoint(H_c0c1)[5,:], self._frames[1].twist)
+        dsdist = (Hg.adjoint_dot(H_c0c1, self._frames[1].twist)[5]
                   -self._frames[0].twist[5])
         self._is_active = (sdist + dsdist*dt < self._proximity)
         self._sdist = sdist
-        self._force[:] = 0.
 
     def is_active(self):
         return self._is_active
@@ -428,9 +486,18 @@ class SoftFingerContact(PointContact):
 
     @property
     def jacobian(self):
-        H_01 = dot(Hg.inv(self._frames[0].pose), self._frames[1].pose)
-        return (dot(Hg.adjoint(H_01)[2:6,:], self._frames[1].jacobian)
-                -self._frames[0].jacobian[2:6,:])
+        jac = zeros((4, self._ndof))
+        jac[:, self.jacobian_dofs] = self.compact_jacobian
+        return jac
+
+    @property
+    def jacobian_dofs(self):
+        return _union(self._frames[0].jacobian_dofs,
+                      self._frames[1].jacobian_dofs)
+
+    @property
+    def compact_jacobian(self):
+        return _relative_jacobian(self._frames, slice(2, 6))
     
     def solve(self, vel, admittance, dt):
         r"""
@@ -823,7 +890,7 @@ class SoftFingerContact(PointContact):
                 # s is the real part of the eigenvalue with the smallest 
                 # imaginary par within those with a positive real part
                 S = eigvals(B)
-                S = S[logical_and(S.imag == 0, S.real <= 0)]
+                S = S[logical_and(S.imag == 0, S.real <= 0)].real
                 if len(S)==0:
                     s = -1e10 #TODO: log when len(S)==0
                 else:
@@ -834,6 +901,72 @@ class SoftFingerContact(PointContact):
                 self._force = solve(A,-alpha)
                 dforce = self._force - prev_force
                 return dforce
+
+    @classmethod
+    def solve_group(cls, constraints, vels, admittances, dt):
+        """Solve several uncoupled soft-finger contacts at once.
+
+        This is a vectorized version of :meth:`solve`, working on 
+        stacks of contacts: it computes the same forces, with one call 
+        to the (stacked) linear algebra routines per stage instead of 
+        one call per contact.
+
+        """
+        n = len(constraints)
+        forces = array([c._force for c in constraints])
+        sdist = array([c._sdist for c in constraints])
+        mu = array([c._mu for c in constraints])
+        eps = array([c._eps for c in constraints])
+        vel_no_force = vels - einsum('nij,nj->ni', admittances, forces)
+        # if there is no contact, the contact force should be 0
+        new_forces = zeros((n, 4))
+        contact = flatnonzero(sdist + dt*vel_no_force[:,3] <= 0)
+        if len(contact):
+            (Y, vel, force) = (admittances[contact], vels[contact], 
+                               forces[contact])
+            (d, m, e) = (sdist[contact]/dt, mu[contact], eps[contact])
+            # First, try with static friction: zero tangent velocity
+            target = vel.copy()
+            target[:,3] += d
+            static_force = force - einsum('nij,nj->ni', _pinv(Y), target)
+            new_forces[contact] = static_force
+            sliding = flatnonzero(((static_force[:,0:3]/e)**2).sum(1) >
+                                  (static_force[:,3]*m)**2)
+            if len(sliding):
+                # the elliptic dry friction law is not respected.
+                (Y, vel, force) = (Y[sliding], vel[sliding], force[sliding])
+                (d, m, e) = (d[sliding], m[sliding], e[sliding])
+                alpha = vel - einsum('nij,nj->ni', Y, force)
+                alpha[:,3] += d
+                Y_c = Y[:,0:3,3]
+                y_n = Y[:,3,3]
+                Y_t = Y[:,0:3,0:3]
+                beta = alpha[:,0:3] - (alpha[:,3]/y_n)[:,newaxis]*Y_c
+                a = m/y_n * alpha[:,3]
+                b = (m/y_n)[:,newaxis] * Y_c
+                # as in solve, the products of 1-d arrays like 
+                # dot(Y_c, Y_c.T) are scalars
+                E = e**2
+                Y_that = Y_t - ((Y_c**2).sum(1)/y_n)[:,newaxis,newaxis]
+                I = eye(3)
+                B = zeros((len(sliding), 6, 6))
+                B[:,3:6,3:6] = E[:,:,newaxis] * Y_that
+                B[:,0:3,0:3] = E[:,:,newaxis] * (Y_that + 
+                    (2/a*(beta*b).sum(1))[:,newaxis,newaxis])
+                B[:,0:3,3:6] = -(E * ((beta**2).sum(1)/a**2)[:,newaxis]
+                                 )[:,:,newaxis] * I
+                B[:,3:6,0:3] = (E * (b**2).sum(1)[:,newaxis] - 1.
+                                )[:,:,newaxis] * I
+                S = eigvals(B)
+                S = where(logical_and(S.imag == 0, S.real <= 0), S.real, 
+                          inf).min(1)
+                s = where(S == inf, -1e10, maximum(S, -1e10))
+                A = Y.copy()
+                A[:,0:3,0:3] -= (s[:,newaxis]*e**-2)[:,:,newaxis] * I
+                new_forces[contact[sliding]] = solve(A, -alpha)
+        for (c, f) in zip(constraints, new_forces):
+            c._force = f.copy()
+        return new_forces - forces
         
 
 def get_all_contacts(world, contact_class=None, **args):
@@ -853,6 +986,10 @@ def get_all_contacts(world, contact_class=None, **args):
     Note: it is your responsability to register these new contact to the
     world.
 
+    For worlds with many shapes, registering a :class:`BroadPhase` 
+    instead avoids calling the collision solvers of the pairs of shapes
+    which are far apart.
+
     """
     assert isinstance(world, World)
     if contact_class is None:
@@ -877,3 +1014,145 @@ def get_all_contacts(world, contact_class=None, **args):
                     #The collison detection is impossible.
                     pass 
     return contacts
+
+
+class BroadPhase(object):
+    r"""Contacts between shapes, created lazily after a broad phase.
+
+    :param shapes: the shapes which may collide, defaults to all the 
+        world shapes (at :meth:`init` time)
+    :type shapes: sequence of :class:`arboris.core.Shape`
+    :param contact_class: the class of the contacts, defaults to 
+        :class:`SoftFingerContact`
+    :type contact_class: a subclass of :class:`PointContact`
+    :param proximity: the contacts proximity
+
+    All additionnal input arguments are passed to the ``contact_class``
+    constructor.
+
+    This is an alternative to :func:`get_all_contacts` for worlds with 
+    many shapes: instead of registering one contact per pair of shapes,
+    whose collision solver would be called at each time step, register 
+    the broad phase into the world. 
+
+    At each time step, :meth:`update` bounds each shape by an 
+    axis-aligned box, enlarged by half the proximity and by the 
+    distance the shape may travel during the time step. The collision 
+    solvers (the narrow phase) are then only called for the pairs of 
+    overlapping boxes (found by :func:`arboris.collisions.sweep_and_prune`). 
+    The other pairs cannot be active during the time step, so that the
+    simulation is the same as with :func:`get_all_contacts`.
+    
+    The contacts are created the first time their shapes boxes overlap,
+    and kept afterwards.
+
+    **Example:**
+
+    >>> from arboris.core import World, simulate
+    >>> from arboris.robots.simpleshapes import add_sphere, add_groundplane
+    >>> w = World()
+    >>> add_groundplane(w)
+    >>> for i in range(5):
+    ...     add_sphere(w, radius=.1, name='Sphere{0}'.format(i))
+    >>> for (i, j) in enumerate(w.getjoints()):
+    ...     j.gpos[0:2,3] = (i, .5)
+    >>> bp = BroadPhase(friction_coeff=.6)
+    >>> w.register(bp)
+    >>> w.init()
+    >>> simulate(w, [0., 0.001, 0.002])
+    >>> len(bp.contacts)
+    0
+
+    """
+    def __init__(self, shapes=None, contact_class=None, 
+                 proximity=point_contact_proximity, **args):
+        if contact_class is None:
+            contact_class = SoftFingerContact
+        assert issubclass(contact_class, PointContact)
+        self._shapes = shapes
+        self._contact_class = contact_class
+        self._proximity = proximity
+        self._args = args
+        self._pairs = {}
+        self._candidates = []
+
+    def init(self, world):
+        self._world = world
+        if self._shapes is None:
+            self._shapes = tuple(world.itershapes())
+        self._radii = array([bounding_radius(s) for s in self._shapes])
+        # one contact (or None if there is no collision solver) per 
+        # pair of shapes which have been candidates once
+        self._pairs = {}
+        self._candidates = []
+
+    @property
+    def contacts(self):
+        """The contacts created so far."""
+        return [c for c in self._pairs.itervalues() if c is not None]
+
+    def _save_state(self):
+        """Return a copy of the contacts created so far and of their 
+        forces, see :func:`arboris.core._save_state`.
+        """
+        return (dict(self._pairs), list(self._candidates),
+                [(c, c._force.copy()) for c in self.contacts])
+
+    def _restore_state(self, state):
+        """Forget the contacts created since ``state`` was saved, and 
+        restore the forces of the others.
+        """
+        (pairs, candidates, forces) = state
+        self._pairs = dict(pairs)
+        self._candidates = list(candidates)
+        for (c, f) in forces:
+            c._force[:] = f
+
+    def _create_contact(self, i, j):
+        (s0, s1) = (self._shapes[i], self._shapes[j])
+        if s0.frame.body is s1.frame.body:
+            # Contact between two rigidly linked bodies would be 
+            # pointless.
+            return None
+        try:
+            c = self._contact_class((s0, s1), proximity=self._proximity, 
+                                    **self._args)
+        except NotImplementedError:
+            #The collison detection is impossible.
+            return None
+        c.init(self._world)
+        c._force[:] = 0.
+        return c
+
+    def update(self, dt):
+        """Return the contacts between shapes which may collide.
+
+        The forces of the contacts which were candidates at the 
+        previous time step and are not anymore are reset to zero.
+        """
+        n = len(self._shapes)
+        (lower, upper) = (zeros((n, 3)), zeros((n, 3)))
+        speed = zeros(n)
+        for (k, s) in enumerate(self._shapes):
+            (lower[k], upper[k]) = bounding_box(s)
+            # bound the speed of the shape points from its body twist
+            twist = s.frame.body.twist
+            p = s.frame.bpose[0:3,3]
+            speed[k] = norm(twist[3:6] + cross(twist[0:3], p)) + \
+                norm(twist[0:3]) * self._radii[k]
+        margin = (self._proximity/2. + dt*speed)[:,newaxis]
+        candidates = []
+        # sorted, so that the constraints order is that of get_all_contacts
+        for pair in sorted(sweep_and_prune(lower - margin, upper + margin)):
+            try:
+                c = self._pairs[pair]
+            except KeyError:
+                c = self._pairs[pair] = self._create_contact(*pair)
+            if c is not None:
+                candidates.append(c)
+        kept = set(candidates)
+        for c in self._candidates:
+            if c not in kept:
+                c._force[:] = 0.
+        self._candidates = candidates
+        return candidates
@@ -3,13 +3,34 @@ __author__ = ("Sébastien BARTHÉLEMY <barthelemy@crans.org>")
 
 from abc import ABCMeta, abstractmethod, abstractproperty
 from core import NamedObject, Controller, World
-from numpy import array, zeros, dot, ix_
-from numpy.linalg import norm
-import homogeneousmatrix
+from numpy import array, zeros, dot, einsum
 from joints import LinearConfigurationSpaceJoint
 
 class WeightController(Controller):
-    """A contoller which applies weight to joints."""
+    r"""A contoller which applies weight to joints.
+
+    The weight of a body `b`, expressed in its frame, is
+
+    .. math::
+        w_b = M_b \; \Ad[b]_g \; \dtwist[g]_{g}
+
+    where `\dtwist[g]_{g}` is the (purely linear) gravity acceleration.
+    Its angular part being zero, only the last three columns of the mass
+    matrices are used, they are cached by :meth:`init`. The weights of
+    all the bodies are computed at once from their poses, then the
+    generalized force is accumulated from the leaves to the root
+
+    .. math::
+        \GForce_j &= (\Ad[c]_n \; \J[n]_{n/r})^T \; F_c \\
+        F_p &= w_p + \sum_{c} \Ad[c]_p^T \; F_c
+
+    where `F_c` is the total weight of the subtree rooted at the body 
+    `c`, `j` is its parent joint and `p` its parent body. The transforms
+    are those of the last :meth:`~arboris.core.World.update_dynamic` 
+    call, hence the cost is linear in the number of bodies, instead of
+    being proportional to the sum of their depths.
+
+    """
     def __init__(self, gravity=-9.81, name=None):
         self.gravity = float(gravity)
         Controller.__init__(self, name=name)
@@ -17,29 +38,29 @@ class WeightController(Controller):
 
     def init(self, world):
         assert isinstance(world, World)
-        self._bodies = filter(lambda x: norm(x.mass>0.),
-                world.ground.iter_descendant_bodies())
+        self._world = world
         self._wndof = world.ndof
         self._gravity_dtwist = zeros(6)
         self._gravity_dtwist[3:6] = float(self.gravity)*world.up
+        self._masses = array([b.mass[:,3:6] for b in world._bodies[1:]])
+        self._masses.shape = (len(world._joints), 6, 3)
 
     def update(self, dt=None):
+        w = self._world
         gforce = zeros(self._wndof)
-        for b in self._bodies:
-            #TODO: improve efficiency
-            from arboris.massmatrix import principalframe
-            H_bc = principalframe(b.mass)
-            R_gb = b.pose[0:3,0:3] 
-            H_bc[0:3,0:3] = R_gb.T
-            #wrench_c = array((0,0,0,0,-9.81*b.mass[3,3],0))
-            #Ad_cb = homogeneousmatrix.iadjoint(H_bc)
-            #wrench_b = dot(Ad_cb.T, wrench_c)
-            #gforce += dot(b.jacobian.T, wrench_b )
-            # gravity acceleration expressed in body frame
-            g = dot(homogeneousmatrix.iadjoint(b.pose), self._gravity_dtwist)
-            gforce += dot(b.jacobian.T, dot(b.mass, g))
-        impedance = zeros( (self._wndof, self._wndof) )
-        return (gforce, impedance)
+        # gravity acceleration expressed in each body frame, then weights
+        rotations = array([b.pose[0:3,0:3] for b in w._bodies[1:]])
+        rotations.shape = (len(w._joints), 3, 3)
+        g = einsum('bji,j->bi', rotations, self._gravity_dtwist[3:6])
+        F = zeros((len(w._bodies), 6))
+        F[1:] = einsum('bij,bj->bi', self._masses, g)
+        parents = w._parents
+        for k in reversed(range(len(w._joints))):
+            (Ad_cp, dAd_cp, X, dX) = w._link_dynamics[k]
+            gforce[w._joints[k].dof] = dot(X.T, F[k+1])
+            F[parents[k]] += dot(Ad_cp.T, F[k+1])
+        # the impedance is zero
+        return (gforce, None)
             
 
 class ProportionalDerivativeController(Controller):
@@ -76,6 +97,11 @@ class ProportionalDerivativeController(Controller):
 
     This result can be easily generalized to the `n`-dimensional case.
 
+    The controller only acts on its joints dofs, hence its 
+    :meth:`update` method returns a ``(dofs, gforce, impedance)`` 
+    tuple (see :meth:`arboris.core.Controller.update`). The impedance
+    block is kept as long as `dt`, `K_p` and `K_d` do not change.
+
     """
     def __init__(self, joints, kp=None, kd=None, gpos_des=None, 
                  gvel_des=None, name=None):
@@ -117,24 +143,24 @@ class ProportionalDerivativeController(Controller):
         for j in self.joints:
                 dof_map.extend(range(j.dof.start, j.dof.stop))
         self._dof_map = array(dof_map)
+        self._impedance = None
+        self._impedance_gains = None
 
     def update(self, dt):
         """
         """
-        gforce = zeros(self._wndof)
-        impedance = zeros((self._wndof, self._wndof))
-        
         gpos = [] 
-        gvel = []
         for j in self.joints:
             gpos.append(j.gpos)
-            gvel.append(j.gvel)
         gpos = array(gpos).reshape(self._cndof)
-        gvel = array(gvel).reshape(self._cndof)
-        gforce[self._dof_map] = \
-                dot(self.kp, self.gpos_des - gpos) + \
+        gforce = dot(self.kp, self.gpos_des - gpos) + \
                 dot(self.kd, self.gvel_des)
-        impedance[ix_(self._dof_map, self._dof_map)] = -(dt*self.kp+self.kd)
-        return (gforce, impedance)
+        gains = self._impedance_gains
+        if gains is None or gains[0] != dt or \
+                not ((gains[1] == self.kp).all() and 
+                     (gains[2] == self.kd).all()):
+            self._impedance = -(dt*self.kp+self.kd)
+            self._impedance_gains = (dt, self.kp.copy(), self.kd.copy())
+        return (self._dof_map, gforce, self._impedance)
 
 
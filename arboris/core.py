@@ -16,11 +16,15 @@ One or more frames (instances of the :class:`SubFrame` class) can be associated
 """
 __author__ = ("Sébastien BARTHÉLEMY <barthelemy@crans.org>")
 
-from numpy import array, zeros, eye, dot
+from numpy import array, zeros, eye, dot, arange, hstack, ix_, flatnonzero,\
+    newaxis, union1d, searchsorted
 import numpy
+from time import time as _time
 import homogeneousmatrix as Hg
 from abc import ABCMeta, abstractmethod, abstractproperty
+from collections import namedtuple
 from rigidmotion import RigidMotion
+from twistvector import adjacency
 
 
 def simplearm():
@@ -147,6 +151,24 @@ class Frame(object):
     def bpose(self):
         pass
 
+    @property
+    def jacobian_dofs(self):
+        """Indices of the columns of the jacobian which may be non-zero.
+        """
+        return arange(self.jacobian.shape[1])
+
+    @property
+    def compact_jacobian(self):
+        """The jacobian, restricted to the ``jacobian_dofs`` columns.
+        """
+        return self.jacobian[:, self.jacobian_dofs]
+
+    @property
+    def compact_djacobian(self):
+        """The djacobian, restricted to the ``jacobian_dofs`` columns.
+        """
+        return self.djacobian[:, self.jacobian_dofs]
+
 class Joint(RigidMotion, NamedObject):
     """A generic class for ideal joints.
     
@@ -161,6 +183,12 @@ class Joint(RigidMotion, NamedObject):
     """    
     __metaclass__ = ABCMeta
 
+    # the cached model, the (gpos, gvel) it was computed for and the 
+    # arrays it is written in (see _compute_model)
+    _model = None
+    _model_state = None
+    _model_buffers = None
+
     def __init__(self, name=None):
         NamedObject.__init__(self, name)
         self._frame0 = None
@@ -211,6 +239,58 @@ class Joint(RigidMotion, NamedObject):
     def integrate(self, gvel, dt):
         pass
 
+    @property
+    def model(self):
+        r"""The joint quantities used by the dynamics, computed at once.
+
+        This is the ``(pose, ipose, twist, jacobian, djacobian,
+        idadjoint)`` tuple, that is `(H_{rn}, H_{nr}, \twist[n]_{n/r},
+        \J[n]_{n/r}, \dJ[n]_{n/r}, \dAd[n]_r)`. It is computed by
+        :meth:`_compute_model` and cached until the joint ``gpos`` or
+        ``gvel`` change. The arrays must not be modified, and are 
+        overwritten when the model is computed again.
+
+        >>> from arboris.joints import RzRyRxJoint
+        >>> j = RzRyRxJoint(gpos=[0.1, 0.2, 0.3], gvel=[1., 2., 3.])
+        >>> (pose, ipose, twist, jac, djac, idadjoint) = j.model
+        >>> numpy.allclose(idadjoint, j.idadjoint)
+        True
+        >>> j.model is j.model
+        True
+
+        """
+        state = self._model_state
+        if state is None:
+            self._model = self._compute_model()
+            self._model_state = (self.gpos.copy(), self.gvel.copy())
+        elif not ((state[0] == self.gpos).all() and
+                  (state[1] == self.gvel).all()):
+            self._model = self._compute_model()
+            state[0][...] = self.gpos
+            state[1][...] = self.gvel
+        return self._model
+
+    def _compute_model(self):
+        """Compute the :attr:`model` tuple.
+
+        The default implementation relies on the joint properties, and
+        writes the results in arrays preallocated for the joint.
+        Subclasses may override it to share the intermediate results.
+        """
+        if self._model_buffers is None:
+            self._model_buffers = (zeros((4,4)), zeros(6), zeros((6,6)),
+                                   zeros((6,6)))
+        (ipose, twist, iAd, idadjoint) = self._model_buffers
+        pose = self.pose
+        jac = self.jacobian
+        dot(jac, self.gvel, out=twist)
+        Hg.inv(pose, out=ipose)
+        Hg.iadjoint(pose, out=iAd)
+        itwist = dot(iAd, twist)
+        itwist *= -1.
+        dot(iAd, adjacency(itwist), out=idadjoint)
+        return (pose, ipose, twist, jac, self.djacobian, idadjoint)
+
 
 class LinearConfigurationSpaceJoint(Joint):
     """
@@ -276,6 +356,18 @@ class Constraint(NamedObject):
     def jacobian(self):
         pass
 
+    @property
+    def jacobian_dofs(self):
+        """Indices of the columns of the jacobian which may be non-zero.
+        """
+        return arange(self.jacobian.shape[1])
+
+    @property
+    def compact_jacobian(self):
+        """The jacobian, restricted to the ``jacobian_dofs`` columns.
+        """
+        return self.jacobian[:, self.jacobian_dofs]
+
     @abstractproperty
     def ndol(self):
         """Number of degrees of "liaison" 
@@ -296,6 +388,24 @@ class Constraint(NamedObject):
     def solve(self, vel, admittance, dt):
         pass
 
+    @classmethod
+    def solve_group(cls, constraints, vels, admittances, dt):
+        """Solve several uncoupled constraints of the class at once.
+
+        :param constraints: the constraints, instances of ``cls``
+        :param vels: the stacked ``vel`` arguments of :meth:`solve`
+        :type vels: (n, ndol) ndarray
+        :param admittances: the stacked ``admittance`` arguments of 
+            :meth:`solve`
+        :type admittances: (n, ndol, ndol) ndarray
+        :return: the stacked force adjustments, a (n, ndol) ndarray
+
+        This default implementation calls :meth:`solve` on each 
+        constraint. Subclasses may override it with a vectorized one.
+        """
+        return array([c.solve(v, a, dt) 
+                      for (c, v, a) in zip(constraints, vels, admittances)])
+
 
 class Shape(NamedObject):
     """A generic class for geometric shapes used in collision detection
@@ -318,21 +428,218 @@ class Controller(NamedObject):
 
     @abstractmethod
     def update(self, dt):
+        r"""Return the controller contribution to the world model.
+
+        This is either a ``(gforce, impedance)`` tuple, of the 
+        generalized force `\GForce_{0a}` and impedance `Z_a` (see 
+        :meth:`World.update_controllers`), respectively a (ndof,) and
+        a (ndof, ndof) array, or a ``(dofs, gforce, impedance)`` tuple 
+        where ``gforce`` and ``impedance`` are restricted to the 
+        ``dofs`` indices, which is cheaper for controllers which only
+        act on a few dofs.
+
+        In both cases, ``impedance`` may be ``None`` when it is zero.
+        The world keeps a copy of the returned ``dofs`` and 
+        ``impedance``, and skips the assembly of the impedances when 
+        none of them changed since the previous call. Hence, a 
+        controller may return the same arrays at each call, and even 
+        modify them in place.
+
+        The impedance may depend on ``dt``, as the force is applied 
+        during the time step, with the implicit scheme of 
+        :meth:`World.update_controllers`. For instance, a stiffness
+        `K` contributes `-dt K` to the impedance, as the position at the
+        end of the step is `\GPos + dt \GVel(t+dt)`. When ``dt`` is zero,
+        which is how the explicit integrators update the controllers 
+        (see :class:`arboris.integrators.RungeKuttaIntegrator`), the 
+        controller must return its continuous-time model, the force at 
+        the current time being `\GForce_{0a} + Z_a \GVel`.
+        """
+        pass
+
+
+class Engine(object):
+    r"""A generic class for the solvers of the world dynamical model.
+
+    The world delegates to its engine the computation of the 
+    generalized-coordinates model and the application of the admittance
+    matrix `Y` (see :meth:`World.update_controllers`). This is the 
+    only place where the model is "inverted", so that the engine 
+    determines the complexity of the time step.
+
+    This class has virtual methods. It should be subclassed by concrete
+    implementations.
+
+    """
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def init(self, world):
+        pass
+
+    @abstractmethod
+    def update_dynamic(self):
+        """Update the engine model, once the bodies model is updated.
+        """
+        pass
+
+    @abstractmethod
+    def update_admittance(self, dt):
+        """Update the admittance, once the controllers are updated.
+        """
+        pass
+
+    @abstractmethod
+    def mass_dot(self, gvel):
+        r"""Return `M \GVel`.
+        """
+        pass
+
+    @abstractmethod
+    def admittance_dot(self, gforce):
+        r"""Return `Y \GForce`.
+
+        ``gforce`` may also be a (ndof, n)-shaped array, in which case
+        each column is multiplied by the admittance.
+        """
+        pass
+
+    def admittance_dot_dofs(self, gforce, dofs):
+        r"""Return `Y_{DD} \GForce_D`, where `D` are the ``dofs``.
+
+        This is the restriction to the ``dofs`` rows of `Y \GForce`,
+        for a generalized force which is zero outside of the ``dofs``,
+        whose rows are given by ``gforce``.
+
+        This default implementation calls :meth:`admittance_dot` on the
+        whole generalized force. Subclasses may override it when the
+        admittance blocks are cheaper to access.
+        """
+        full = zeros((self._world.ndof,) + gforce.shape[1:])
+        full[dofs] = gforce
+        return self.admittance_dot(full)[dofs]
+
+
+class DenseEngine(Engine):
+    """The default engine, which uses the world dense model matrices.
+
+    The impedance is inverted explicitly, its inverse is saved in the
+    world :attr:`~arboris.core.World._admittance` attribute.
+
+    """
+    def init(self, world):
+        self._world = world
+
+    def update_dynamic(self):
+        self._world._update_model()
+
+    def update_admittance(self, dt):
+        w = self._world
+        w._impedance = w.mass/dt + w.viscosity + w.nleffects - \
+                w._controller_impedance
+        blocks = w._coupled_dofs()
+        if len(blocks) == 1:
+            w._admittance = numpy.linalg.inv(w._impedance)
+            return
+        # the impedance is block-diagonal, the blocks of the same size 
+        # are inverted at once
+        w._admittance = zeros(w._impedance.shape)
+        for n in set(len(b) for b in blocks):
+            dofs = array([b for b in blocks if len(b) == n])
+            (rows, cols) = (dofs[:,:,newaxis], dofs[:,newaxis,:])
+            w._admittance[rows, cols] = numpy.linalg.inv(
+                w._impedance[rows, cols])
+
+    def mass_dot(self, gvel):
+        return dot(self._world.mass, gvel)
+
+    def admittance_dot(self, gforce):
+        return dot(self._world._admittance, gforce)
+
+    def admittance_dot_dofs(self, gforce, dofs):
+        return dot(self._world._admittance[ix_(dofs, dofs)], gforce)
+
+
+class Integrator(object):
+    r"""A generic class for the time integration schemes.
+
+    The world delegates to its integrator the computation of its state
+    (the generalized velocity and the joints generalized positions) at
+    time `t+dt`, once the :meth:`World.update_dynamic`,
+    :meth:`World.update_controllers` and :meth:`World.update_constraints`
+    methods have been called at time `t`.
+
+    This class has virtual methods. It should be subclassed by concrete
+    implementations.
+
+    """
+    __metaclass__ = ABCMeta
+
+    needs_admittance = True
+    """Whether the integrator uses the admittance `Y` of the world 
+    engine. If not, :meth:`World.update_controllers` does not update it.
+    """
+
+    @abstractmethod
+    def init(self, world):
+        pass
+
+    @abstractmethod
+    def integrate(self, dt):
+        """Update the world generalized velocity and positions to `t+dt`.
+        """
         pass
 
 
+class EulerIntegrator(Integrator):
+    r"""The default integrator, a semi-implicit Euler scheme.
+
+    The new generalized velocity is computed from the first order model
+    of :meth:`World.update_controllers` and :meth:`World.update_constraints`
+
+    .. math::
+        \GVel(t+dt) &= Y(t) \left(
+        \frac{M(t)}{dt} \GVel(t) + \GForce(t) \right)
+
+    then each joint position is integrated with the new velocity, by the
+    joint :meth:`~arboris.core.Joint.integrate` method.
+
+    """
+    def init(self, world):
+        self._world = world
+
+    def integrate(self, dt):
+        w = self._world
+        engine = w._engine
+        w._gvel[:] = engine.admittance_dot(
+            engine.mass_dot(w._gvel/dt) + w._gforce)
+        # the sleeping islands do not move (see World.update_constraints)
+        w._gvel[w._sleeping_dofs] = 0.
+        for j in w._joints:
+            j.integrate(w._gvel[j.dof], dt)
+
+
 class World(NamedObject):
     """
 
     """
 
-    def __init__(self, name=None):
+    def __init__(self, name=None, engine=None, integrator=None):
         NamedObject.__init__(self, name)
+        if engine is None:
+            engine = DenseEngine()
+        assert isinstance(engine, Engine)
+        self._engine = engine
+        if integrator is None:
+            integrator = EulerIntegrator()
+        assert isinstance(integrator, Integrator)
+        self._integrator = integrator
         self.ground = Body('ground')
         self._current_time = 0.
         self._up = array((0., 1., 0.))
         self._controllers = [] #TODO: should be a Set?
         self._constraints = [] #TODO: should be a Set?
+        self._broad_phases = []
         self._subframes = [] #TODO: should be a Set?
         self._shapes = [] #TODO: should be a Set?
         self._ndof = 0
@@ -343,6 +650,37 @@ class World(NamedObject):
         self._nleffects = array([]) # updated by self.update_dynamic()
         self._impedance = array([]) # updated by self.update_controller()
         self._admittance = array([]) # updated by self.update_controller()
+        self._controller_impedance = array([]) # idem
+        self._impedance_blocks = [] # the (dofs, impedance) it sums
+        self._model_is_stale = False
+        # settings and report of the constraints solver 
+        self.constraints_tolerance = 1e-4
+        self.constraints_max_iterations = 20
+        self.constraints_warm_start = True
+        self._constraints_iterations = 0
+        self._constraints_residual = 0.
+        self._active_constraints = []
+        self._islands_count = (0, 0)
+        # the islands settings (see self.update_constraints())
+        self.islands_pool = None
+        self.sleep_velocity = None
+        self.sleep_steps = 20
+        self._island_rest = {}
+        self._sleeping_dofs = arange(0)
+        # the profiler (see arboris.observers.Profiler), if any
+        self.profiler = None
+        # the kinematic tree, flattened by self.init()
+        self._bodies = (self.ground,)
+        self._joints = ()
+        self._parents = array([], dtype=int)
+        self._joint_dofs = ()
+        self._link_constants = []
+        self._moving_links = ()
+        self._link_dynamics = []
+        # set when links are added, until the tree is flattened again
+        self._topology_is_stale = True
+        # incremented when the state changes, see self.invalidate_frames()
+        self._generation = 0
 
     def iterbodies(self):
         """Iterate over all bodies, with a depth-first strategy."""
@@ -440,6 +778,7 @@ class World(NamedObject):
         frame0.body.childrenjoints.append(joint)
         self.register(frame0)
         self.register(frame1)
+        self._topology_is_stale = True
         if len(args) > 0:
             self.add_link(*args)
     
@@ -489,7 +828,8 @@ class World(NamedObject):
         """
         Register an object into the world.
         
-        ``obj`` can be a subframe, a shape or a constraint.
+        ``obj`` can be a subframe, a shape, a constraint or a broad phase 
+        (see :class:`arboris.constraints.BroadPhase`).
         
         :arguments:
             obj
@@ -532,6 +872,11 @@ class World(NamedObject):
             if not obj in self._controllers:
                 self._controllers.append(obj)
         else:
+            from arboris.constraints import BroadPhase
+            if isinstance(obj, BroadPhase):
+                if not obj in self._broad_phases:
+                    self._broad_phases.append(obj)
+                return
             raise ValueError(
                 'I do not know how to register objects of type {0}'.format(type(obj)))
 
@@ -549,7 +894,8 @@ class World(NamedObject):
         self._mass = zeros((self._ndof,self._ndof))
         self._nleffects =  zeros((self._ndof,self._ndof))
         self._viscosity = zeros((self._ndof,self._ndof))
-        self._controller_viscosity = zeros((self._ndof,self._ndof))
+        self._controller_impedance = zeros((self._ndof,self._ndof))
+        self._impedance_blocks = []
         self._gforce = zeros(self._ndof)
             
         # Init the worldwide generalized velocity vector:
@@ -558,12 +904,129 @@ class World(NamedObject):
             self._gvel[j.dof] = j.gvel[:]
             j.gvel = self._gvel[j.dof]
 
+        # the constraints and controllers may rely on the flattened tree
+        self._compile_topology()
+        self._island_rest = {}
+        self._sleeping_dofs = arange(0)
+
         for c in self._constraints:
             c.init(self)
+            c._force[:] = 0.
+
+        for bp in self._broad_phases:
+            bp.init(self)
         
         for a in self._controllers:
             a.init(self)
 
+        self._engine.init(self)
+        self._integrator.init(self)
+
+    def _compile_topology(self):
+        """Flatten the kinematic tree into arrays.
+
+        The joints are sorted in depth-first order, so that a parent body
+        always comes before its children. The k-th joint links the 
+        ``self._parents[k]``-th body to the (k+1)-th one, the ground
+        being the 0-th body. The joints dofs and the constant transforms
+        of each link (see :func:`_link_constants`) are cached, which 
+        allows the forward models to be computed in a single loop.
+
+        The transforms of the links attached to a 
+        :class:`MovingSubFrame` are not constant, they are recomputed 
+        at each update.
+
+        """
+        self._joints = tuple(self.iterjoints())
+        self._bodies = (self.ground,) + \
+                tuple(j._frame1.body for j in self._joints)
+        index = dict((b, i) for (i, b) in enumerate(self._bodies))
+        self._parents = array([index[j._frame0.body] for j in self._joints],
+                              dtype=int)
+        self._joint_dofs = tuple(arange(j.dof.start, j.dof.stop)
+                                 for j in self._joints)
+        self._link_constants = [_link_constants(j) for j in self._joints]
+        self._moving_links = tuple(
+            k for (k, j) in enumerate(self._joints)
+            if isinstance(j._frame0, MovingSubFrame) or 
+               isinstance(j._frame1, MovingSubFrame))
+        self._link_dynamics = [None] * len(self._joints)
+        # the first joint of the subtree of the ground holding each dof
+        trees = arange(len(self._joints))
+        for (k, p) in enumerate(self._parents):
+            if p != 0:
+                trees[k] = trees[p-1]
+        self._dof_trees = zeros(self._ndof, dtype=int)
+        for (k, j) in enumerate(self._joints):
+            self._dof_trees[j.dof] = trees[k]
+        self._ntrees = len(set(trees))
+        self._tree_blocks = [flatnonzero(self._dof_trees == t) 
+                             for t in sorted(set(trees))]
+        self._topology_is_stale = False
+        for (k, b) in enumerate(self._bodies):
+            b._world = self
+            b._index = k
+        self.ground._set_dynamic(eye(4), zeros((6, 0)), zeros((6, 0)), 
+                                 zeros(6), arange(0), self._ndof)
+        self.invalidate_frames()
+
+    def invalidate_frames(self):
+        """Mark the bodies poses, jacobians and twists as stale.
+
+        They are then computed on demand, when they are first accessed,
+        along with those of their ancestors. This is done by 
+        :meth:`integrate`, other changes of the joints ``gpos`` or 
+        ``gvel`` should be followed by a call to this method (or to
+        :meth:`update_geometric` or :meth:`update_dynamic`).
+
+        **Example:**
+
+        >>> w = simplearm()
+        >>> w.init()
+        >>> hand = w.getbodies()['Hand']
+        >>> w.getjoints()['Shoulder'].gpos[0] = numpy.pi/2
+        >>> w.invalidate_frames()
+        >>> print numpy.round(hand.pose[0:3,3], 6)
+        [-0.9  0.   0. ]
+
+        """
+        self._generation += 1
+        # the ground model is constant
+        self.ground._pose_generation = self._generation
+        self.ground._dynamic_generation = self._generation
+
+    def _ancestors_path(self, body, generation):
+        """Return the indices of ``body`` and of its ancestors whose
+        ``generation`` attribute is stale, parents first.
+        """
+        path = []
+        k = body._index
+        while k and getattr(self._bodies[k], generation) != self._generation:
+            path.append(k)
+            k = self._parents[k-1]
+        path.reverse()
+        return path
+
+    def _update_body_geometric(self, body):
+        """Compute the pose of ``body`` and of its stale ancestors."""
+        self._update_moving_links()
+        for k in self._ancestors_path(body, '_pose_generation'):
+            (j, c) = (self._joints[k-1], self._link_constants[k-1])
+            j._frame0.body._update_child_geometric(j, c[0], c[1])
+
+    def _update_body_dynamic(self, body):
+        """Compute the dynamical model of ``body`` and of its stale 
+        ancestors.
+        """
+        self._update_moving_links()
+        for k in self._ancestors_path(body, '_dynamic_generation'):
+            j = self._joints[k-1]
+            j._frame0.body._update_child_dynamic(j, *self._link_constants[k-1])
+
+    def _update_moving_links(self):
+        for k in self._moving_links:
+            self._link_constants[k] = _link_constants(self._joints[k])
+
     @property
     def current_time(self):
         return self._current_time
@@ -572,16 +1035,60 @@ class World(NamedObject):
     def up(self):
         return self._up
 
+    @property
+    def engine(self):
+        """The engine used to solve the world dynamical model.
+
+        Changing the engine takes effect at the next call to 
+        :meth:`init`.
+
+        """
+        return self._engine
+
+    @engine.setter
+    def engine(self, engine):
+        assert isinstance(engine, Engine)
+        self._engine = engine
+
+    @property
+    def constraints_iterations(self):
+        """Number of Gauss-Seidel sweeps done at the last time step.
+        """
+        return self._constraints_iterations
+
+    @property
+    def constraints_islands(self):
+        """Numbers of constraints islands and of awake islands at the last
+        time step (see :meth:`update_constraints`).
+        """
+        return self._islands_count
+
+    @property
+    def constraints_residual(self):
+        """Residual of the Gauss-Seidel solver at the last time step.
+
+        This is the largest constraint force change during the last
+        sweep, relative to the largest constraint force (see 
+        :meth:`update_constraints`).
+        """
+        return self._constraints_residual
+
     @property
     def mass(self):
+        if self._model_is_stale:
+            self._update_model()
         return self._mass
 
     @property
     def viscosity(self):
+        if self._model_is_stale:
+            self._update_model()
         return self._viscosity
 
     @property
     def nleffects(self):
+        if self._model_is_stale:
+            self._update_model()
         return self._nleffects
 
     @property
@@ -595,7 +1102,10 @@ class World(NamedObject):
     def update_geometric(self):
         """Compute the forward geometric model. 
         
-        This will recursively update each body pose attribute.
+        This will update each body pose attribute.
+
+        The tree flattened by :meth:`init` is used, unless links were 
+        added since, in which case the tree is traversed recursively.
         
         Example:
 
@@ -603,7 +1113,18 @@ class World(NamedObject):
         >>> w.update_geometric()
         
         """
-        self.ground.update_geometric(eye(4))
+        profiler = self.profiler
+        if profiler is not None:
+            start = _time()
+        if self._topology_is_stale:
+            self.ground.update_geometric(eye(4))
+        else:
+            self.ground._pose = eye(4)
+            self._update_moving_links()
+            for (j, c) in zip(self._joints, self._link_constants):
+                j._frame0.body._update_child_geometric(j, c[0], c[1])
+        if profiler is not None:
+            profiler.record('update_geometric', _time() - start)
 
     def update_kinematic(self):
         """
@@ -617,7 +1138,7 @@ class World(NamedObject):
     def update_dynamic(self):
         r"""Compute the forward geometric, kinematic and dynamic models. 
         
-        Recursively update each body pose, jacobian, djacobian, twist 
+        Update each body pose, jacobian, djacobian, twist 
         and nleffects attributes (thanks to the
         :meth:`arboris.Body.update_dynamic` method) and then update
         the world mass, viscosity and nleffects attributes.
@@ -647,26 +1168,48 @@ class World(NamedObject):
         .. math::
             M \dGVel + \left( N + B \right) \GVel = 0
 
+        The bodies are updated in the order given by the tree 
+        flattened by :meth:`init`, parents first. If links were added
+        since, :meth:`init` is called first, as the world gets new dofs.
+
         """        
-        self.ground.update_dynamic(
-            eye(4),
-            zeros((6,self._ndof)),
-            zeros((6,self._ndof)),
-            zeros(6))
-        
+        if self._topology_is_stale:
+            self.init()
+        profiler = self.profiler
+        if profiler is not None:
+            start = _time()
+        self.ground._set_dynamic(eye(4), zeros((6, 0)), zeros((6, 0)), 
+                                 zeros(6), arange(0), self._ndof)
+        self._update_moving_links()
+        for (k, j) in enumerate(self._joints):
+            self._link_dynamics[k] = j._frame0.body._update_child_dynamic(
+                j, *self._link_constants[k])
+        self._model_is_stale = True
+        self._engine.update_dynamic()
+        if profiler is not None:
+            profiler.record('update_dynamic', _time() - start)
+
+    def _update_model(self):
+        """Compute the world mass, viscosity and nleffects matrices.
+
+        The engine may call this method from its own 
+        :meth:`~arboris.core.Engine.update_dynamic` method, otherwise the
+        matrices are computed on first access.
+
+        """
+        self._model_is_stale = False
         self._mass[:] = 0.
         self._viscosity[:] = 0.
         self._nleffects[:] = 0.
-        for b in self.ground.iter_descendant_bodies():
-            self._mass += dot(
-                dot(b.jacobian.T, b.mass),
-                b.jacobian)
-            self._viscosity += dot(
-                dot(b.jacobian.T, b.viscosity),
-                b.jacobian)
-            self._nleffects += dot(
-                b.jacobian.T,
-                dot(b.mass, b.djacobian) + dot(b.nleffects, b.jacobian))
+        for b in self._bodies[1:]:
+            # only the ancestors dofs blocks are non-zero
+            dofs = ix_(b._dofs, b._dofs)
+            J = b._cjacobian
+            self._mass[dofs] += dot(dot(J.T, b.mass), J)
+            self._viscosity[dofs] += dot(dot(J.T, b.viscosity), J)
+            self._nleffects[dofs] += dot(
+                J.T,
+                dot(b.mass, b._cdjacobian) + dot(b.nleffects, J))
 
     def update_controllers(self, dt):
         r"""
@@ -744,13 +1287,73 @@ class World(NamedObject):
 
         """
         assert dt > 0
+        profiler = self.profiler
+        if profiler is not None:
+            start = _time()
+        self._sum_controllers(dt)
+        if not self._integrator.needs_admittance:
+            pass
+        elif profiler is not None:
+            start_a = _time()
+            self._engine.update_admittance(dt)
+            profiler.record('update_controllers', _time() - start_a, 
+                            'admittance')
+        else:
+            self._engine.update_admittance(dt)
+        if profiler is not None:
+            profiler.record('update_controllers', _time() - start)
+
+    def _sum_controllers(self, dt):
+        """Update the controllers and sum their generalized forces and
+        impedances into ``self._gforce`` and 
+        ``self._controller_impedance``, without updating the admittance.
+
+        With ``dt`` set to zero, this is the continuous-time model of 
+        the controllers (see :meth:`Controller.update`).
+        """
+        profiler = self.profiler
         self._gforce[:] = 0.
-        self._impedance = self._mass/dt + self._viscosity + self._nleffects 
+        blocks = []
         for a in self._controllers:
-            (gforce, impedance) = a.update(dt)
-            self._gforce += gforce
-            self._impedance -= impedance
-        self._admittance = numpy.linalg.inv(self._impedance)
+            if profiler is not None:
+                start_a = _time()
+            result = a.update(dt)
+            if len(result) == 3:
+                (dofs, gforce, impedance) = result
+                self._gforce[dofs] += gforce
+            else:
+                (gforce, impedance) = result
+                dofs = None
+                self._gforce += gforce
+            blocks.append((dofs, impedance))
+            if profiler is not None:
+                profiler.record('update_controllers', _time() - start_a, a)
+        self._assemble_controller_impedance(blocks)
+
+    def _assemble_controller_impedance(self, blocks):
+        """Sum the controllers impedances, as returned by 
+        :meth:`Controller.update`, into ``self._controller_impedance``.
+
+        The sum is kept if the blocks are equal to those of the 
+        previous call, a copy of which is kept.
+        """
+        previous = self._impedance_blocks
+        if len(blocks) == len(previous) and \
+                all(_same_block(d, d0) and _same_block(z, z0)
+                    for ((d, z), (d0, z0)) in zip(blocks, previous)):
+            return
+        self._impedance_blocks = [
+            (None if d is None else array(d), None if z is None else array(z))
+            for (d, z) in blocks]
+        Z = self._controller_impedance
+        Z[:] = 0.
+        for (dofs, impedance) in blocks:
+            if impedance is None:
+                pass
+            elif dofs is None:
+                Z += impedance
+            else:
+                Z[ix_(dofs, dofs)] += impedance
 
     def update_constraints(self, dt):
         r"""
@@ -828,47 +1431,394 @@ class World(NamedObject):
 
         This method computes the constraint forces in three steps:
 
-        - ask each active constraint object for its jacobian,
+        - ask each registered broad phase for the contacts which may
+          be active, then update all the constraints and ask each 
+          active constraint object for its jacobian,
 
-        - compute `J`, `v`  and `Y`,
+        - partition the active constraints into islands (see below),
+          then for each island:
 
-        - iterate over each constraint object in order to compute 
-          `\pre[c]f`. At each iteration the force is 
-          updated by `\Delta\pre[c]f`
+          - compute `J`, `v`  and `Y` (see :meth:`_delassus`),
+
+          - iterate over each constraint object in order to compute 
+            `\pre[c]f`. At each iteration the force is 
+            updated by `\Delta\pre[c]f`
 
         - eventually add each active constraint generalized force to
           world :attr:`~arboros.core.World._gforce` property.
         
+        **Convergence:**
+
+        The Gauss-Seidel iterations (or sweeps) stop when the constraints
+        forces change, during a sweep, by less than 
+        :attr:`constraints_tolerance` times the largest constraint force,
+        or after :attr:`constraints_max_iterations` sweeps. This relative
+        criterion does not depend on the units nor on the load of the
+        constraints: the contacts velocities are of the order of 
+        `10^{-3}\;\text{m/s}` at rest, and each sweep only reduces the 
+        error by a constant factor, so that no absolute velocity 
+        tolerance would suit both light and heavy worlds. The number of 
+        sweeps and the final residual are then available from the
+        :attr:`constraints_iterations` and :attr:`constraints_residual`
+        properties.
+
+        Solving at once several constraints which are not coupled (the 
+        corresponding off-diagonal blocks of `Y'` are zero) is the same 
+        as solving them one after the other. The active constraints are 
+        thus colored into groups of uncoupled constraints of the same 
+        class, and each group is solved at once by the 
+        :meth:`Constraint.solve_group` method. This changes the order 
+        of the sweeps, but not their solution.
+
+        In practice, only the constraints on distinct subtrees of the 
+        ground (such as the contacts of free objects) are uncoupled: the
+        contacts of a single articulated robot, such as the feet of a 
+        standing humanoid, are all coupled through its root and end up 
+        in groups of size one. They are then solved one after the other,
+        as without the coloring.
+
+        If :attr:`constraints_warm_start` is true, the iterations start 
+        from the forces of the previous time step for the constraints 
+        which remain active (such as persistent contacts), otherwise 
+        they start from zero. The forces of the inactive constraints are
+        always reset to zero.
+
+        **Islands:**
+
+        The active constraints are partitioned into islands (see 
+        :meth:`_islands`): the subtrees of the ground, such as several 
+        robots or free objects, are not coupled by the admittance, 
+        unless through a controller impedance. Hence, the constraints
+        which do not involve, directly or through other constraints,
+        the same subtrees can be solved independently. 
+
+        By default, the awake islands (see below) are packed into a 
+        single problem, whose coloring keeps the islands independent
+        while allowing the vectorized solves of the groups. If the 
+        :attr:`islands_pool` attribute is set to an object with a 
+        ``map`` method, such as a 
+        :class:`multiprocessing.pool.ThreadPool`, each island gets 
+        instead its own constraints admittance `Y'` and Gauss-Seidel 
+        sweeps, which stop as soon as the island converged, and the 
+        islands are solved by this pool. The constraints are solved in
+        place, so a process pool cannot be used.
+        :attr:`constraints_iterations` and :attr:`constraints_residual`
+        report the worst island, :attr:`constraints_islands` the number
+        of islands.
+
+        If the :attr:`sleep_velocity` attribute is set, the islands 
+        which stay at rest during more than :attr:`sleep_steps` time 
+        steps fall asleep: their constraints are not solved anymore and
+        their generalized velocity is set to zero. The rest detection
+        relies on the forces of the previous time step, hence on 
+        :attr:`constraints_warm_start` (see :meth:`_update_sleep`).
+
         TODO: add an example.
 
         """
         assert dt > 0
+        profiler = self.profiler
+        if profiler is not None:
+            start = _time()
+        candidates = self._constraints
+        for bp in self._broad_phases:
+            if profiler is not None:
+                start_c = _time()
+            candidates = candidates + bp.update(dt)
+            if profiler is not None:
+                profiler.record('update_constraints', _time() - start_c, bp)
         constraints = []
-        ndol = 0
-        for c in self._constraints:
-            c.update(dt)
+        for c in candidates:
+            if profiler is None:
+                c.update(dt)
+            else:
+                start_c = _time()
+                c.update(dt)
+                profiler.record('update_constraints', _time() - start_c, c)
             if c.is_active():
-                c._dol = slice(ndol, ndol+c.ndol)
-                ndol = ndol + c.ndol
                 constraints.append(c)
-        jac = zeros((ndol, self._ndof))
+                if not self.constraints_warm_start:
+                    c._force[:] = 0.
+            else:
+                c._force[:] = 0.
+        if profiler is not None:
+            start_c = _time()
         gforce = self._gforce.copy()
+        jacobians = []
         for c in constraints:
-            jac[c._dol,:] = c.jacobian
-            gforce += c.gforce
-        vel = dot(jac, dot(self._admittance, 
-                           dot(self._mass, self._gvel/dt) + gforce))
-        admittance = dot(jac, dot(self._admittance, jac.T))
-
-        k=0
-        while k < 20: 
-        #TODO: change the break condition, it should be computed from the error
-            k+=1 
-            for c in constraints:
-                dforce = c.solve(vel[c._dol], admittance[c._dol,c._dol], dt)
-                vel += dot(admittance[:,c._dol], dforce)
+            (dofs, jac) = (c.jacobian_dofs, c.compact_jacobian)
+            jacobians.append((dofs, jac))
+            gforce[dofs] += dot(jac.T, c._force)
+        engine = self._engine
+        if constraints:
+            gvel = engine.admittance_dot(engine.mass_dot(self._gvel/dt) +
+                                         gforce)
+        else:
+            # there is no island
+            gvel = None
+        trees = self._coupled_trees()
+        islands = self._islands(constraints, jacobians, trees)
+        if self.sleep_velocity is None:
+            awake = islands
+            self._sleeping_dofs = arange(0)
+        else:
+            awake = self._update_sleep(islands, trees, gvel)
+        self._islands_count = (len(islands), len(awake))
+        if self.islands_pool is None or len(awake) < 2:
+            # packing the islands allows the vectorized group solves
+            map_ = map
+            if awake:
+                awake = [tuple(sum((list(island[i]) for island in awake), 
+                                   []) for i in range(2))]
+        else:
+            map_ = self.islands_pool.map
+        problems = map_(lambda island: 
+                        self._assemble_island(island, gvel, trees), awake)
+        if profiler is not None:
+            now = _time()
+            profiler.record('update_constraints', now - start_c, 'assembly')
+            start_c = now
+        reports = map_(lambda problem: self._solve_island(problem, dt), 
+                       problems)
+        self._constraints_iterations = max([0] + [k for (k, r) in reports])
+        self._constraints_residual = max([0.] + [r for (k, r) in reports])
+        self._active_constraints = constraints
+        for (c, (dofs, jac)) in zip(constraints, jacobians):
+            self._gforce[dofs] += dot(jac.T, c._force)
+        if profiler is not None:
+            now = _time()
+            profiler.record('update_constraints', now - start_c, 'sweeps')
+            profiler.record('update_constraints', now - start)
+
+    def _coupled_dofs(self):
+        """Return the dofs of each set of coupled subtrees of the ground.
+
+        The world impedance is block-diagonal, with a block per set (see 
+        :meth:`_coupled_trees`).
+        """
+        if self._ntrees == 1:
+            return self._tree_blocks
+        trees = self._coupled_trees()
+        if trees is self._dof_trees:
+            return self._tree_blocks
+        return [flatnonzero(trees == t) for t in sorted(set(trees))]
+
+    def _islands(self, constraints, jacobians, trees):
+        """Partition the active constraints into islands.
+
+        Two constraints belong to the same island if they involve the 
+        same set of coupled subtrees of the ground (see 
+        :meth:`_coupled_trees`), directly or through other constraints.
+        The constraints of distinct islands are not coupled, they can
+        thus be solved independently.
+
+        Return a list of ``(constraints, jacobians, labels)`` tuples, 
+        where ``labels`` is the set of the subtrees labels of the 
+        island. The islands and their constraints are sorted in the 
+        constraints order.
+        """
+        roots = {}
+        def find(t):
+            while roots[t] != t:
+                t = roots[t]
+            return t
+        labels = []
+        for (dofs, jac) in jacobians:
+            if not len(dofs):
+                labels.append(())
+                continue
+            l = trees[dofs]
+            l = (l[0],) if (l == l[0]).all() else tuple(numpy.unique(l))
+            for t in l:
+                roots.setdefault(t, t)
+            for t in l[1:]:
+                roots[find(t)] = find(l[0])
+            labels.append(l)
+        islands = {}
+        order = []
+        for (c, jacobian, l) in zip(constraints, jacobians, labels):
+            key = find(l[0]) if l else c
+            if key not in islands:
+                islands[key] = ([], [], set())
+                order.append(key)
+            island = islands[key]
+            island[0].append(c)
+            island[1].append(jacobian)
+            island[2].update(l)
+        return [islands[key] for key in order]
+
+    def _update_sleep(self, islands, trees, gvel):
+        """Return the awake islands, put the others to sleep.
+
+        An island falls asleep when the generalized velocity of its dofs,
+        computed with the constraints forces of the previous time step,
+        remains below :attr:`sleep_velocity` during 
+        :attr:`sleep_steps` time steps. It wakes up as soon as this is
+        no longer the case, or when its active constraints change.
+        """
+        rest = {}
+        awake = []
+        sleeping = [arange(0)]
+        for island in islands:
+            key = frozenset(island[0])
+            dofs = flatnonzero(numpy.in1d(trees, list(island[2])))
+            if len(dofs) and abs(gvel[dofs]).max() <= self.sleep_velocity:
+                rest[key] = self._island_rest.get(key, 0) + 1
+            else:
+                rest[key] = 0
+            if rest[key] > self.sleep_steps:
+                sleeping.append(dofs)
+            else:
+                awake.append(island)
+        self._island_rest = rest
+        self._sleeping_dofs = hstack(sleeping)
+        return awake
+
+    def _assemble_island(self, island, gvel, trees):
+        """Assemble the constraints problem of an island.
+
+        ``gvel`` is the generalized velocity the world would have 
+        without the constraints forces adjustments. Return the 
+        constraints, their velocities `v'`, admittance `Y'` and groups 
+        (see :meth:`_group_constraints`).
+        """
+        (constraints, jacobians) = island[0:2]
+        ndol = 0
         for c in constraints:
-            self._gforce += c.gforce
+            c._dol = slice(ndol, ndol+c.ndol)
+            ndol = ndol + c.ndol
+        vel = zeros(ndol)
+        for (c, (dofs, jac)) in zip(constraints, jacobians):
+            vel[c._dol] = dot(jac, gvel[dofs])
+        admittance = self._delassus(constraints, jacobians, ndol, trees)
+        return (constraints, vel, admittance,
+                self._group_constraints(constraints, admittance))
+
+    def _solve_island(self, problem, dt):
+        """Solve the constraints problem of an island.
+
+        ``problem`` is given by :meth:`_assemble_island`. Return the 
+        number of Gauss-Seidel sweeps and the final residual.
+        """
+        (constraints, vel, admittance, groups) = problem
+        k = 0
+        residual = 0.
+        while k < self.constraints_max_iterations:
+            k += 1
+            change = 0.
+            for (group, dols) in groups:
+                if len(group) == 1:
+                    c = group[0]
+                    dforce = c.solve(vel[c._dol], admittance[c._dol,c._dol],
+                                     dt)
+                else:
+                    dforce = type(group[0]).solve_group(group, vel[dols], 
+                        admittance[dols[:,:,newaxis], dols[:,newaxis,:]],
+                        dt).reshape(-1)
+                vel += dot(admittance[:,dols.reshape(-1)], dforce)
+                change = max(change, abs(dforce).max())
+            force = max(abs(c._force).max() for c in constraints)
+            residual = change/force if force > 0. else 0.
+            if residual <= self.constraints_tolerance:
+                break
+        return (k, residual)
+
+    def _coupled_trees(self):
+        """Label each dof by the set of coupled subtrees it belongs to.
+
+        The subtrees of the ground are dynamically uncoupled, unless a 
+        controller impedance couples some of their dofs. Such subtrees
+        are merged and get the same label.
+        """
+        trees = self._dof_trees
+        if self._ntrees == 1:
+            return trees
+        (i, j) = numpy.nonzero(self._controller_impedance)
+        cross = trees[i] != trees[j]
+        if not cross.any():
+            return trees
+        roots = dict((t, t) for t in trees)
+        def find(t):
+            while roots[t] != t:
+                t = roots[t]
+            return t
+        for (a, b) in zip(trees[i[cross]], trees[j[cross]]):
+            roots[find(a)] = find(b)
+        return array([find(t) for t in trees])
+
+    def _delassus(self, constraints, jacobians, ndol, trees=None):
+        r"""Compute the constraints admittance `Y' = J' \; Y \; J'^T`.
+
+        ``jacobians`` holds the ``(jacobian_dofs, compact_jacobian)``
+        tuple of each constraint, the jacobians are thus kept compact. 
+        ``trees`` defaults to the result of :meth:`_coupled_trees`.
+
+        The admittance `Y` does not couple the subtrees of the ground 
+        (see :meth:`_coupled_trees`), hence `Y'` is the sum, over each 
+        set `T` of coupled subtrees, of `J'_T \; Y_{TT} \; J'^T_T`, 
+        where `J'_T` is the restriction of `J'` to the rows of the 
+        constraints which involve `T` and to the columns of their dofs 
+        in `T`. Only these blocks of `Y'` are computed, using the 
+        engine :meth:`~Engine.admittance_dot_dofs` method, the others
+        are structurally zero.
+        """
+        admittance = zeros((ndol, ndol))
+        if trees is None:
+            trees = self._coupled_trees()
+        parts = {}
+        for (c, (dofs, jac)) in zip(constraints, jacobians):
+            if not len(dofs):
+                continue
+            labels = trees[dofs]
+            if (labels == labels[0]).all():
+                parts.setdefault(labels[0], []).append((c._dol, dofs, jac))
+            else:
+                for t in numpy.unique(labels):
+                    mask = (labels == t)
+                    parts.setdefault(t, []).append(
+                        (c._dol, dofs[mask], jac[:, mask]))
+        for items in parts.values():
+            dofs = numpy.unique(hstack([d for (dol, d, j) in items]))
+            rows = hstack([arange(dol.start, dol.stop) 
+                           for (dol, d, j) in items])
+            jac = zeros((len(rows), len(dofs)))
+            r = 0
+            for (dol, d, j) in items:
+                jac[r:r+len(j), numpy.searchsorted(dofs, d)] = j
+                r += len(j)
+            admittance[ix_(rows, rows)] += dot(
+                jac, self._engine.admittance_dot_dofs(jac.T, dofs))
+        return admittance
+
+    def _group_constraints(self, constraints, admittance):
+        """Color the constraints into groups of uncoupled constraints.
+
+        Return a list of ``(group, dols)`` tuples, where ``group`` is a 
+        list of constraints of the same class and size and ``dols`` is a
+        (len(group), ndol) array of their indices in the constraints 
+        space. The groups are built greedily, in the constraints order. 
+        Coupled constraints are never put in the same group, which 
+        would make the sweeps a block-Jacobi iteration.
+        """
+        if not constraints:
+            return []
+        starts = [c._dol.start for c in constraints]
+        coupled = numpy.logical_or.reduceat(numpy.logical_or.reduceat(
+            admittance != 0., starts, 0), starts, 1)
+        groups = []
+        for (i, c) in enumerate(constraints):
+            for g in groups:
+                d = constraints[g[0]]
+                if type(d) is type(c) and d.ndol == c.ndol and \
+                        not coupled[i, g].any():
+                    g.append(i)
+                    break
+            else:
+                groups.append([i])
+        return [([constraints[i] for i in g], 
+                 array([arange(constraints[i]._dol.start, 
+                               constraints[i]._dol.stop) for i in g]))
+                for g in groups]
 
     def integrate(self, dt):
         r"""
@@ -887,6 +1837,10 @@ class World(NamedObject):
         In order to get the new generalized position, each joint is integrated
         separately.
 
+        This is the scheme of the default :class:`EulerIntegrator`, the
+        world may be given another integrator when it is created (see
+        the :mod:`arboris.integrators` module).
+
         TODO: add support for kinematic controllers
         TODO: repair this doctest
         TODO: check the last test result!
@@ -906,12 +1860,14 @@ class World(NamedObject):
         array([-0.00709132,  0.03355273, -0.09131555])
         """
         assert dt > 0
-        self._gvel[:] = dot(self._admittance, 
-                            dot(self._mass, self._gvel/dt) + self._gforce)
-        
-        for j in self.iterjoints():
-            j.integrate(self._gvel[j.dof], dt)
+        profiler = self.profiler
+        if profiler is not None:
+            start = _time()
+        self._integrator.integrate(dt)
         self._current_time += dt
+        self.invalidate_frames()
+        if profiler is not None:
+            profiler.record('integrate', _time() - start)
 
 
 class _SubFrame(NamedObject, Frame):
@@ -954,16 +1910,34 @@ class _SubFrame(NamedObject, Frame):
     
     @property
     def twist(self):
-        return dot(Hg.iadjoint(self._bpose), self._body._twist)
+        return Hg.iadjoint_dot(self._bpose, self._body.twist)
 
     @property
     def jacobian(self):
-        return dot(Hg.iadjoint(self._bpose), self._body._jacobian)
+        cjac = self.compact_jacobian
+        jac = zeros((6, self._body._ndof))
+        jac[:, self._body._dofs] = cjac
+        return jac
 
     @property
     def djacobian(self):
+        cdjac = self.compact_djacobian
+        djac = zeros((6, self._body._ndof))
+        djac[:, self._body._dofs] = cdjac
+        return djac
+
+    @property
+    def jacobian_dofs(self):
+        return self._body.jacobian_dofs
+
+    @property
+    def compact_jacobian(self):
+        return Hg.iadjoint_dot(self._bpose, self._body.compact_jacobian)
+
+    @property
+    def compact_djacobian(self):
         # we assume self._bpose is constant
-        return dot(Hg.iadjoint(self._bpose), self._body._djacobian)
+        return Hg.iadjoint_dot(self._bpose, self._body.compact_djacobian)
 
     @property
     def body(self):
@@ -1009,57 +1983,100 @@ class Body(NamedObject, Frame):
         self.mass = mass
         self.viscosity = viscosity
         self._pose = None # updated by update_{geometric,kinematic,dynamic}
-        self._jacobian = None # updated by update_{geometric,kinematic,dynamic}
-        self._djacobian = None # updated by update_dynamic
+        # the jacobians are stored in compact form: only the columns 
+        # corresponding to the ancestors dofs are kept
+        self._dofs = None # updated by update_dynamic
+        self._ndof = None # updated by update_dynamic
+        self._cjacobian = None # updated by update_dynamic
+        self._cdjacobian = None # updated by update_dynamic
+        self._jacobian = None # dense view of _cjacobian, built on demand
+        self._djacobian = None # dense view of _cdjacobian, built on demand
         self._twist = None # updated by update_dynamic
         self._nleffects = None # updated by update_dynamic
+        # the world, which computes the stale models on demand, and the
+        # generations of the pose and dynamical model (see World.init)
+        self._world = None
+        self._index = None
+        self._pose_generation = None
+        self._dynamic_generation = None
 
     def iter_descendant_bodies(self):
         """Iterate over all descendant bodies, with a depth-first strategy"""
-        from itertools import imap
-        for b in imap(lambda j: j._frame1.body, self.childrenjoints):
-            yield b
-            for bb in b.iter_descendant_bodies():
-                yield bb
+        for j in self.iter_descendant_joints():
+            yield j._frame1.body
 
     def iter_ancestor_bodies(self):
-        if self.parentjoint is not None:
-            parentbody = self.parentjoint._frame0.body
-            yield parentbody
-            for a in parentbody.iter_ancestor_bodies():
-                yield a
+        for j in self.iter_ancestor_joints():
+            yield j._frame0.body
     
     def iter_descendant_joints(self):
         """Iterate over all descendant joints, with a depth-first strategy"""
-        for j in self.childrenjoints:
+        # we use an explicit stack, deep trees would otherwise exceed 
+        # the python recursion limit
+        stack = list(reversed(self.childrenjoints))
+        while stack:
+            j = stack.pop()
             yield j
-            for jj in j._frame1.body.iter_descendant_joints():
-                yield jj
+            stack.extend(reversed(j._frame1.body.childrenjoints))
 
     def iter_ancestor_joints(self):
-        if self.parentjoint is not None:
-            yield self.parentjoint
-            for a in self.parentjoint._frame0.body.iter_ancestor_joints():
-                yield a
+        j = self.parentjoint
+        while j is not None:
+            yield j
+            j = j._frame0.body.parentjoint
+
+    def _refresh_dynamic(self):
+        """Update the dynamical model if the world state changed."""
+        w = self._world
+        if w is not None and self._dynamic_generation != w._generation:
+            w._update_body_dynamic(self)
 
     @property
     def pose(self):
+        w = self._world
+        if w is not None and self._pose_generation != w._generation:
+            w._update_body_geometric(self)
         return self._pose
 
     @property
     def jacobian(self):
+        self._refresh_dynamic()
+        if self._jacobian is None and self._cjacobian is not None:
+            self._jacobian = zeros((6, self._ndof))
+            self._jacobian[:, self._dofs] = self._cjacobian
         return self._jacobian
 
     @property
     def djacobian(self):
+        self._refresh_dynamic()
+        if self._djacobian is None and self._cdjacobian is not None:
+            self._djacobian = zeros((6, self._ndof))
+            self._djacobian[:, self._dofs] = self._cdjacobian
         return self._djacobian
 
+    @property
+    def jacobian_dofs(self):
+        self._refresh_dynamic()
+        return self._dofs
+
+    @property
+    def compact_jacobian(self):
+        self._refresh_dynamic()
+        return self._cjacobian
+
+    @property
+    def compact_djacobian(self):
+        self._refresh_dynamic()
+        return self._cdjacobian
+
     @property
     def twist(self):
+        self._refresh_dynamic()
         return self._twist
 
     @property
     def nleffects(self):
+        self._refresh_dynamic()
         return self._nleffects
 
     @property
@@ -1084,14 +2101,22 @@ class Body(NamedObject, Frame):
              = H_gp * (H_pr * H_rn * H_nc)
         """
         self._pose = pose
-        H_gp = pose
-        for j in self.childrenjoints:
-            H_cn = j._frame1.bpose
-            H_pr = j._frame0.bpose
-            H_rn = j.pose
-            H_pc = dot(H_pr, dot(H_rn, Hg.inv(H_cn)))
-            child_pose = dot(H_gp, H_pc)
-            j._frame1.body.update_geometric(child_pose)
+        if self._world is not None:
+            self._pose_generation = self._world._generation
+        for j in self.iter_descendant_joints():
+            (H_pr, H_nc) = _link_constants(j)[0:2]
+            j._frame0.body._update_child_geometric(j, H_pr, H_nc)
+
+    def _update_child_geometric(self, j, H_pr, H_nc):
+        """Compute the pose of the child body of the joint ``j``.
+
+        :param H_pr: the constant pose of the joint reference frame
+        :param H_nc: the constant inverse pose of the joint new frame
+        """
+        H_pc = dot(H_pr, dot(j.pose, H_nc))
+        child = j._frame1.body
+        child._pose = dot(self._pose, H_pc)
+        child._pose_generation = self._pose_generation
         
     def update_dynamic(self, pose, jac, djac, twist):
         r"""Sets the body ``pose, jac, djac, twist`` and computes its children ones.
@@ -1206,15 +2231,44 @@ class Body(NamedObject, Frame):
         :attr:`~arboris.core.Joint.djacobian` attributes.
 
         T_ab: velocity of {a} relative to {b} expressed in {a} (body twist)
+
+        **Storage:**
+
+        The jacobian of a body is zero except on the columns 
+        corresponding to the dofs of its ancestor joints. Only these 
+        columns are stored and propagated (see the 
+        :attr:`jacobian_dofs` and :attr:`compact_jacobian` attributes), 
+        the dense :attr:`jacobian` and :attr:`djacobian` are built on 
+        demand.
+        """
+        dofs = flatnonzero(jac.any(0) | djac.any(0))
+        self._set_dynamic(pose, jac[:, dofs], djac[:, dofs], twist, dofs,
+                          jac.shape[1])
+        if self._world is not None:
+            self._pose_generation = self._world._generation
+            self._dynamic_generation = self._world._generation
+        # the parent bodies are updated before their children
+        for j in self.iter_descendant_joints():
+            j._frame0.body._update_child_dynamic(j, *_link_constants(j))
+
+    def _set_dynamic(self, pose, cjac, cdjac, twist, dofs, ndof):
+        """Set the body dynamical model, with compact jacobians.
+
+        :param dofs: the indices of the ``cjac`` and ``cdjac`` columns
+        :param ndof: the number of dofs of the world
         """
         self._pose = pose
-        self._jacobian = jac
-        self._djacobian = djac
+        self._dofs = dofs
+        self._ndof = ndof
+        self._cjacobian = cjac
+        self._cdjacobian = cdjac
+        self._jacobian = None
+        self._djacobian = None
         self._twist = twist
         wx = array(
-            [[             0,-self.twist[2], self.twist[1]],
-             [ self.twist[2],             0,-self.twist[0]],
-             [-self.twist[1], self.twist[0],             0]])
+            [[        0,-twist[2], twist[1]],
+             [ twist[2],        0,-twist[0]],
+             [-twist[1], twist[0],        0]])
         if self.mass[3,3]<=1e-10: #TODO: avoid hardcoded value
             rx = zeros((3,3))
         else:
@@ -1223,34 +2277,70 @@ class Body(NamedObject, Frame):
         self._nleffects[0:3,0:3] = wx
         self._nleffects[3:6,3:6] = wx
         self._nleffects[0:3,3:6] = dot(rx,wx) - dot(wx,rx)
-        self._nleffects = dot(self.nleffects, self.mass)
-
-        H_gp = pose
-        J_pg = jac
-        dJ_pg = djac
-        T_pg = twist
-        for j in self.childrenjoints:
-            H_cn = j._frame1.bpose
-            H_pr = j._frame0.bpose
-            H_rn = j.pose
-            H_pc = dot(H_pr, dot(H_rn, Hg.inv(H_cn)))
-            child_pose = dot(H_gp, H_pc)
-            Ad_cp = Hg.iadjoint(H_pc)
-            Ad_cn = Hg.adjoint(H_cn)
-            Ad_rp = Hg.adjoint(Hg.inv(H_pr))
-            dAd_nr = j.idadjoint
-            dAd_cp = dot(Ad_cn, dot(dAd_nr, Ad_rp))
-            T_nr = j.twist
-            J_nr = j.jacobian
-            dJ_nr = j.djacobian
-            child_twist = dot(Ad_cp, T_pg) + dot(Ad_cn, T_nr)
-            child_jac = dot(Ad_cp, J_pg)
-            child_jac[:,j.dof] += dot(Ad_cn, J_nr)
-
-            child_djac = dot(dAd_cp, J_pg) + dot(Ad_cp, dJ_pg)
-            child_djac[:,j.dof] += dot(Ad_cn, dJ_nr)
-            j._frame1.body.update_dynamic(child_pose, child_jac, child_djac, 
-                                          child_twist)
+        self._nleffects = dot(self._nleffects, self.mass)
+
+    def _update_child_dynamic(self, j, H_pr, H_nc, Ad_cn, Ad_rp):
+        r"""Compute the dynamical model of the child body of the joint ``j``.
+
+        The arguments are the joint constant transforms, as returned by
+        :func:`_link_constants`. The method returns the matrices 
+        `\Ad[c]_p`, `\dAd[c]_p`, `\Ad[c]_n \; \J[n]_{n/r}` and 
+        `\Ad[c]_n \; \dJ[n]_{n/r}`, which the engines may reuse.
+        """
+        (H_gp, J_pg, dJ_pg, T_pg) = (self._pose, self._cjacobian,
+                                     self._cdjacobian, self._twist)
+        dofs = self._dofs
+        (H_rn, H_nr, T_nr, J_nr, dJ_nr, dAd_nr) = j.model
+        H_pc = dot(H_pr, dot(H_rn, H_nc))
+        child_pose = dot(H_gp, H_pc)
+        Ad_cp = Hg.iadjoint(H_pc)
+        dAd_cp = dot(Ad_cn, dot(dAd_nr, Ad_rp))
+        X = dot(Ad_cn, J_nr)
+        dX = dot(Ad_cn, dJ_nr)
+        child_twist = dot(Ad_cp, T_pg) + dot(Ad_cn, T_nr)
+        joint_dofs = arange(j.dof.start, j.dof.stop)
+        if len(dofs) == 0 or dofs[-1] < j.dof.start:
+            # usual case: the ancestors dofs come before the joint ones
+            child_dofs = hstack((dofs, joint_dofs))
+            child_jac = hstack((dot(Ad_cp, J_pg), X))
+            child_djac = hstack((dot(dAd_cp, J_pg) + dot(Ad_cp, dJ_pg), dX))
+        else:
+            # the given jacobian already had non-zero joint columns
+            child_dofs = union1d(dofs, joint_dofs)
+            cols = searchsorted(child_dofs, dofs)
+            joint_cols = searchsorted(child_dofs, joint_dofs)
+            child_jac = zeros((6, len(child_dofs)))
+            child_jac[:, cols] = dot(Ad_cp, J_pg)
+            child_jac[:, joint_cols] += X
+            child_djac = zeros((6, len(child_dofs)))
+            child_djac[:, cols] = dot(dAd_cp, J_pg) + dot(Ad_cp, dJ_pg)
+            child_djac[:, joint_cols] += dX
+        child = j._frame1.body
+        child._set_dynamic(child_pose, child_jac, child_djac, child_twist,
+                           child_dofs, self._ndof)
+        child._pose_generation = self._dynamic_generation
+        child._dynamic_generation = self._dynamic_generation
+        return (Ad_cp, dAd_cp, X, dX)
+
+
+def _same_block(a, a0):
+    """Return whether the ``a`` array (or None) equals the ``a0`` copy."""
+    if a is None or a0 is None:
+        return a is a0
+    a = numpy.asarray(a)
+    return a.shape == a0.shape and (a == a0).all()
+
+
+def _link_constants(joint):
+    r"""Return the constant transforms of the link of ``joint``.
+
+    Using the notations of :meth:`Body.update_dynamic`, these are
+    `H_{pr}`, `H_{nc}`, `\Ad[c]_n` and `\Ad[r]_p`. They only 
+    depend on the poses of the joint frames relative to their bodies.
+    """
+    H_pr = joint._frame0.bpose
+    H_nc = Hg.inv(joint._frame1.bpose)
+    return (H_pr, H_nc, Hg.iadjoint(H_nc), Hg.iadjoint(H_pr))
 
 
 class Observer(object):
@@ -1269,6 +2359,31 @@ class Observer(object):
         pass
 
 
+def _step(world, dt, observers, interval=None):
+    """Run one time step of the simulation.
+
+    The observers are updated with ``interval``, which defaults to ``dt``.
+    """
+    if interval is None:
+        interval = dt
+    profiler = world.profiler
+    if profiler is not None:
+        start = _time()
+    world.update_dynamic()
+    world.update_controllers(dt)
+    world.update_constraints(dt)
+    for obs in observers:
+        if profiler is None:
+            obs.update(interval)
+        else:
+            start_obs = _time()
+            obs.update(interval)
+            profiler.record('observers', _time() - start_obs, obs)
+    world.integrate(dt)
+    if profiler is not None:
+        profiler.record('step', _time() - start)
+
+
 def simulate(world, timeline, observers=()):
     """Run a full simulation, 
 
@@ -1277,6 +2392,10 @@ def simulate(world, timeline, observers=()):
     :param time: a list of distinct times
     :type time: iterable
 
+    The observers :meth:`~Observer.finish` methods are called even if 
+    the simulation raises an exception, so that they release their 
+    resources (such as threads or files).
+
     Example:
 
     >>> w = simplearm()
@@ -1291,13 +2410,208 @@ def simulate(world, timeline, observers=()):
     world.init()
     for obs in observers:
         obs.init(world, timeline)
-    for next_time in timeline[1:]:
-        dt = next_time - world._current_time
-        world.update_dynamic()
-        world.update_controllers(dt)
-        world.update_constraints(dt)
+    try:
+        for next_time in timeline[1:]:
+            _step(world, next_time - world._current_time, observers)
+    finally:
         for obs in observers:
-            obs.update(dt)
-        world.integrate(dt)
+            obs.finish()
+
+
+def _save_state(world):
+    """Return a copy of the world state, see :func:`_restore_state`.
+
+    Besides the joints positions and velocities, the state includes what
+    carries over to the next time step: the constraints forces (the 
+    initial guess of the Gauss-Seidel solver), the contacts created by 
+    the broad phases and the rest counters of the constraints islands.
+    """
+    return (world._current_time, [j.gpos.copy() for j in world._joints],
+            world._gvel.copy(), [c._force.copy() for c in world._constraints],
+            [bp._save_state() for bp in world._broad_phases],
+            dict(world._island_rest), world._sleeping_dofs.copy())
+
+
+def _restore_state(world, state):
+    """Restore the world state, as saved by :func:`_save_state`.
+
+    The arrays are restored in place, because the joints generalized
+    velocities are views of the world one.
+    """
+    (world._current_time, gpos, world._gvel[:], forces, broad_phases,
+     island_rest, sleeping_dofs) = state
+    for (j, q) in zip(world._joints, gpos):
+        j.gpos[...] = q
+    for (c, f) in zip(world._constraints, forces):
+        c._force[:] = f
+    for (bp, s) in zip(world._broad_phases, broad_phases):
+        bp._restore_state(s)
+    world._island_rest = dict(island_rest)
+    world._sleeping_dofs = sleeping_dofs.copy()
+    world.invalidate_frames()
+
+
+def simulate_adaptive(world, timeline, observers=(), tolerance=1e-3,
+                      min_dt=1e-6, max_dt=None, safety=0.9):
+    r"""Run a full simulation, with adaptive time steps.
+
+    :param world: the world to be simulated
+    :type world: :class:`arboris.core.World`
+    :param timeline: the output times, at which the observers are updated
+    :type timeline: iterable
+    :param observers: the observers, as for :func:`simulate`
+    :param tolerance: the maximal local error of a time step
+    :param min_dt: the minimal time step
+    :param max_dt: the maximal time step, defaults to the largest
+        interval of the timeline
+    :param safety: the safety factor of the step size controller
+    :return: the numbers of accepted and rejected time steps
+
+    The world is integrated with as many time steps as needed between 
+    two consecutive output times. The local error of a step is estimated
+    by the difference between the integrated position and the one of
+    the trapezoidal rule, which is (for each dof)
+
+    .. math::
+        e = \frac{dt}{2} \left|\GVel(t+dt) - \GVel(t)\right|
+
+    If its maximum exceeds ``tolerance``, the step is rejected and done
+    again with a smaller time step. Otherwise, the next time step is
+    grown or shrunk to reach the tolerance, within the bounds. Hence, the
+    steps are short around the impacts, and long during the free flight
+    or the quasi-static phases.
+
+    The steps are run as in :func:`simulate` (and timed by the profiler,
+    if any), but the observers are only updated at the first step after 
+    each output time (but the last, as with :func:`simulate`), with the 
+    interval to the next output time (and finished even if the 
+    simulation raises an exception). The rejected steps are undone (see
+    :func:`_save_state`), so that the accepted ones match a fixed-step
+    simulation over the same times. The controllers should not rely on
+    being updated at regular intervals, and should not keep any state.
+
+    **Example:**
+
+    >>> w = simplearm()
+    >>> (accepted, rejected) = simulate_adaptive(w, [0., 0.05, 0.1])
+    >>> print w.current_time
+    0.1
+
+    """
+    timeline = numpy.asarray(timeline, dtype=float)
+    if max_dt is None:
+        max_dt = numpy.diff(timeline).max()
+    world._current_time = timeline[0]
+    world.init()
     for obs in observers:
-        obs.finish()
+        obs.init(world, timeline)
+    dt = max_dt
+    (accepted, rejected) = (0, 0)
+    try:
+        for next_time in timeline[1:]:
+            interval = next_time - world._current_time
+            observed = False
+            while next_time - world._current_time > \
+                    1e-12*max(1., abs(next_time)):
+                h = min(dt, next_time - world._current_time)
+                state = _save_state(world)
+                _step(world, h, () if observed else observers, interval)
+                observed = True
+                error = 0.5 * h * numpy.abs(world._gvel - state[2]).max() \
+                        if world._ndof else 0.
+                if error > tolerance and h > min_dt:
+                    rejected += 1
+                    _restore_state(world, state)
+                    dt = max(min_dt, 
+                             h*max(0.2, safety*(tolerance/error)**0.5))
+                    continue
+                accepted += 1
+                if error == 0.:
+                    proposed = 5.*h
+                else:
+                    proposed = h*min(5., 
+                                     max(0.2, safety*(tolerance/error)**0.5))
+                if h < dt:
+                    # the step was shortened to reach the output time
+                    proposed = max(proposed, dt)
+                dt = min(max_dt, max(min_dt, proposed))
+            world._current_time = next_time
+    finally:
+        for obs in observers:
+            obs.finish()
+    return (accepted, rejected)
+
+
+Snapshot = namedtuple('Snapshot', 'time gpos gvel poses forces')
+"""The state of a world, as yielded by :func:`itersimulate`.
+
+- ``time``: the world current time,
+- ``gpos``: a tuple of the joints generalized positions, in 
+  depth-first order (that of :meth:`World.iterjoints`),
+- ``gvel``: the world generalized velocity,
+- ``poses``: a tuple of the bodies poses, in depth-first order, without
+  the ground (or None),
+- ``forces``: a dictionnary mapping each active constraint to its
+  force (or None).
+
+The arrays are read-only copies.
+"""
+
+
+def _frozen(a):
+    a = array(a)
+    a.flags.writeable = False
+    return a
+
+
+def itersimulate(world, timeline, observers=(), poses=False, forces=False):
+    """Run a simulation step by step, yielding the state after each step.
+
+    :param world: the world to be simulated
+    :type world: :class:`arboris.core.World`
+    :param timeline: a list of distinct times
+    :type timeline: iterable
+    :param observers: the observers, as for :func:`simulate`
+    :param poses: whether the snapshots include the bodies poses
+    :param forces: whether the snapshots include the constraints forces
+    :return: an iterator over :data:`Snapshot` instances
+
+    The simulation advances by one time step each time a snapshot is 
+    requested, so that the caller can inspect the state, change the 
+    world controllers (their gains or set points for instance) before 
+    the next step, or stop the simulation early (the observers
+    :meth:`~Observer.finish` methods are then called when the iterator
+    is closed or garbage collected).
+
+    **Example:**
+
+    >>> w = simplearm()
+    >>> for state in itersimulate(w, numpy.arange(0., 0.01, 0.001)):
+    ...     if state.time >= 0.005:
+    ...         break
+    >>> print state.time, w.current_time
+    0.005 0.005
+    >>> state.gvel[0] = 1.
+    Traceback (most recent call last):
+        ...
+    ValueError: assignment destination is read-only
+
+    """
+    world._current_time = timeline[0]
+    world.init()
+    for obs in observers:
+        obs.init(world, timeline)
+    try:
+        for next_time in timeline[1:]:
+            _step(world, next_time - world._current_time, observers)
+            yield Snapshot(
+                world._current_time,
+                tuple(_frozen(j.gpos) for j in world._joints),
+                _frozen(world._gvel),
+                tuple(_frozen(b.pose) for b in world._bodies[1:]) 
+                    if poses else None,
+                dict((c, _frozen(c._force)) 
+                     for c in world._active_constraints) if forces else None)
+    finally:
+        for obs in observers:
+            obs.finish()
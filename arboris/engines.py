@@ -0,0 +1,498 @@
+# coding=utf-8
+r"""Engines, which solve the world dynamical model.
+
+The default engine (:class:`arboris.core.DenseEngine`) builds the dense
+world model matrices and inverts the impedance, which costs `O(n^3)`
+at each time step. The engines of this module exploit the kinematic tree
+structure instead, or reuse the inverse over several time steps.
+
+"""
+__author__ = ("Sébastien BARTHÉLEMY <barthelemy@crans.org>")
+
+from numpy import zeros, dot, hstack, vstack
+from numpy.linalg import inv, norm
+from core import Engine, DenseEngine
+
+
+def _mass_dot(world, gvel):
+    r"""Return `M \GVel`, computed recursively.
+
+    The bodies twists are computed from the root to the leaves, then
+    the bodies momentums are accumulated from the leaves to the root,
+    using the links models computed by 
+    :meth:`arboris.core.World.update_dynamic`.
+    """
+    (bodies, parents) = (world._bodies, world._parents)
+    dynamics = world._link_dynamics
+    dofs = [j.dof for j in world._joints]
+    T = zeros((len(bodies), 6))
+    for (k, p) in enumerate(parents):
+        (Ad, dAd, X, dX) = dynamics[k]
+        T[k+1] = dot(Ad, T[p]) + dot(X, gvel[dofs[k]])
+    F = zeros((len(bodies), 6))
+    mgvel = zeros(gvel.shape)
+    for k in reversed(range(len(dofs))):
+        (c, p) = (k+1, parents[k])
+        (Ad, dAd, X, dX) = dynamics[k]
+        F[c] += dot(bodies[c].mass, T[c])
+        mgvel[dofs[k]] = dot(X.T, F[c])
+        F[p] += dot(Ad.T, F[c])
+    return mgvel
+
+
+class ArticulatedBodyEngine(Engine):
+    r"""A recursive engine, based on the articulated-body algorithm.
+
+    This engine computes `\GVel(t+dt) = Y(t) \GForce` in linear time
+    with respect to the number of bodies, without building nor
+    inverting the world impedance matrix. This is Featherstone's
+    articulated-body algorithm, extended to the arboris first order model.
+
+    **Algorithm:**
+
+    Let's use the notations of :meth:`arboris.core.Body.update_dynamic`
+    and denote `a_c = \dJ[c]_{c/g} \; \GVel` for any generalized
+    velocity `\GVel`. The child body twist and `a_c` are computed from
+    the parent ones by the linear recursion
+
+    .. math::
+        s_c =
+        \begin{bmatrix} \twist[c]_{c/g} \\ a_c \end{bmatrix}
+        &=
+        \begin{bmatrix} \Ad[c]_p & 0 \\ \dAd[c]_p & \Ad[c]_p \end{bmatrix}
+        s_p +
+        \begin{bmatrix}
+            \Ad[c]_n \; \J[n]_{n/r} \\ \Ad[c]_n \; \dJ[n]_{n/r}
+        \end{bmatrix} \GVel_j \\
+        &= A_c \; s_p + S_c \; \GVel_j
+
+    and the world impedance is
+
+    .. math::
+        Z &= \sum_b \J[b]_{b/g}^T \; W_b \;
+            \begin{bmatrix} \J[b]_{b/g} \\ \dJ[b]_{b/g} \end{bmatrix}
+            - \sum_a Z_a
+        \text{ with }
+        W_b = \begin{bmatrix} \frac{M_b}{dt} + N_b + B_b & M_b \end{bmatrix}
+
+    Solving `Z \; \GVel = \GForce` is then done by gaussian elimination
+    along the tree, from the leaves to the root (computing the
+    articulated inertias `I^A_b`, which are `6 \times 12` matrices) then
+    from the root to the leaves (computing `\GVel_j`).
+
+    The inertias only depend on the model, they are computed once per
+    time step by :meth:`update_admittance`, the remaining passes cost
+    `O(n)` per right hand side.
+
+    The controllers impedances can be taken into account by the
+    algorithm as long as they do not couple distinct joints. Otherwise,
+    the engine falls back to the dense model.
+
+    **Example:**
+
+    >>> from arboris.robots.simplearm import add_simplearm
+    >>> from arboris.core import World, simulate
+    >>> w = World(engine=ArticulatedBodyEngine())
+    >>> add_simplearm(w)
+    >>> simulate(w, [0., 0.001, 0.002])
+
+    """
+    def init(self, world):
+        self._world = world
+        # the child body of the k-th joint is the (k+1)-th body, the
+        # ground being the 0-th one (see World._compile_topology)
+        self._joints = world._joints
+        self._bodies = world._bodies
+        self._parents = tuple(world._parents)
+        self._dofs = tuple(j.dof for j in self._joints)
+        njoints = len(self._joints)
+        self._Ad = [None] * njoints
+        self._dAd = [None] * njoints
+        self._X = [None] * njoints
+        self._dX = [None] * njoints
+        self._U = [None] * njoints
+        self._L = [None] * njoints
+        self._iD = [None] * njoints
+        self._dense_admittance = None
+
+    def update_dynamic(self):
+        """Get the joints contributions to the recursion.
+
+        They are computed by :meth:`arboris.core.World.update_dynamic`.
+        """
+        for (k, d) in enumerate(self._world._link_dynamics):
+            (self._Ad[k], self._dAd[k], self._X[k], self._dX[k]) = d
+
+    def _is_joint_diagonal(self, impedance):
+        """Check the controllers impedance does not couple distinct joints.
+        """
+        coupling = impedance.copy()
+        for dof in self._dofs:
+            coupling[dof, dof] = 0.
+        return not coupling.any()
+
+    def update_admittance(self, dt):
+        r"""Compute the articulated inertias (from the leaves to the root).
+        """
+        Z_c = self._world._controller_impedance
+        if not self._is_joint_diagonal(Z_c):
+            w = self._world
+            self._dense_admittance = inv(
+                w.mass/dt + w.viscosity + w.nleffects - Z_c)
+            return
+        self._dense_admittance = None
+        IA = [None]
+        for b in self._bodies[1:]:
+            IA.append(hstack((b.mass/dt + b.nleffects + b.viscosity, b.mass)))
+        for k in reversed(range(len(self._joints))):
+            (c, p, dof) = (k+1, self._parents[k], self._dofs[k])
+            (Ad, dAd, X) = (self._Ad[k], self._dAd[k], self._X[k])
+            S = vstack((X, self._dX[k]))
+            U = dot(IA[c], S)
+            L = dot(X.T, IA[c])
+            iD = inv(dot(X.T, U) - Z_c[dof, dof])
+            (self._U[k], self._L[k], self._iD[k]) = (U, L, iD)
+            if p != 0:
+                Ia = IA[c] - dot(U, dot(iD, L))
+                IA[p] += dot(Ad.T, hstack((
+                    dot(Ia[:,0:6], Ad) + dot(Ia[:,6:12], dAd),
+                    dot(Ia[:,6:12], Ad))))
+
+    def mass_dot(self, gvel):
+        r"""Return `M \GVel`, computed recursively (see :func:`_mass_dot`).
+        """
+        return _mass_dot(self._world, gvel)
+
+    def admittance_dot(self, gforce):
+        r"""Return `Y \GForce`, computed recursively.
+        """
+        if self._dense_admittance is not None:
+            return dot(self._dense_admittance, gforce)
+        shape = gforce.shape
+        gforce = gforce.reshape((shape[0], -1))
+        n = gforce.shape[1]
+        nbodies = len(self._bodies)
+        njoints = len(self._joints)
+        # from the leaves to the root: articulated bias forces
+        pA = zeros((nbodies, 6, n))
+        u = [None] * njoints
+        for k in reversed(range(njoints)):
+            (c, p) = (k+1, self._parents[k])
+            u[k] = gforce[self._dofs[k]] - dot(self._X[k].T, pA[c])
+            if p != 0:
+                pA[p] += dot(self._Ad[k].T,
+                             pA[c] + dot(self._U[k], dot(self._iD[k], u[k])))
+        # from the root to the leaves: generalized velocities
+        gvel = zeros((shape[0], n))
+        T = zeros((nbodies, 6, n))
+        A = zeros((nbodies, 6, n))
+        for (k, p) in enumerate(self._parents):
+            c = k+1
+            Ad = self._Ad[k]
+            Ts = dot(Ad, T[p])
+            As = dot(self._dAd[k], T[p]) + dot(Ad, A[p])
+            L = self._L[k]
+            v = dot(self._iD[k],
+                    u[k] - dot(L[:,0:6], Ts) - dot(L[:,6:12], As))
+            gvel[self._dofs[k]] = v
+            T[c] = Ts + dot(self._X[k], v)
+            A[c] = As + dot(self._dX[k], v)
+        return gvel.reshape(shape)
+
+
+class TreeFactorizationEngine(Engine):
+    r"""An engine which factorizes the impedance along the kinematic tree.
+
+    The world impedance `Z` has the sparsity induced by the kinematic 
+    tree branches: `Z_{ij}` is zero unless the joint of the dof `i` is 
+    an ancestor of the joint of the dof `j` or the reverse. 
+
+    This engine eliminates the joints from the leaves to the root,
+    which causes no fill-in (this is Featherstone's sparse
+    `L^T D L` factorization, without the symmetry requirement and with
+    one block per joint). The admittance is then applied by
+    substitution, using the factors, instead of being computed 
+    explicitly.
+
+    Eliminating a joint costs `O(d^2)` where `d` is the number of dofs 
+    of its ancestors. The cost of a time step thus depends on the trees 
+    depths rather than on the total number of dofs. 
+
+    The world dense model is not built: the blocks of the impedance which
+    link each joint to its ancestors are computed from the links models
+    (see :meth:`arboris.core.World.update_dynamic`), as in the 
+    composite-rigid-body algorithm. Using the notations of
+    :class:`ArticulatedBodyEngine`, the composite inertia of the subtree
+    of the body `c`
+
+    .. math::
+        K_c = W_c + \sum_{c' \text{ child of } c} 
+            {\Ad[c']_c}^T K_{c'} A_{c'}
+
+    gives the blocks of the joint `j` (whose child body is `c`) and of 
+    each of its ancestors `i`
+
+    .. math::
+        Z_{ij} &= \left(\Ad[c]_{c_i} \; X_i\right)^T K_c \; S_c \\
+        Z_{ji} &= X_j^T \; K_c \; A_{c \leftarrow c_i} \; S_{c_i}
+
+    where `A_{c \leftarrow c_i}` is the product of the `A` matrices
+    along the path from the child body `c_i` of `i` to `c`.
+
+    If a controller impedance does not respect the branch-induced
+    sparsity, the engine falls back to the explicit inverse of the
+    dense model.
+
+    **Example:**
+
+    >>> from arboris.robots.simplearm import add_simplearm
+    >>> from arboris.core import World, simulate
+    >>> w = World(engine=TreeFactorizationEngine())
+    >>> add_simplearm(w)
+    >>> simulate(w, [0., 0.001, 0.002])
+
+    """
+    def init(self, world):
+        self._world = world
+        joints = world._joints
+        self._dofs = tuple(j.dof for j in joints)
+        # dofs of the ancestor joints of each joint, the parent of a 
+        # joint comes before it
+        self._ancestors = []
+        for p in world._parents:
+            if p == 0:
+                self._ancestors.append(zeros(0, dtype=int))
+            else:
+                self._ancestors.append(hstack((self._ancestors[p-1],
+                                               world._joint_dofs[p-1])))
+        # the dofs of a joint and of its ancestors
+        self._chains = [hstack((a, d)) 
+                        for (a, d) in zip(self._ancestors, world._joint_dofs)]
+        # the ancestor joints, from the parent to the root
+        self._paths = []
+        for p in world._parents:
+            if p == 0:
+                self._paths.append(())
+            else:
+                self._paths.append((p-1,) + self._paths[p-1])
+        # mask of the entries which are structurally zero 
+        self._unrelated = zeros((world.ndof, world.ndof), dtype=bool)
+        self._unrelated[:] = True
+        for (dof, a) in zip(self._dofs, self._ancestors):
+            self._unrelated[dof, dof] = False
+            self._unrelated[dof, a] = False
+            self._unrelated[a, dof] = False
+        njoints = len(joints)
+        self._iD = [None] * njoints
+        self._C = [None] * njoints
+        self._R = [None] * njoints
+        self._dense_admittance = None
+        # the controllers impedance blocks which were checked
+        self._checked_blocks = None
+
+    def update_dynamic(self):
+        """Nothing to do, the links models are computed by
+        :meth:`arboris.core.World.update_dynamic`.
+        """
+        pass
+
+    def _check_controller_impedance(self):
+        """Check whether the controllers impedance is zero, and whether
+        it has the branch-induced sparsity.
+
+        This is only done when the world assembled a new impedance (see
+        :meth:`arboris.core.World._assemble_controller_impedance`).
+        """
+        w = self._world
+        if w._impedance_blocks is not self._checked_blocks:
+            self._checked_blocks = w._impedance_blocks
+            Z_c = w._controller_impedance
+            self._controllers_are_sparse = not Z_c[self._unrelated].any()
+            self._controllers_are_zero = not Z_c.any()
+
+    def update_admittance(self, dt):
+        """Factorize the impedance, from the leaves to the root.
+        """
+        w = self._world
+        Z_c = w._controller_impedance
+        self._check_controller_impedance()
+        if not self._controllers_are_sparse:
+            self._dense_admittance = inv(
+                w.mass/dt + w.viscosity + w.nleffects - Z_c)
+            return
+        self._dense_admittance = None
+        (bodies, parents) = (w._bodies, w._parents)
+        dynamics = w._link_dynamics
+        # the composite inertias K = hstack(K0, K1)
+        (K0, K1) = ([None], [None])
+        for b in bodies[1:]:
+            K0.append(b.mass/dt + b.nleffects + b.viscosity)
+            K1.append(b.mass.copy())
+        # the updates of the ancestors blocks, by the eliminations
+        schur = [None] * len(self._dofs)
+        for k in reversed(range(len(self._dofs))):
+            (c, p) = (k+1, parents[k])
+            (Ad, dAd, X, dX) = dynamics[k]
+            (dof, a) = (self._dofs[k], self._ancestors[k])
+            (na, nd) = (len(a), X.shape[1])
+            # the blocks Z[dof, chain] and Z[a, dof]
+            F = dot(K0[c], X) + dot(K1[c], dX)
+            (G0, G1) = (dot(X.T, K0[c]), dot(X.T, K1[c]))
+            row = zeros((nd, na + nd))
+            col = zeros((na, nd))
+            row[:,na:] = dot(X.T, F)
+            node = k
+            for i in self._paths[k]:
+                (Ad_n, dAd_n) = dynamics[node][0:2]
+                F = dot(Ad_n.T, F)
+                (G0, G1) = (dot(G0, Ad_n) + dot(G1, dAd_n), dot(G1, Ad_n))
+                (X_i, dX_i) = dynamics[i][2:4]
+                cols = slice(len(self._ancestors[i]), len(self._chains[i]))
+                col[cols] = dot(X_i.T, F)
+                row[:,cols] = dot(G0, X_i) + dot(G1, dX_i)
+                node = i
+            if not self._controllers_are_zero:
+                row -= Z_c[dof][:,self._chains[k]]
+                col -= Z_c[a,dof]
+            if schur[k] is not None:
+                row += schur[k][na:]
+                col += schur[k][0:na,na:]
+            iD = inv(row[:,na:])
+            self._iD[k] = iD
+            if na:
+                R = row[:,0:na]
+                C = dot(col, iD)
+                (self._R[k], self._C[k]) = (R, C)
+                update = -dot(C, R)
+                if schur[k] is not None:
+                    update += schur[k][0:na,0:na]
+                if schur[p-1] is None:
+                    schur[p-1] = update
+                else:
+                    schur[p-1] += update
+                K0[p] += dot(Ad.T, dot(K0[c], Ad) + dot(K1[c], dAd))
+                K1[p] += dot(Ad.T, dot(K1[c], Ad))
+
+    def mass_dot(self, gvel):
+        r"""Return `M \GVel`, computed recursively (see :func:`_mass_dot`).
+        """
+        return _mass_dot(self._world, gvel)
+
+    def admittance_dot(self, gforce):
+        r"""Return `Y \GForce`, by forward and back substitution.
+        """
+        if self._dense_admittance is not None:
+            return dot(self._dense_admittance, gforce)
+        y = gforce.copy()
+        njoints = len(self._dofs)
+        for k in reversed(range(njoints)):
+            if self._C[k] is not None:
+                y[self._ancestors[k]] -= dot(self._C[k], y[self._dofs[k]])
+        gvel = zeros(gforce.shape)
+        for k in range(njoints):
+            (dof, a) = (self._dofs[k], self._ancestors[k])
+            if self._R[k] is None:
+                gvel[dof] = dot(self._iD[k], y[dof])
+            else:
+                gvel[dof] = dot(self._iD[k], y[dof] - dot(self._R[k], gvel[a]))
+        return gvel
+
+
+class ReusedAdmittanceEngine(DenseEngine):
+    r"""A dense engine which reuses the admittance while it is accurate.
+
+    In quasi-static phases, the world impedance `Z` barely changes 
+    between consecutive time steps, so that inverting it at each step 
+    is wasted. This engine keeps the admittance `Y_0 = Z_0^{-1}` of a 
+    previous impedance `Z_0` and only inverts the impedance again after
+    ``period`` steps, or when its relative change
+
+    .. math::
+        \epsilon = \frac{\| Z - Z_0 \|}{\| Z_0 \|}
+
+    (using the Frobenius norm) exceeds ``tolerance``. In between, the 
+    admittance is applied with ``iterations`` steps of iterative 
+    refinement
+
+    .. math::
+        \GVel_{k+1} = \GVel_k + Y_0 \left(\GForce - Z \; \GVel_k\right)
+
+    starting from `\GVel_0 = Y_0 \GForce`. Each step costs two 
+    matrix-vector products (instead of an inversion) and divides the 
+    error by roughly `1/\|I - Y_0 Z\|`. If the residual still exceeds
+    ``tolerance``, the impedance is inverted at the next step.
+
+    Without refinement, the solution is that of the impedance `Z_0`, 
+    whose error accumulates over the steps: this is only suitable for
+    slow motions.
+
+    :param period: the maximal number of steps between two inversions
+    :param tolerance: the relative change of the impedance which 
+        triggers an inversion
+    :param iterations: the number of refinement steps
+
+    The accuracy is reported by the :attr:`impedance_change` (`\epsilon`
+    at the last step) and :attr:`residual` (the relative residual
+    `\|\GForce - Z \; \GVel_k\| / \|\GForce\|` before the last 
+    refinement step, hence an upper estimate of the error) attributes, 
+    while :attr:`inversions` counts the inversions.
+
+    **Example:**
+
+    >>> from arboris.robots.simplearm import add_simplearm
+    >>> from arboris.core import World, simulate
+    >>> engine = ReusedAdmittanceEngine(period=5, tolerance=0.01)
+    >>> w = World(engine=engine)
+    >>> add_simplearm(w)
+    >>> simulate(w, [0., 0.001, 0.002, 0.003])
+    >>> engine.inversions
+    1
+
+    """
+    def __init__(self, period=10, tolerance=1e-3, iterations=1):
+        self.period = int(period)
+        self.tolerance = float(tolerance)
+        self.iterations = int(iterations)
+
+    def init(self, world):
+        DenseEngine.init(self, world)
+        self._reference_impedance = None
+        self._age = 0
+        self.inversions = 0
+        self.impedance_change = 0.
+        self.residual = 0.
+
+    def update_admittance(self, dt):
+        w = self._world
+        w._impedance = w.mass/dt + w.viscosity + w.nleffects - \
+                w._controller_impedance
+        Z_0 = self._reference_impedance
+        self._age += 1
+        if Z_0 is not None and self._age < self.period:
+            self.impedance_change = norm(w._impedance - Z_0)/norm(Z_0)
+            if self.impedance_change <= self.tolerance:
+                return
+        self._reference_impedance = w._impedance
+        self._age = 0
+        self.inversions += 1
+        self.impedance_change = 0.
+        self.residual = 0.
+        w._admittance = inv(w._impedance)
+
+    def admittance_dot_dofs(self, gforce, dofs):
+        # the refinement needs the whole admittance
+        return Engine.admittance_dot_dofs(self, gforce, dofs)
+
+    def admittance_dot(self, gforce):
+        w = self._world
+        gvel = dot(w._admittance, gforce)
+        if w._impedance is self._reference_impedance:
+            return gvel
+        for k in range(self.iterations):
+            r = gforce - dot(w._impedance, gvel)
+            self.residual = norm(r)/max(norm(gforce), 1e-300)
+            gvel += dot(w._admittance, r)
+        if self.residual > self.tolerance:
+            # the refinement is not accurate enough (or diverges)
+            self._age = self.period
+        return gvel
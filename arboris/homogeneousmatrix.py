@@ -1,13 +1,59 @@
 # coding=utf-8
-"""Functions for working with homogeneous matrices."""
+"""Functions for working with homogeneous matrices.
+
+Most functions also accept stacks of matrices, as ``(N,4,4)`` arrays,
+and the related stacks of points, twists or jacobians, as ``(N,3)``,
+``(N,6)`` or ``(N,6,n)`` arrays. They then compute on the whole stack at
+once. Likewise, the rotations and translations are stacked when their
+arguments are ``(N,)`` arrays:
+
+>>> H = rotx(numpy.linspace(0., 1., 5))
+>>> H.shape
+(5, 4, 4)
+>>> numpy.allclose(inv(H)[2], inv(H[2]))
+True
+
+"""
 
 __author__ = ("Sébastien BARTHÉLEMY <barthelemy@crans.org>")
 
-from numpy import array, zeros, sin, cos, dot, hstack, vstack
+from numpy import array, zeros, empty, sin, cos, dot, hstack, vstack, \
+    einsum
 import numpy
 
 tol=1e-9
 
+check = True
+"""Whether the functions check that their arguments are homogeneous
+matrices.
+
+The check computes a determinant, which is expensive compared to the
+functions themselves. It can be disabled in production, by setting this
+flag to ``False`` (the checks are also skipped when python runs with
+the ``-O`` option, as they are assertions).
+"""
+
+def _array(rows, *args):
+    """Return ``array(rows)``, or a stack of matrices if the ``args``,
+    from which the ``rows`` entries are computed, are arrays.
+    """
+    for a in args:
+        if numpy.ndim(a):
+            break
+    else:
+        return array(rows)
+    out = empty(numpy.broadcast(*args).shape + (len(rows), len(rows[0])))
+    for (i, row) in enumerate(rows):
+        for (j, entry) in enumerate(row):
+            out[..., i, j] = entry
+    return out
+
+def _stack_dot(A, x):
+    """Multiply each matrix of the ``A`` stack by the matching vector or
+    matrix of the ``x`` stack.
+    """
+    return einsum('bij,bj...->bi...', A, x)
+
 def transl(t_x, t_y, t_z):
     """Homogeneous matrix of a translation.
 
@@ -24,11 +70,12 @@ def transl(t_x, t_y, t_z):
            [ 0.,  0.,  0.,  1.]])
 
     """
-    return array(
+    return _array(
         [[ 1. , 0., 0., t_x],
          [ 0. , 1., 0., t_y],
          [ 0. , 0., 1., t_z],
-         [ 0.,  0., 0., 1.]])
+         [ 0.,  0., 0., 1.]],
+        t_x, t_y, t_z)
 
 
 def rotzyx(angle_z, angle_y, angle_x):
@@ -52,11 +99,12 @@ def rotzyx(angle_z, angle_y, angle_x):
     cy = cos(angle_y)
     sx = sin(angle_x)
     cx = cos(angle_x)
-    return array(
+    return _array(
         [[ cz*cy, cz*sy*sx-sz*cx, cz*sy*cx+sz*sx, 0.],
          [ sz*cy, sz*sy*sx+cz*cx, sz*sy*cx-cz*sx, 0.],
          [-sy   , cy*sx         , cy*cx         , 0.],
-         [ 0.   , 0.            , 0.            , 1.]])
+         [ 0.   , 0.            , 0.            , 1.]],
+        angle_z, angle_y, angle_x)
          
          
 def rotzy(angle_z, angle_y):
@@ -77,11 +125,12 @@ def rotzy(angle_z, angle_y):
     cz = cos(angle_z)
     sy = sin(angle_y)
     cy = cos(angle_y)
-    return array(
+    return _array(
         [[ cz*cy,-sz, cz*sy, 0.],
          [ sz*cy, cz, sz*sy, 0.],
          [-sy   , 0., cy   , 0.],
-         [ 0.   , 0., 0.   , 1.]])
+         [ 0.   , 0., 0.   , 1.]],
+        angle_z, angle_y)
 
 
 def rotzx(angle_z, angle_x):
@@ -102,11 +151,12 @@ def rotzx(angle_z, angle_x):
     cz = cos(angle_z)
     sx = sin(angle_x)
     cx = cos(angle_x)
-    return array(
+    return _array(
         [[ cz,-sz*cx, sz*sx, 0.],
          [ sz, cz*cx,-cz*sx, 0.],
          [ 0., sx   , cx   , 0.],
-         [ 0., 0.   , 0.   , 1.]])
+         [ 0., 0.   , 0.   , 1.]],
+        angle_z, angle_x)
          
          
 def rotyx(angle_y, angle_x):
@@ -127,11 +177,12 @@ def rotyx(angle_y, angle_x):
     cy = cos(angle_y)
     sx = sin(angle_x)
     cx = cos(angle_x)
-    return array(
+    return _array(
         [[ cy, sy*sx, sy*cx, 0.],
          [ 0., cx   ,-sx   , 0.],
          [-sy, cy*sx, cy*cx, 0.],
-         [ 0., 0.   , 0.   , 1.]])
+         [ 0., 0.   , 0.   , 1.]],
+        angle_y, angle_x)
 
 def rotx(angle):
     """
@@ -148,11 +199,12 @@ def rotx(angle):
     """
     ca = cos(angle)
     sa = sin(angle)
-    H = array(
+    H = _array(
         [[1,  0,   0,  0],
          [0, ca, -sa,  0],
          [0, sa,  ca,  0],
-         [0,  0,   0,  1]])
+         [0,  0,   0,  1]],
+        angle)
     return H
 
 def roty(angle):
@@ -170,11 +222,12 @@ def roty(angle):
     """
     ca = cos(angle)
     sa = sin(angle)
-    H = array(
+    H = _array(
         [[ ca,  0,  sa,  0],
          [  0,  1,   0,  0],
          [-sa,  0,  ca,  0],
-         [  0,  0,   0,  1]])
+         [  0,  0,   0,  1]],
+        angle)
     return H
 
 def rotz(angle):
@@ -191,37 +244,48 @@ def rotz(angle):
     """
     ca = cos(angle)
     sa = sin(angle)
-    H = array(
+    H = _array(
         [[ca, -sa, 0, 0],
          [sa,  ca, 0, 0],
          [ 0,   0, 1, 0],
-         [ 0,   0, 0, 1]])
+         [ 0,   0, 0, 1]],
+        angle)
     return H
 
 def ishomogeneousmatrix(H, tol=tol):
     """
-    Return true if input is an homogeneous matrix
+    Return true if input is an homogeneous matrix (or a stack of them)
     """
-    return (H.shape == (4,4)) \
-        and (numpy.abs(numpy.linalg.det(H[0:3,0:3])-1)<=tol) \
-        and (H[3,0:4]==[0,0,0,1]).all()
+    return (H.shape[-2:] == (4,4)) \
+        and (numpy.abs(numpy.linalg.det(H[...,0:3,0:3])-1)<=tol).all() \
+        and (H[...,3,0:4]==[0,0,0,1]).all()
 
 def pdot(H, point):
     """Frame change for a point.
     """
-    assert ishomogeneousmatrix(H)
-    return dot(H[0:3,0:3], point) + H[0:3, 3]
+    assert not check or ishomogeneousmatrix(H)
+    if H.ndim == 2:
+        return dot(H[0:3,0:3], point) + H[0:3, 3]
+    return _stack_dot(H[:,0:3,0:3], point) + H[:,0:3,3]
 
 def vdot(H, vec):
     """Frame change for a vector.
     """
-    assert ishomogeneousmatrix(H)
-    return dot(H[0:3,0:3], vec)
+    assert not check or ishomogeneousmatrix(H)
+    if H.ndim == 2:
+        return dot(H[0:3,0:3], vec)
+    return _stack_dot(H[:,0:3,0:3], vec)
 
-def inv(H):
+def inv(H, out=None):
     """
     Invert an homogeneous matrix.
 
+    :param H: homogeneous matrix
+    :type H: 4x4 ndarray
+    :param out: if given, the result is written in this 4x4 array,
+        which must not be ``H``
+    :return: the inverse matrix
+
     **Example:**
 
     >>> H = array(
@@ -236,17 +300,38 @@ def inv(H):
            [ 0.        ,  0.        ,  0.        ,  1.        ]])
 
     """
-    assert ishomogeneousmatrix(H)
-    R = H[0:3,0:3]
-    p = H[0:3,3:4]
-    return vstack( (hstack((R.T,-dot(R.T,p))), [0,0,0,1]))
-
-def adjoint(H):
+    assert not check or ishomogeneousmatrix(H)
+    if out is None:
+        out = empty(H.shape)
+    R = H[...,0:3,0:3]
+    out[...,0:3,0:3] = R.swapaxes(-1,-2)
+    if H.ndim == 2:
+        out[0:3,3] = dot(H[0:3,3], R)
+    else:
+        out[:,0:3,3] = _stack_dot(out[:,0:3,0:3], H[:,0:3,3])
+    out[...,0:3,3] *= -1.
+    out[...,3,0:3] = 0.
+    out[...,3,3] = 1.
+    return out
+
+def _cross_rows(p, R, out):
+    """Write the rows of `\hat{p} R` in ``out``, for a 3-vector ``p``
+    and an array ``R`` with 3 rows, or for stacks of them.
+    """
+    if p.ndim > 1:
+        p = p.reshape(p.shape + (1,)*(R.ndim-2)).swapaxes(0,1)
+        (R, out) = (R.swapaxes(0,1), out.swapaxes(0,1))
+    out[0] = p[1]*R[2] - p[2]*R[1]
+    out[1] = p[2]*R[0] - p[0]*R[2]
+    out[2] = p[0]*R[1] - p[1]*R[0]
+
+def adjoint(H, out=None):
     """
     Adjoint (6x6 matrix) of the homogeneous matrix.
 
     :param H: homogeneous matrix 
     :type H: 4x4 ndarray
+    :param out: if given, the result is written in this 6x6 array
     :return: adjoint matrix
     :rtype: 6x6 ndarray
 
@@ -272,22 +357,113 @@ def adjoint(H):
              0.35401931]])
 
     """
-    assert ishomogeneousmatrix(H), H
-    R = H[0:3,0:3]
-    p = H[0:3,3:4]
-    pxR = dot(
-        array(
-            [[    0, -p[2],  p[1]],
-             [ p[2],     0, -p[0]],
-             [-p[1],  p[0],     0]]),
-        R)
-    return vstack((
-        hstack((R  , zeros((3,3)))),
-        hstack((pxR, R))))
-
-def iadjoint(H):
-    """
+    assert not check or ishomogeneousmatrix(H), H
+    if out is None:
+        out = empty(H.shape[:-2] + (6,6))
+    R = H[...,0:3,0:3]
+    out[...,0:3,0:3] = R
+    out[...,0:3,3:6] = 0.
+    out[...,3:6,3:6] = R
+    _cross_rows(H[...,0:3,3], R, out[...,3:6,0:3])
+    return out
+
+def iadjoint(H, out=None):
+    r"""
     Return the adjoint (6x6 matrix) of the inverse homogeneous matrix.
+
+    It is computed in closed form, without inverting ``H``:
+
+    .. math::
+        \Ad(H^{-1}) = \begin{bmatrix}
+            R^T & 0 \\ (\hat{p} R)^T & R^T
+        \end{bmatrix}
+
+    >>> H = rotzyx(0.1, 0.2, 0.3)
+    >>> H[0:3,3] = (1., 2., 3.)
+    >>> numpy.allclose(iadjoint(H), adjoint(inv(H)))
+    True
+
+    """
+    assert not check or ishomogeneousmatrix(H), H
+    if out is None:
+        out = empty(H.shape[:-2] + (6,6))
+    Rt = H[...,0:3,0:3].swapaxes(-1,-2)
+    out[...,0:3,0:3] = Rt
+    out[...,0:3,3:6] = 0.
+    out[...,3:6,3:6] = Rt
+    _cross_rows(H[...,0:3,3], H[...,0:3,0:3],
+                out[...,3:6,0:3].swapaxes(-1,-2))
+    return out
+
+def adjoint_dot(H, x, out=None):
+    r"""
+    Return ``dot(adjoint(H), x)`` without building the adjoint matrix.
+
+    :param H: homogeneous matrix
+    :type H: 4x4 ndarray
+    :param x: a twist (6-vector) or a jacobian (6xn array)
+    :param out: if given, the result is written in this array, which
+        must have the shape of ``x`` and must not be ``x``
+
+    With `H = \begin{bmatrix} R & p \\ 0 & 1 \end{bmatrix}` and
+    `x = \begin{bmatrix} \omega \\ v \end{bmatrix}`, the result is
+    `\begin{bmatrix} R \omega \\ p \times (R \omega) + R v \end{bmatrix}`.
+
+    >>> H = rotzyx(0.1, 0.2, 0.3)
+    >>> H[0:3,3] = (1., 2., 3.)
+    >>> J = numpy.arange(12.).reshape((6,2))
+    >>> numpy.allclose(adjoint_dot(H, J), dot(adjoint(H), J))
+    True
+
+    """
+    assert not check or ishomogeneousmatrix(H), H
+    x = numpy.asarray(x)
+    if out is None:
+        out = empty(x.shape)
+    R = H[...,0:3,0:3]
+    if H.ndim == 2:
+        out[0:3] = dot(R, x[0:3])
+        _cross_rows(H[0:3,3], out[0:3], out[3:6])
+        out[3:6] += dot(R, x[3:6])
+    else:
+        out[:,0:3] = _stack_dot(R, x[:,0:3])
+        _cross_rows(H[:,0:3,3], out[:,0:3], out[:,3:6])
+        out[:,3:6] += _stack_dot(R, x[:,3:6])
+    return out
+
+def iadjoint_dot(H, x, out=None):
+    r"""
+    Return ``dot(iadjoint(H), x)`` without building the adjoint matrix.
+
+    :param H: homogeneous matrix
+    :type H: 4x4 ndarray
+    :param x: a twist (6-vector) or a jacobian (6xn array)
+    :param out: if given, the result is written in this array, which
+        must have the shape of ``x`` and must not be ``x``
+
+    With the notations of :func:`adjoint_dot`, the result is
+    `\begin{bmatrix} R^T \omega \\ R^T (v - p \times \omega) \end{bmatrix}`.
+
+    >>> H = rotzyx(0.1, 0.2, 0.3)
+    >>> H[0:3,3] = (1., 2., 3.)
+    >>> t = numpy.array([1., 2., 3., 4., 5., 6.])
+    >>> numpy.allclose(iadjoint_dot(H, t), dot(iadjoint(H), t))
+    True
+
     """
-    return adjoint(inv(H))
+    assert not check or ishomogeneousmatrix(H), H
+    x = numpy.asarray(x)
+    if out is None:
+        out = empty(x.shape)
+    if H.ndim == 2:
+        R = H[0:3,0:3]
+        _cross_rows(H[0:3,3], x[0:3], out[0:3])
+        out[3:6] = dot(R.T, x[3:6] - out[0:3])
+        out[0:3] = dot(R.T, x[0:3])
+    else:
+        Rt = H[:,0:3,0:3].swapaxes(1,2)
+        _cross_rows(H[:,0:3,3], x[:,0:3], out[:,0:3])
+        out[:,3:6] = _stack_dot(Rt, x[:,3:6] - out[:,0:3])
+        out[:,0:3] = _stack_dot(Rt, x[:,0:3])
+    return out
 
@@ -0,0 +1,147 @@
+# coding=utf-8
+r"""Integrators, which advance the world state in time.
+
+The default integrator (:class:`arboris.core.EulerIntegrator`) is a first
+order scheme: its error, which shows as an energy drift (see the
+``examples/energy_drift.py`` script), is only reduced by shrinking the
+time step. The higher order integrators of this module reach the same
+accuracy with larger time steps, hence with fewer steps.
+
+An integrator is chosen when creating the world::
+
+    world = World(integrator=RungeKuttaIntegrator('rk4'))
+
+"""
+__author__ = ("Sébastien BARTHÉLEMY <barthelemy@crans.org>")
+
+from numpy import dot
+from numpy.linalg import solve
+from core import Integrator
+
+
+class RungeKuttaIntegrator(Integrator):
+    r"""An explicit Runge-Kutta integrator, for constraint-free worlds.
+
+    The integrated model is the continuous one
+
+    .. math::
+        M(\GPos) \dGVel + \left(N(\GPos, \GVel) + B(\GPos)\right) \GVel
+        &= \GForce_0 + Z_c \GVel
+
+    where `\GForce_0` and `Z_c` are the sum of the controllers forces and
+    impedances, for a zero time step (see 
+    :meth:`arboris.core.Controller.update`): the impedances of the 
+    implicit scheme of the default integrator hold terms proportional 
+    to the time step, such as the `-dt K_p` term of the
+    :class:`~arboris.controllers.ProportionalDerivativeController`,
+    which would make the scheme first order. The world model and the
+    controllers are updated at each stage of the scheme, which costs 
+    about as much as a time step of the default integrator (the 
+    admittance is not needed, see :attr:`needs_admittance`), but the
+    error decreases as `dt^p` instead of `dt`, where `p` is the order
+    of the method.
+
+    The generalized positions of the stages are computed by the joints
+    :meth:`~arboris.core.Joint.integrate` method, which is exact on the
+    joints linear configuration spaces and uses the exponential map for
+    the :class:`~arboris.joints.FreeJoint`. In the latter case, the order
+    is at most 2, as the stages velocities are combined in the joint
+    frame without the `\text{dexp}^{-1}` correction.
+
+    The constraints cannot be taken into account, as their forces are
+    computed for the first order model of the default integrator.
+    Moreover, the controllers are updated several times per time step,
+    they should not rely on being updated once per step.
+
+    :param method: one of the keys of :attr:`methods`
+
+    **Example:**
+
+    >>> from arboris.core import World, simulate
+    >>> from arboris.robots.simplearm import add_simplearm
+    >>> from arboris.controllers import WeightController
+    >>> w = World(integrator=RungeKuttaIntegrator('rk4'))
+    >>> add_simplearm(w)
+    >>> w.register(WeightController())
+    >>> simulate(w, [0., 0.01, 0.02])
+
+    """
+    methods = {
+        'midpoint': (((),
+                      (0.5,)),
+                     (0., 1.),
+                     (0., 0.5)),
+        'heun': (((),
+                  (1.,)),
+                 (0.5, 0.5),
+                 (0., 1.)),
+        'rk4': (((),
+                 (0.5,),
+                 (0., 0.5),
+                 (0., 0., 1.)),
+                (1./6., 1./3., 1./3., 1./6.),
+                (0., 0.5, 0.5, 1.))}
+    """The Butcher tableaus `(a, b, c)` of the available methods."""
+
+    needs_admittance = False
+
+    def __init__(self, method='rk4'):
+        if method not in self.methods:
+            raise ValueError('unknown method: {0}'.format(method))
+        self.method = method
+        (self._a, self._b, self._c) = self.methods[method]
+
+    def init(self, world):
+        if world._constraints or world._broad_phases:
+            raise ValueError(
+                'the Runge-Kutta integrators do not support constraints')
+        self._world = world
+
+    def _acceleration(self):
+        r"""Return `\dGVel` from the current world model and forces."""
+        w = self._world
+        return solve(w.mass, w._gforce + dot(
+            w._controller_impedance - w.viscosity - w.nleffects, w._gvel))
+
+    def _set_positions(self, gpos, gvel, dt):
+        """Set the joints positions to ``gpos`` integrated with ``gvel``.
+
+        The joints generalized velocities are views of the world one,
+        which must be kept, hence ``gvel`` is copied into it.
+        """
+        w = self._world
+        w._gvel[:] = gvel
+        for (j, q) in zip(w._joints, gpos):
+            j.gpos[...] = q
+            j.integrate(w._gvel[j.dof], dt)
+
+    def integrate(self, dt):
+        w = self._world
+        t = w._current_time
+        gpos = [j.gpos.copy() for j in w._joints]
+        gvel = w._gvel.copy()
+        # the model of the first stage is up to date, but the 
+        # controllers were updated for the implicit scheme
+        w._sum_controllers(0.)
+        vels = [gvel]
+        accs = [self._acceleration()]
+        for (a, c) in zip(self._a[1:], self._c[1:]):
+            self._set_positions(gpos, _combine(a, vels), dt)
+            w._gvel[:] = gvel + dt * _combine(a, accs)
+            w._current_time = t + c*dt
+            w.update_dynamic()
+            w._sum_controllers(0.)
+            vels.append(w._gvel.copy())
+            accs.append(self._acceleration())
+        self._set_positions(gpos, _combine(self._b, vels), dt)
+        w._gvel[:] = gvel + dt * _combine(self._b, accs)
+        w._current_time = t
+
+
+def _combine(coeffs, vectors):
+    """Return the linear combination of ``vectors``."""
+    result = 0.
+    for (k, v) in zip(coeffs, vectors):
+        if k != 0.:
+            result = result + k*v
+    return result
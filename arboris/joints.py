@@ -7,6 +7,72 @@ from numpy import array, zeros, eye, sin, cos, dot
 import homogeneousmatrix
 from core import Joint, LinearConfigurationSpaceJoint
 
+
+def _readonly(a):
+    a.setflags(write=False)
+    return a
+
+# the constant jacobians of the x, y and z hinges, and their djacobian
+_hinge_jacobians = tuple(_readonly(eye(6)[:, i:i+1]) for i in range(3))
+_hinge_djacobian = _readonly(zeros((6,1)))
+
+
+def _rotation_model(pose, jac, djac, gvel, out=None):
+    r"""Return the model of a joint whose pose is a pure rotation.
+
+    See :attr:`arboris.core.Joint.model`. The inverse pose is the
+    transposed rotation and, denoting `R` the rotation and `\omega` the
+    angular part of the joint twist, the idadjoint is block diagonal:
+
+    .. math::
+        \dAd[n]_r = \begin{bmatrix}
+            R^T \hat{w} & 0 \\ 0 & R^T \hat{w}
+        \end{bmatrix}
+        = \begin{bmatrix}
+            (\hat{u} R)^T & 0 \\ 0 & (\hat{u} R)^T
+        \end{bmatrix}
+        \text{ with } w = -u = -R^T \omega
+
+    If given, ``out`` is the ``(ipose, twist, idadjoint)`` tuple of the
+    arrays in which the results are written (see 
+    :func:`_rotation_model_buffers`).
+    """
+    if out is None:
+        out = _rotation_model_buffers()
+    (ipose, twist, idadjoint) = out
+    R = pose[0:3,0:3]
+    ipose[0:3,0:3] = R.T
+    dot(jac, gvel, out=twist)
+    homogeneousmatrix._cross_rows(dot(twist[0:3], R), R, 
+                                  idadjoint[0:3,0:3].T)
+    idadjoint[3:6,3:6] = idadjoint[0:3,0:3]
+    return (pose, ipose, twist, jac, djac, idadjoint)
+
+
+def _rotation_model_buffers():
+    """Return the arrays in which :func:`_rotation_model` writes.
+
+    Their constant entries (the last row of the inverse pose and the 
+    off-diagonal blocks of the idadjoint) are set once for all.
+    """
+    ipose = zeros((4,4))
+    ipose[3,3] = 1.
+    return (ipose, zeros(6), zeros((6,6)))
+
+
+class _RotationJoint(LinearConfigurationSpaceJoint):
+    """A joint whose pose is a pure rotation."""
+
+    def _compute_model(self):
+        return _rotation_model(self.pose, self.jacobian, self.djacobian,
+                               self.gvel, self._rotation_buffers())
+
+    def _rotation_buffers(self):
+        if self._model_buffers is None:
+            self._model_buffers = _rotation_model_buffers()
+        return self._model_buffers
+
+
 class FreeJoint(Joint):
 
     """Free joint (6-dof)
@@ -45,7 +111,7 @@ class FreeJoint(Joint):
         self.gvel = gvel
         self.gpos = dot(self.gpos, exp( dt*self.gvel))
 
-class RzRyRxJoint(LinearConfigurationSpaceJoint):
+class RzRyRxJoint(_RotationJoint):
     """Ball and socket (3-dof) joint implemented with 3 serial hinges
 
     the resulting homogeneous matrix is given by `H_{01} = Rz Ry Rx`
@@ -93,7 +159,7 @@ class RzRyRxJoint(LinearConfigurationSpaceJoint):
              [ 0.                ,  0.   ,  0. ]])
 
 
-class RzRyJoint(LinearConfigurationSpaceJoint):
+class RzRyJoint(_RotationJoint):
     """Fingered Ball (2-dof) implemented with 2 serial hinges
 
     the resulting homogeneous matrix is given by H = Rz*Ry
@@ -135,7 +201,7 @@ class RzRyJoint(LinearConfigurationSpaceJoint):
              [   0.   , 0.  ]])
              
              
-class RzRxJoint(LinearConfigurationSpaceJoint):
+class RzRxJoint(_RotationJoint):
     """Fingered Ball (2-dof) implemented with 2 serial hinges
 
     the resulting homogeneous matrix is given by H = Rz*Rx
@@ -174,7 +240,7 @@ class RzRxJoint(LinearConfigurationSpaceJoint):
              [   0.   , 0.  ]])
              
              
-class RyRxJoint(LinearConfigurationSpaceJoint):
+class RyRxJoint(_RotationJoint):
     """Fingered Ball (2-dof) implemented with 2 serial hinges
 
     the resulting homogeneous matrix is given by H = Rz*Ry
@@ -213,7 +279,7 @@ class RyRxJoint(LinearConfigurationSpaceJoint):
              [ 0.    , 0. ]])
              
 
-class RzJoint(LinearConfigurationSpaceJoint):
+class RzJoint(_RotationJoint):
     """Hinge (1-dof) with axis in the z-direction
     
     example:
@@ -237,6 +303,11 @@ class RzJoint(LinearConfigurationSpaceJoint):
     def ipose(self):
         return homogeneousmatrix.rotz(-self.gpos[0])
 
+    def _compute_model(self):
+        return _rotation_model(self.pose, _hinge_jacobians[2],
+                               _hinge_djacobian, self.gvel, 
+                               self._rotation_buffers())
+
     @property
     def jacobian(self):
         return array([[0.], [0.], [1.], [0.], [0.], [0.]])
@@ -245,7 +316,7 @@ class RzJoint(LinearConfigurationSpaceJoint):
     def djacobian(self):
         return zeros((6,1))
 
-class RyJoint(LinearConfigurationSpaceJoint):
+class RyJoint(_RotationJoint):
     """Hinge (1-dof) with axis in the y-direction.
     """
     @property
@@ -260,6 +331,11 @@ class RyJoint(LinearConfigurationSpaceJoint):
     def ipose(self):
         return homogeneousmatrix.roty(-self.gpos[0])
 
+    def _compute_model(self):
+        return _rotation_model(self.pose, _hinge_jacobians[1],
+                               _hinge_djacobian, self.gvel, 
+                               self._rotation_buffers())
+
     @property
     def jacobian(self):
         return array([[0.], [1.], [0.], [0.], [0.], [0.]])
@@ -268,7 +344,7 @@ class RyJoint(LinearConfigurationSpaceJoint):
     def djacobian(self):
         return zeros((6,1))
         
-class RxJoint(LinearConfigurationSpaceJoint):
+class RxJoint(_RotationJoint):
     """Hinge (1-dof) with axis in the x-direction
     """
     @property
@@ -283,6 +359,11 @@ class RxJoint(LinearConfigurationSpaceJoint):
     def ipose(self):
         return homogeneousmatrix.rotx(-self.gpos[0])
 
+    def _compute_model(self):
+        return _rotation_model(self.pose, _hinge_jacobians[0],
+                               _hinge_djacobian, self.gvel, 
+                               self._rotation_buffers())
+
     @property
     def jacobian(self):
         return array([[1.], [0.], [0.], [0.], [0.], [0.]])
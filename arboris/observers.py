@@ -5,9 +5,15 @@ __author__ = ("Sébastien BARTHÉLEMY <barthelemy@crans.org>",
               "Joseph SALINI <joseph.salini@gmail.com>")
 import arboris.core
 from abc import ABCMeta, abstractmethod, abstractproperty
-from numpy import dot, array, eye, linalg, vstack, hstack, zeros, diag
+from numpy import dot, array, eye, linalg, vstack, hstack, zeros, diag, \
+    arange
+from math import log10, ceil
 from time import time as _time
+from threading import Thread
+from Queue import Queue
+import sys
 from massmatrix import principalframe
+import homogeneousmatrix as Hg
 import logging
 logging.basicConfig(level=logging.DEBUG)
 
@@ -32,21 +38,20 @@ class EnergyMonitor(arboris.core.Observer):
         self.kinetic_energy = []
         self.potential_energy = []
         self.mechanichal_energy = []
-        self._com_pos = {}
-        self._bodies = self._world.ground.iter_descendant_bodies
-        for body in self._bodies():
-            self._com_pos[body]  = principalframe(body.mass)[:,3]
+        self._bodies = list(self._world.ground.iter_descendant_bodies())
+        self._com_pos = array([principalframe(body.mass)[0:3,3]
+                               for body in self._bodies])
+        self._masses = array([body.mass[3,3] for body in self._bodies])
 
     def update(self, dt):
         self.time.append(self._world.current_time)
         Ec = dot(self._world.gvel, 
                  dot(self._world.mass, self._world.gvel) )/2.
         self.kinetic_energy.append(Ec)
-        Ep = 0.
-        for body in self._bodies():
-            h = dot( dot(body.pose, self._com_pos[body])[0:3], self._world.up)
-            Ep += body.mass[3,3] * h
-        Ep *= 9.81
+        # the bodies centers of mass, computed at once on the poses stack
+        poses = array([body.pose for body in self._bodies])
+        h = dot(Hg.pdot(poses, self._com_pos), self._world.up)
+        Ep = 9.81 * dot(self._masses, h)
         self.potential_energy.append(Ep)
         self.mechanichal_energy.append(Ec+Ep)
 
@@ -129,38 +134,437 @@ max computation time (s): {3}""".format(
     max(self._computation_time))
 
 
-class Hdf5Logger(arboris.core.Observer):
+class Profiler(arboris.core.Observer):
+    """Record the duration of each phase of the simulation.
+
+    Once registered as an observer (or assigned to the world 
+    :attr:`profiler` attribute), the profiler is called by 
+    :func:`arboris.core.simulate` and the world ``update_*`` and 
+    ``integrate`` methods, which record the duration of:
+
+    - each phase of the time steps (``'update_dynamic'``, 
+      ``'update_controllers'``, ...) and of the whole time steps 
+      (``'step'``),
+    - each controller, constraint, broad phase and observer update
+      (``'update_controllers/<controller name>'``, ...),
+    - the admittance update by the engine, the constraints assembly and
+      the Gauss-Seidel sweeps (``'update_controllers/admittance'``, 
+      ``'update_constraints/assembly'`` and 
+      ``'update_constraints/sweeps'``).
+
+    The durations are aggregated: the profiler only keeps, for each 
+    phase, the number of calls, the total, minimal and maximal durations
+    and a histogram of the durations, with logarithmic bins. Its 
+    memory usage does not depend on the simulation length.
+
+    When no profiler is set, the instrumentation reduces to a test per
+    phase and per object.
+
+    **Example:**
+
+        >>> from arboris.core import World, simulate
+        >>> from arboris.robots.simplearm import add_simplearm
+        >>> from arboris.controllers import WeightController
+        >>> w = World()
+        >>> add_simplearm(w)
+        >>> w.register(WeightController(name='weight'))
+        >>> obs = Profiler()
+        >>> simulate(w, [0., 0.001, 0.002], [obs])
+        >>> stats = obs.get_stats()
+        >>> stats['update_controllers/weight']['count']
+        2
+        >>> sum(stats['step']['histogram'])
+        2
+        >>> print obs.get_summary() #doctest: +ELLIPSIS +NORMALIZE_WHITESPACE
+        phase count total (s) mean (s) max (s)
+        step 2 ...
+
+    """
+    def __init__(self, min_duration=1e-7, max_duration=10., 
+                 bins_per_decade=4):
+        self._min_duration = min_duration
+        self._bins_per_decade = bins_per_decade
+        self._nbins = int(ceil(log10(max_duration/min_duration) * 
+                               bins_per_decade))
+        self._world = None
+        self.reset()
+
+    def reset(self):
+        """Forget the recorded durations."""
+        self._stats = {}
+        self._labels = {}
+
+    @property
+    def bin_edges(self):
+        """The edges of the histograms bins (in seconds).
+
+        The first and last bins also count the durations which are 
+        respectively below and above the edges.
+        """
+        return self._min_duration * 10**(
+            arange(self._nbins+1)/float(self._bins_per_decade))
+
+    def init(self, world, timeline):
+        self._world = world
+        world.profiler = self
+
+    def update(self, dt):
+        pass
+
+    def finish(self):
+        if self._world.profiler is self:
+            self._world.profiler = None
+
+    def record(self, phase, duration, obj=None):
+        """Record the duration of a phase.
+
+        :param phase: the name of the phase
+        :type phase: str
+        :param duration: the duration (in seconds)
+        :type duration: float
+        :param obj: the object (such as a controller or a constraint) 
+            or the sub-phase name the duration relates to, if any
+        """
+        key = (phase, obj)
+        try:
+            stats = self._stats[key]
+        except KeyError:
+            stats = self._stats[key] = [0, 0., duration, duration, 
+                                        zeros(self._nbins, dtype=int)]
+        stats[0] += 1
+        stats[1] += duration
+        if duration < stats[2]:
+            stats[2] = duration
+        elif duration > stats[3]:
+            stats[3] = duration
+        if duration > self._min_duration:
+            b = int(log10(duration/self._min_duration) * 
+                    self._bins_per_decade)
+            stats[4][min(b, self._nbins-1)] += 1
+        else:
+            stats[4][0] += 1
+
+    def _label(self, phase, obj):
+        if obj is None:
+            return phase
+        if isinstance(obj, str):
+            return phase + '/' + obj
+        try:
+            return phase + '/' + self._labels[obj]
+        except KeyError:
+            name = getattr(obj, 'name', None) or type(obj).__name__
+            label = name
+            k = 1
+            while label in self._labels.itervalues():
+                label = '{0}#{1}'.format(name, k)
+                k += 1
+            self._labels[obj] = label
+            return phase + '/' + label
+
+    def get_stats(self):
+        """Return the aggregated durations.
+
+        :return: a dictionnary mapping each phase label to a 
+            dictionnary with the ``'count'``, ``'total'``, ``'mean'``, 
+            ``'min'``, ``'max'`` and ``'histogram'`` keys. The histogram
+            is a list of counts, one for each bin (see 
+            :attr:`bin_edges`).
+
+        Unnamed objects are labelled by their class name, and objects
+        which share a label are numbered.
+        """
+        stats = {}
+        for ((phase, obj), (count, total, mini, maxi, histogram)) in \
+                sorted(self._stats.iteritems(), key=lambda i: str(i[0][0])):
+            stats[self._label(phase, obj)] = {
+                'count': count, 'total': total, 'mean': total/count, 
+                'min': mini, 'max': maxi, 'histogram': histogram.tolist()}
+        return stats
+
+    def save(self, filename):
+        """Save the aggregated durations and the bins edges as JSON."""
+        import json
+        with open(filename, 'w') as f:
+            json.dump({'bin_edges': self.bin_edges.tolist(), 
+                       'phases': self.get_stats()}, f, indent=1, 
+                      sort_keys=True)
+
+    def get_summary(self):
+        """Return a table of the phases, by decreasing total duration."""
+        lines = ['{0:30} {1:>6} {2:>12} {3:>12} {4:>12}'.format(
+            'phase', 'count', 'total (s)', 'mean (s)', 'max (s)')]
+        stats = self.get_stats()
+        for label in sorted(stats, key=lambda l: -stats[l]['total']):
+            s = stats[label]
+            lines.append('{0:30} {1:6} {2:12.6f} {3:12.6f} {4:12.6f}'.format(
+                label, s['count'], s['total'], s['mean'], s['max']))
+        return '\n'.join(lines)
+
+
+class AsyncObserver(arboris.core.Observer):
+    """Base class for observers which write data in a background thread.
+
+    :param chunk_size: the number of time steps per buffer
+    :param nb_buffers: the number of buffers
+    :param threaded: if false, the data are written by the simulation 
+        thread, when a buffer is full
+
+    At each time step, the :meth:`snapshot` method copies the data 
+    (such as the bodies poses or the generalized velocity) in a 
+    preallocated buffer, on the simulation thread. Once full, the buffer
+    is queued and the :meth:`write` method is called on it by a writer 
+    thread, so that the I/O overlaps with the simulation. The buffer is
+    then reused.
+
+    The simulation only waits for the writer when all the buffers are 
+    full (or at the end of the simulation), which bounds the memory 
+    usage. The world arrays are never accessed by the writer thread.
+
+    If :meth:`write` raises an exception, the following buffers are 
+    dropped, the output is closed and the exception is raised again on 
+    the simulation thread, by the next call to :meth:`update` or 
+    :meth:`finish`. If the simulation raises an exception, 
+    :meth:`finish` (which :func:`~arboris.core.simulate` still calls) 
+    writes the buffered data and closes the output.
+
+    Subclasses must implement the :meth:`setup`, :meth:`snapshot` and 
+    :meth:`write` methods, and may implement :meth:`close`.
+
+    **Example:**
+
+        >>> from arboris.core import World, simulate
+        >>> from arboris.robots.simplearm import add_simplearm
+        >>> class GvelPrinter(AsyncObserver):
+        ...     def setup(self, world, timeline):
+        ...         self._world = world
+        ...         return {'time': (), 'gvel': (world.ndof,)}
+        ...     def snapshot(self, buffers, k):
+        ...         buffers['time'][k] = self._world.current_time
+        ...         buffers['gvel'][k] = self._world._gvel
+        ...     def write(self, start, stop, buffers):
+        ...         print start, stop, buffers['gvel'][0:stop-start].shape
+        >>> w = World()
+        >>> add_simplearm(w)
+        >>> simulate(w, [0., 0.001, 0.002, 0.003], [GvelPrinter(2)])
+        0 2 (2, 3)
+        2 3 (1, 3)
+
+    """
+    def __init__(self, chunk_size=100, nb_buffers=3, threaded=True):
+        assert chunk_size > 0 and nb_buffers > 0
+        self._chunk_size = chunk_size
+        self._nb_buffers = nb_buffers
+        self._threaded = threaded
+
+    @abstractmethod
+    def setup(self, world, timeline):
+        """Prepare the output, on the simulation thread.
+
+        :return: a dictionnary mapping the name of each buffer to the 
+            shape of the data saved at each time step
+        """
+        pass
+
+    @abstractmethod
+    def snapshot(self, buffers, k):
+        """Copy the current data in the ``k``-th row of the buffers.
+
+        This method is called on the simulation thread.
+        """
+        pass
+
+    @abstractmethod
+    def write(self, start, stop, buffers):
+        """Write the data of the time steps ``start`` to ``stop``.
+
+        The data are in the first ``stop-start`` rows of the buffers. 
+        This method is called on the writer thread (if any), it must not
+        access the world.
+        """
+        pass
+
+    def close(self):
+        """Close the output, on the simulation thread."""
+        pass
+
+    def init(self, world, timeline):
+        shapes = self.setup(world, timeline)
+        self._nb_steps = len(timeline)-1
+        chunk = max(1, min(self._chunk_size, self._nb_steps))
+        self._free = Queue()
+        for i in range(self._nb_buffers):
+            self._free.put(dict((name, zeros((chunk,)+shape)) 
+                                for (name, shape) in shapes.iteritems()))
+        self._buffers = None
+        self._current_step = 0
+        # the buffers rows are written in the steps self._flushed_step to
+        # self._current_step (excluded)
+        self._flushed_step = 0
+        self._error = None
+        if self._threaded:
+            self._pending = Queue(self._nb_buffers)
+            self._writer = Thread(target=self._drain, 
+                                  name=self.__class__.__name__)
+            self._writer.daemon = True
+            self._writer.start()
+        self._running = True
+
+    def _drain(self):
+        """Write the pending buffers (on the writer thread)."""
+        while True:
+            item = self._pending.get()
+            if item is None:
+                return
+            (start, stop, buffers) = item
+            if self._error is None:
+                try:
+                    self.write(start, stop, buffers)
+                except Exception:
+                    self._error = sys.exc_info()
+            self._free.put(buffers)
+
+    def _stop(self):
+        """Stop the writer thread and close the output, once."""
+        if not self._running:
+            return
+        self._running = False
+        if self._threaded:
+            self._pending.put(None)
+            self._writer.join()
+        self.close()
+
+    def _raise_error(self):
+        if self._error is not None:
+            (error, self._error) = (self._error, None)
+            raise error[0], error[1], error[2]
+
+    def update(self, dt):
+        assert self._current_step < self._nb_steps
+        if self._error is not None:
+            self._stop()
+            self._raise_error()
+        if self._buffers is None:
+            # wait for a buffer to be free
+            self._buffers = self._free.get()
+        k = self._current_step - self._flushed_step
+        self.snapshot(self._buffers, k)
+        self._current_step += 1
+        if k+1 == self._buffers.itervalues().next().shape[0]:
+            self.flush()
+
+    def flush(self):
+        """Hand the buffered data over to the writer.
+        """
+        (start, stop) = (self._flushed_step, self._current_step)
+        if stop == start:
+            return
+        (buffers, self._buffers) = (self._buffers, None)
+        if self._threaded:
+            self._pending.put((start, stop, buffers))
+        else:
+            self.write(start, stop, buffers)
+            self._free.put(buffers)
+        self._flushed_step = stop
+
+    def finish(self):
+        if self._running:
+            self.flush()
+            self._stop()
+        self._raise_error()
+
+
+class Hdf5Logger(AsyncObserver):
     """An observer that saves the simulation data in an hdf5 file.
+
+    :param filename: the hdf5 file name
+    :param group: the group, within the file, where the data are saved
+    :param mode: the file opening mode (see :class:`h5py.File`)
+    :param save_viewer_data: whether to save the bodies poses
+    :param save_dyn_model: whether to save the world generalized 
+        velocity, mass and nleffects matrices
+    :param chunk_size: the number of time steps which are buffered in 
+        memory before being written. It is also the chunk size of the 
+        datasets.
+    :param compression: the compression filter of the datasets, such as
+        ``'gzip'`` or ``'lzf'`` (see :meth:`h5py.Group.create_dataset`)
+    :param stack_transforms: if true, the bodies poses are saved in one 
+        ``poses`` dataset, of shape ``(nb_steps, nb_bodies, 4, 4)``,
+        whose ``names`` attribute gives the bodies names. Otherwise, 
+        they are saved in one dataset per body, in the ``transforms`` 
+        group.
+    :param threaded: whether the data are written by a background 
+        thread (see :class:`AsyncObserver`)
+
+    The data are copied in buffers at each time step, and written in 
+    the file once per ``chunk_size`` time steps, instead of issuing one 
+    (small) write per dataset and per time step. 
+
+    **Example:**
+
+        >>> from arboris.core import World, simulate
+        >>> from arboris.robots.simplearm import add_simplearm
+        >>> import os, tempfile, h5py
+        >>> (fd, filename) = tempfile.mkstemp('.h5')
+        >>> os.close(fd)
+        >>> w = World()
+        >>> add_simplearm(w)
+        >>> obs = Hdf5Logger(filename, mode='w', chunk_size=2, 
+        ...                  stack_transforms=True)
+        >>> simulate(w, [0., 0.001, 0.002, 0.003], [obs])
+        >>> f = h5py.File(filename, 'r')
+        >>> f['poses'].shape
+        (3, 3, 4, 4)
+        >>> list(f['poses'].attrs['names'])
+        ['Arm', 'ForeArm', 'Hand']
+        >>> f.close()
+        >>> os.remove(filename)
+
     """
     def __init__(self, filename, group = "/",
                  mode = 'a', save_viewer_data = True , 
-                 save_dyn_model = False):
+                 save_dyn_model = False, chunk_size = 100,
+                 compression = None, stack_transforms = False, 
+                 threaded = True):
         import h5py
+        AsyncObserver.__init__(self, chunk_size, threaded=threaded)
         # hdf5 file handlers
         self._file = h5py.File(filename, mode)
         self._root = self._file
         for g in group.split('/'):
             if g:
                 self._root = self._root.require_group(g)
-        self._transforms = self._root.require_group('transforms')
         # what to save
         self._save_viewer_data = save_viewer_data
         self._save_dyn_model = save_dyn_model
+        # how to save it
+        self._compression = compression
+        self._stack_transforms = stack_transforms
  
-    def init(self, world, timeline):
+    def _require_dataset(self, group, name, shape):
+        chunk = max(1, min(self._chunk_size, self._nb_steps))
+        return group.require_dataset(name, (self._nb_steps,)+shape, 'f8',
+                                     chunks=(chunk,)+shape,
+                                     compression=self._compression)
+
+    def setup(self, world, timeline):
         """Create the datasets.
         """
         self._world = world
         self._nb_steps = len(timeline)-1
-        self._current_step = 0
-        self._root.require_dataset("timeline", (self._nb_steps,), 'f8')
-        
+        shapes = {"timeline": ()}
         if self._save_viewer_data:
             self._matrix = self._world.getbodies()[1:]
-            for m in self._matrix:
-                d = self._transforms.require_dataset(m.name, 
-				               (self._nb_steps, 4,4), 'f8')
-                #d.attrs["ArborisViewerType"] = "matrix"
+            self._names = [m.name for m in self._matrix]
+            shapes["poses"] = (len(self._matrix), 4, 4)
+            if self._stack_transforms:
+                d = self._require_dataset(self._root, "poses", 
+                                          shapes["poses"])
+                d.attrs["names"] = [str(name) for name in self._names]
+            else:
+                transforms = self._root.require_group('transforms')
+                for name in self._names:
+                    d = self._require_dataset(transforms, name, (4, 4))
+                    #d.attrs["ArborisViewerType"] = "matrix"
             #self._wrench = []
             #for w in self._wrench:
             #    d = self._root.require_dataset(w.name, 
@@ -171,30 +575,41 @@ class Hdf5Logger(arboris.core.Observer):
             ndof = self._world.ndof
             #self._root.require_dataset("gpos", 
             #        (self._nb_steps, 4, 4), 'f8')
-            self._root.require_dataset("gvel", 
-                    (self._nb_steps, ndof), 'f8')
-            self._root.require_dataset("mass", 
-                    (self._nb_steps, ndof, ndof), 'f8')
-            self._root.require_dataset("nleffects", 
-                    (self._nb_steps, ndof, ndof), 'f8')
+            shapes["gvel"] = (ndof,)
+            shapes["mass"] = (ndof, ndof)
+            shapes["nleffects"] = (ndof, ndof)
+        for (name, shape) in shapes.iteritems():
+            if name != "poses":
+                self._require_dataset(self._root, name, shape)
+        return shapes
 
-    def update(self, dt):
+    def snapshot(self, buffers, k):
         """Save the current data (state...).
         """
-	assert self._current_step <= self._nb_steps
-        self._root["timeline"][self._current_step] = self._world._current_time
+        buffers["timeline"][k] = self._world._current_time
         if self._save_viewer_data:
-            for m in self._matrix:
-                self._transforms[m.name][self._current_step,:,:] = m.pose
+            poses = buffers["poses"][k]
+            for (i, m) in enumerate(self._matrix):
+                poses[i] = m.pose
             #for w in self._wrench:
             #    self._root[w.name][self._current_step,:] = w.value
         if self._save_dyn_model:
             #self._root["gpos"][self._current_step,:,:] = \
             #        self._world.ground.childrenjoints[0].frames[1].pose
-            self._root["gvel"][self._current_step,:] = self._world.gvel
-            self._root["mass"][self._current_step,:,:] = self._world.mass.copy()
-            self._root["nleffects"][self._current_step,:,:] = self._world.nleffects.copy()
-        self._current_step += 1
+            buffers["gvel"][k] = self._world._gvel
+            buffers["mass"][k] = self._world.mass
+            buffers["nleffects"][k] = self._world.nleffects
 
-    def finish(self):
+    def write(self, start, stop, buffers):
+        """Write the buffered data in the file.
+        """
+        for (name, buf) in buffers.iteritems():
+            if name == "poses" and not self._stack_transforms:
+                transforms = self._root["transforms"]
+                for (i, name) in enumerate(self._names):
+                    transforms[name][start:stop] = buf[0:stop-start, i]
+            else:
+                self._root[name][start:stop] = buf[0:stop-start]
+
+    def close(self):
         self._file.close()
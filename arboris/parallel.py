@@ -0,0 +1,95 @@
+# coding=utf-8
+"""Run independent simulations on a pool of processes.
+
+Parameter sweeps and regression runs simulate many independent
+scenarios. :func:`simulate_scenarios` fans them out over a pool of
+worker processes and yields their results as they finish.
+
+The worlds are built in the workers, by a factory function called with
+the parameters of each scenario, so that neither the worlds nor the
+observers need to be sent between processes. Only the scenarios
+parameters and the results are pickled. Hence, the factory and the
+``collect`` function must be picklable, which means they should be
+defined at the top level of a module.
+
+**Example:**
+
+>>> from arboris.core import World
+>>> from arboris.robots.simplearm import add_simplearm
+>>> def arm(shoulder):
+...     w = World()
+...     add_simplearm(w)
+...     w.getjoints()['Shoulder'].gpos[0] = shoulder
+...     return (w, [])
+>>> results = simulate_scenarios(arm, [0., 0.5, 1.], [0., 0.001, 0.002],
+...                              processes=1)
+>>> sorted(index for (index, result) in results)
+[0, 1, 2]
+
+(``arm`` is not picklable, it can only be run in the current process).
+
+"""
+__author__ = ("Sébastien BARTHÉLEMY <barthelemy@crans.org>")
+
+from multiprocessing import Pool
+from core import simulate
+
+
+def final_state(world, observers):
+    """Return the state of the world at the end of the simulation.
+
+    This is the default ``collect`` function of
+    :func:`simulate_scenarios`. The state is a dictionnary, with the
+    ``'time'``, ``'gvel'`` and ``'gpos'`` keys, the latter being a
+    list of the joints generalized positions.
+    """
+    return {'time': world.current_time,
+            'gvel': world.gvel,
+            'gpos': [j.gpos.copy() for j in world.iterjoints()]}
+
+
+def _run_scenario(task):
+    """Build, simulate and collect a scenario (in a worker process)."""
+    (index, factory, params, timeline, collect) = task
+    (world, observers) = factory(params)
+    simulate(world, timeline, observers)
+    return (index, collect(world, observers))
+
+
+def simulate_scenarios(factory, scenarios, timeline, collect=final_state,
+                       processes=None, chunksize=1):
+    """Simulate each scenario and yield the results as they finish.
+
+    :param factory: a function which takes the parameters of a scenario
+        and returns a ``(world, observers)`` tuple
+    :param scenarios: the parameters of each scenario
+    :type scenarios: iterable
+    :param timeline: the simulation timeline, common to all scenarios
+    :param collect: a function which takes the simulated world and the
+        observers and returns the result of the scenario
+    :param processes: the number of worker processes, defaults to the
+        number of cpus. If 1, the scenarios are simulated in the
+        current process.
+    :param chunksize: the number of scenarios sent at once to a worker
+    :return: an iterator over ``(index, result)`` tuples, in completion
+        order, where ``index`` is the position of the scenario in
+        ``scenarios``
+
+    If a scenario raises an exception, it is raised again by the
+    iterator and the remaining scenarios are cancelled.
+
+    """
+    tasks = ((i, factory, params, timeline, collect)
+             for (i, params) in enumerate(scenarios))
+    if processes == 1:
+        for task in tasks:
+            yield _run_scenario(task)
+        return
+    pool = Pool(processes)
+    try:
+        for result in pool.imap_unordered(_run_scenario, tasks, chunksize):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -1,14 +1,28 @@
 # coding=utf-8
 """
 Functions for working with twists stored as [w,v]
+
+:func:`adjacency` and :func:`exp` also accept stacks of twists, as
+``(N,6)`` arrays, and then return ``(N,6,6)`` or ``(N,4,4)`` stacks.
 """
 __author__ = ("Sébastien BARTHÉLEMY <barthelemy@crans.org>")
 
-from numpy import array, sin, cos, eye, dot, hstack, vstack
+from numpy import array, zeros, sin, cos, eye, dot, hstack, vstack, \
+    where, einsum, newaxis
 from numpy.linalg import norm
 
+def _skew(v):
+    """Return the stack of skew-symmetric matrices of a (N,3) stack."""
+    vx = zeros((len(v), 3, 3))
+    vx[:,0,1] = -v[:,2]
+    vx[:,0,2] = v[:,1]
+    vx[:,1,0] = v[:,2]
+    vx[:,1,2] = -v[:,0]
+    vx[:,2,0] = -v[:,1]
+    vx[:,2,1] = v[:,0]
+    return vx
+
 def adjacency(tw):
-    assert tw.shape == (6,)
     """
     return the adjacency matrix
 
@@ -24,6 +38,13 @@ def adjacency(tw):
            [-11.,  10.,   0.,  -2.,   1.,   0.]])
 
 """
+    if tw.ndim == 2:
+        wx = _skew(tw[:,0:3])
+        A = zeros((len(tw), 6, 6))
+        A[:,0:3,0:3] = wx
+        A[:,3:6,3:6] = wx
+        A[:,3:6,0:3] = _skew(tw[:,3:6])
+        return A
     assert tw.shape == (6,)
     return array(
         [[     0,-tw[2], tw[1],      0,     0,     0],
@@ -47,6 +68,8 @@ def exp(tw):
            [  0.        ,   0.        ,   0.        ,   1.        ]])
 
     """
+    if tw.ndim == 2:
+        return _exp_stack(tw)
     assert tw.shape == (6,)
     w = tw[0:3]
     v = tw[3:6]
@@ -69,3 +92,22 @@ def exp(tw):
     p = dot(sc*eye(3)+cc*wx+dsc*dot(w_3x1,w_3x1.T), v)
     return vstack((hstack((R, p.reshape(3,1))),
                    array([[0., 0., 0., 1.]])))
+
+def _exp_stack(tw):
+    """Vectorized version of :func:`exp`, for a (N,6) stack of twists."""
+    w = tw[:,0:3]
+    v = tw[:,3:6]
+    wx = _skew(w)
+    t = norm(w, axis=1)
+    small = (t < 0.001)
+    ts = where(small, 1., t)
+    cc = where(small, 1./2., (1-cos(ts))/ts**2)
+    sc = where(small, 1.-t**2/6., sin(ts)/ts)
+    dsc = where(small, 1./6., (ts-sin(ts))/ts**3)
+    H = zeros((len(tw), 4, 4))
+    H[:,0:3,0:3] = eye(3) + sc[:,newaxis,newaxis]*wx + \
+            cc[:,newaxis,newaxis]*einsum('bij,bjk->bik', wx, wx)
+    H[:,0:3,3] = sc[:,newaxis]*v + cc[:,newaxis]*einsum('bij,bj->bi', wx, v) \
+            + (dsc*einsum('bi,bi->b', w, v))[:,newaxis]*w
+    H[:,3,3] = 1.
+    return H
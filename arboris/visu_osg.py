@@ -526,7 +526,6 @@ class Drawer(core.Observer):
                 raise NotImplemented(obj)
 
     def init(self, world, timeline):
-        self._world.update_geometric() #TODO find a way to remove this
         for obj in self._world.iterbodies():
             self._register(obj)
         for obj in self._world.itersubframes():
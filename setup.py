@@ -80,7 +80,34 @@ class DocTestCommand(Command):
         
 
 
-cmdclass = {'test': TestCommand, 'doctest' : DocTestCommand}
+class BenchCommand(Command):
+    description = 'run the benchmarks'
+    user_options = [('output=', 'o', 'save the results as JSON'),
+                    ('compare=', 'c', 'compare the results to a baseline')]
+
+    def initialize_options(self):
+        self.output = None
+        self.compare = None
+
+    def finalize_options(self):
+        pass
+
+    def run(self):
+        '''
+        Run the benchmarks of arboris.benchmarks.
+        '''
+        from arboris.benchmarks import main
+        argv = []
+        if self.output:
+            argv.extend(['--output', self.output])
+        if self.compare:
+            argv.extend(['--compare', self.compare])
+        if main(argv):
+            raise SystemExit('performance regression')
+
+
+cmdclass = {'test': TestCommand, 'doctest' : DocTestCommand,
+            'bench': BenchCommand}
 
 try:
     from sphinx.setup_command import BuildDoc
@@ -0,0 +1,94 @@
+import unittest
+from ArborisTests import BaseTest
+from numpy import arange, eye, linspace, array
+from numpy.random import rand
+from arboris.core import World, simulate
+from arboris.batch import BatchWorld, BatchWeightController, \
+    BatchProportionalDerivativeController, simulate_batch, _joint_model
+from arboris.controllers import WeightController, \
+    ProportionalDerivativeController
+from arboris.joints import FreeJoint, RzRyRxJoint, RzRyJoint, RzRxJoint, \
+    RyRxJoint, RzJoint, RyJoint, RxJoint, TxTyTzJoint
+from arboris.twistvector import exp
+from arboris.robots.simplearm import add_simplearm
+from arboris.robots.human36 import add_human36
+
+
+class BatchTestCase(BaseTest):
+
+    def testJointModels(self):
+        for J in (RxJoint, RyJoint, RzJoint, RzRyRxJoint, RzRyJoint, 
+                  RzRxJoint, RyRxJoint, TxTyTzJoint, FreeJoint):
+            if J is FreeJoint:
+                gpos = array([exp(rand(6)) for i in range(3)])
+                gvel = rand(3, 6)
+            else:
+                gpos = rand(3, J().ndof)
+                gvel = rand(3, J().ndof)
+            models = _joint_model(J())(gpos, gvel)
+            for i in range(3):
+                j = J(gpos=gpos[i], gvel=gvel[i])
+                for (value, model) in zip((j.pose, j.jacobian, j.djacobian,
+                                           j.twist, j.idadjoint), models):
+                    self.assertListsAlmostEqual(model[i], value)
+
+    def testSimplearm(self):
+        # each batch member has its own initial position and gains
+        time = arange(0., 0.02, 0.001)
+        gpos = linspace(0., 1., 4)
+        kp = linspace(1., 3., 4)
+        w = World()
+        add_simplearm(w)
+        joints = w.getjoints()
+        bw = BatchWorld(w, 4)
+        bw.joint_gpos(joints['Shoulder'])[:,0] = gpos
+        bw.register(BatchWeightController())
+        bw.register(BatchProportionalDerivativeController(joints[1:3], 
+            kp=[eye(2)*k for k in kp], kd=eye(2)*0.1))
+        simulate_batch(bw, time)
+        for i in range(4):
+            w = World()
+            add_simplearm(w)
+            joints = w.getjoints()
+            joints['Shoulder'].gpos[0] = gpos[i]
+            w.register(WeightController())
+            w.register(ProportionalDerivativeController(joints[1:3],
+                kp=eye(2)*kp[i], kd=eye(2)*0.1))
+            simulate(w, time)
+            self.assertListsAlmostEqual(bw.gvel[i], w.gvel)
+
+    def testHuman36(self):
+        time = arange(0., 0.01, 0.001)
+        w = World()
+        add_human36(w)
+        bw = BatchWorld(w, 2)
+        bw.gvel[1,6:] = 0.1
+        bw.register(BatchWeightController())
+        simulate_batch(bw, time)
+        for i in range(2):
+            w = World()
+            add_human36(w)
+            for j in w.getjoints()[1:]:
+                j.gvel[:] = 0.1*i
+            w.register(WeightController())
+            simulate(w, time)
+            self.assertListsAlmostEqual(bw.gvel[i], w.gvel)
+            self.assertListsAlmostEqual(bw.pose(bw._world._bodies[-1])[i],
+                                        w._bodies[-1].pose)
+
+    def testPoseBeforeInit(self):
+        w = World()
+        add_simplearm(w)
+        w.getjoints()['Shoulder'].gpos[0] = 1.
+        bw = BatchWorld(w, 2)
+        hand = w.getbodies()['Hand']
+        w.update_geometric()
+        for i in range(2):
+            self.assertListsAlmostEqual(bw.pose(hand)[i], hand.pose)
+
+
+ts = unittest.TestSuite()
+ts.addTest(BatchTestCase('testJointModels'))
+ts.addTest(BatchTestCase('testSimplearm'))
+ts.addTest(BatchTestCase('testHuman36'))
+ts.addTest(BatchTestCase('testPoseBeforeInit'))
@@ -0,0 +1,99 @@
+import unittest
+import os
+from tempfile import mkstemp
+from ArborisTests import BaseTest
+from arboris.benchmarks import run_benchmarks, compare, save_results, \
+    load_results, phases, scenarios
+from arboris.core import simulate
+from arboris.engines import ArticulatedBodyEngine
+from arboris.integrators import RungeKuttaIntegrator
+
+
+class BenchmarksTestCase(BaseTest):
+
+    def testRunBenchmarks(self):
+        results = run_benchmarks(['simplearm', 'human36'], number=1, 
+                                 repeat=1, steps=2)
+        names = sorted(results['benchmarks'].keys())
+        self.assertEqual(names, sorted(s+'/'+p for s in ('simplearm', 
+            'human36') for p in phases))
+        for result in results['benchmarks'].values():
+            self.assertTrue(result['best'] > 0.)
+            self.assertTrue(result['mean'] >= result['best'])
+
+    def testStandingScenario(self):
+        # the constraints solver is benchmarked
+        world = dict(scenarios)['human36_standing']()
+        simulate(world, [0., 0.001, 0.002])
+        self.assertTrue(len(world._active_constraints) > 0)
+        results = run_benchmarks(['human36_standing'], 
+                                 ['update_constraints'], number=2, repeat=1)
+        self.assertTrue(
+            results['benchmarks']['human36_standing/update_constraints']
+            ['best'] > 0.)
+
+    def testSpheresScenario(self):
+        # the contacts of the free spheres are solved as a single group
+        world = dict(scenarios)['spheres16']()
+        simulate(world, [0., 0.001, 0.002])
+        constraints = world._active_constraints
+        self.assertEqual(len(constraints), 16)
+        jacobians = [(c.jacobian_dofs, c.compact_jacobian) 
+                     for c in constraints]
+        groups = world._assemble_island((constraints, jacobians), 
+                                        world.gvel, world._coupled_trees())[3]
+        self.assertEqual([len(group) for (group, dols) in groups], [16])
+
+    def testEngineAndIntegrator(self):
+        world = dict(scenarios)['snake10'](engine=ArticulatedBodyEngine(),
+            integrator=RungeKuttaIntegrator('heun'))
+        self.assertTrue(isinstance(world.engine, ArticulatedBodyEngine))
+        results = run_benchmarks(['snake10'], ['simulate'], number=1, 
+                                 repeat=1, steps=2, 
+                                 engine='tree_factorization', 
+                                 integrator='heun')
+        self.assertEqual(results['environment']['engine'], 
+                         'tree_factorization')
+        self.assertEqual(results['environment']['integrator'], 'heun')
+        self.assertRaises(ValueError, run_benchmarks, ['simplearm'], 
+                          number=1, repeat=1, engine='unknown')
+
+    def testCompare(self):
+        results = run_benchmarks(['simplearm'], ['update_dynamic', 
+                                                 'integrate'], 
+                                 number=1, repeat=1)
+        (fd, filename) = mkstemp('.json')
+        os.close(fd)
+        try:
+            save_results(results, filename)
+            baseline = load_results(filename)
+        finally:
+            os.remove(filename)
+        self.assertEqual([s for (n, r, s) in compare(results, baseline)],
+                         ['ok', 'ok'])
+        baseline['benchmarks']['simplearm/integrate']['best'] /= 2.
+        baseline['benchmarks']['simplearm/update_dynamic']['best'] *= 2.
+        self.assertEqual([s for (n, r, s) in compare(results, baseline)],
+                         ['regression', 'improvement'])
+        del baseline['benchmarks']['simplearm/integrate']
+        self.assertEqual(compare(results, baseline)[0],
+                         ('simplearm/integrate', None, 'new'))
+        # the settings must match, the baselines saved before the engine
+        # and integrator were recorded used the default ones
+        del baseline['environment']['engine']
+        del baseline['environment']['integrator']
+        compare(results, baseline)
+        for (key, value) in (('dt', 0.01), ('steps', 10), 
+                             ('engine', 'articulated_body'), 
+                             ('integrator', 'rk4')):
+            other = dict(baseline, environment=dict(baseline['environment']))
+            other['environment'][key] = value
+            self.assertRaises(ValueError, compare, results, other)
+
+
+ts = unittest.TestSuite()
+ts.addTest(BenchmarksTestCase('testRunBenchmarks'))
+ts.addTest(BenchmarksTestCase('testStandingScenario'))
+ts.addTest(BenchmarksTestCase('testSpheresScenario'))
+ts.addTest(BenchmarksTestCase('testEngineAndIntegrator'))
+ts.addTest(BenchmarksTestCase('testCompare'))
@@ -1,12 +1,18 @@
 import unittest
 from ArborisTests import BaseTest
-from numpy import arange, eye
+from copy import deepcopy
+from numpy import arange, eye, array, dot, random, vstack
 from arboris.constraints import JointLimits, BallAndSocketConstraint
 from arboris.constraints import SoftFingerContact
 from arboris.controllers import WeightController
-from arboris.core import simplearm, simulate, Body, World
+from arboris.constraints import get_all_contacts, BroadPhase
+from arboris.core import simplearm, simulate, Body, World, SubFrame, _step
 from arboris.joints import FreeJoint
-from arboris.robots.simpleshapes import add_sphere
+from arboris.shapes import Point, Box
+from arboris.massmatrix import box
+from arboris.homogeneousmatrix import transl
+from arboris.robots.simpleshapes import add_sphere, add_groundplane
+from arboris.robots.human36 import add_human36
 
 
 class ConstraintsTestCase(BaseTest):
@@ -79,9 +85,168 @@ class ConstraintsTestCase(BaseTest):
               [ 0.   ,  0.   ,  1.   ,  0.   ],
               [ 0.   ,  0.   ,  0.   ,  1.   ] ])
 
+    def testGaussSeidelConvergence(self):
+        # a box resting on its four corners
+        for warm_start in (False, True):
+            w = World()
+            add_groundplane(w)
+            b = Body(mass=box((.1, .1, .1), 1.))
+            w.add_link(w.ground, FreeJoint(gpos=transl(0., .1, 0.)), b)
+            for x in (-.1, .1):
+                for z in (-.1, .1):
+                    w.register(Point(SubFrame(b, transl(x, -.1, z))))
+            w.init()
+            w.register(WeightController())
+            for c in get_all_contacts(w, friction_coeff=.6):
+                w.register(c)
+            w.constraints_warm_start = warm_start
+            simulate(w, arange(0., 0.05, 1e-3))
+            self.assertTrue(w.constraints_residual <= w.constraints_tolerance)
+            if warm_start:
+                self.assertEqual(w.constraints_iterations, 1)
+            else:
+                self.assertTrue(w.constraints_iterations > 1)
+            self.assertAlmostEqual(w.getjoints()[0].gpos[1,3], .1)
+
+    def testGaussSeidelStandingHumanoid(self):
+        # the 8 feet contacts of a standing humanoid are coupled, the 
+        # warm-started sweeps converge once the contact is established
+        w = World()
+        add_groundplane(w, half_extents=(3., 0.01, 2.))
+        add_human36(w)
+        w.register(WeightController())
+        for c in get_all_contacts(w, friction_coeff=.6):
+            w.register(c)
+        w.init()
+        iterations = []
+        for k in range(40):
+            _step(w, 1e-3, ())
+            iterations.append(w.constraints_iterations)
+        self.assertEqual(len(w._active_constraints), 8)
+        self.assertEqual(iterations[0], w.constraints_max_iterations)
+        self.assertTrue(max(iterations[10:]) < w.constraints_max_iterations)
+        self.assertTrue(w.constraints_residual <= w.constraints_tolerance)
+
+    def testSoftFingerSolveGroup(self):
+        # the vectorized solver gives the same forces as the 
+        # per-contact one, whatever the friction mode
+        random.seed(0)
+        dt = 1e-3
+        w = World()
+        shapes = (Box(w.ground), Point(w.ground))
+        contacts = []
+        for i in range(60):
+            c = SoftFingerContact(shapes, random.rand())
+            c._sdist = 2e-3 * random.randn()
+            c._force = random.randn(4) * (i % 3 != 0)
+            c._eps = random.rand(3) + .5
+            contacts.append(c)
+        vels = random.randn(60, 4)
+        M = random.randn(60, 4, 4)
+        admittances = array([dot(m, m.T) + .1*eye(4) for m in M])
+        copies = deepcopy(contacts)
+        dforces = SoftFingerContact.solve_group(contacts, vels, admittances, 
+                                                dt)
+        for (i, c) in enumerate(copies):
+            dforce = c.solve(vels[i], admittances[i], dt)
+            self.assertListsAlmostEqual(dforces[i], dforce)
+            self.assertListsAlmostEqual(contacts[i]._force, c._force)
+
+    def testBroadPhase(self):
+        # same simulation as with all the contacts, but fewer contacts
+        gvels = []
+        for broad_phase in (False, True):
+            w = World()
+            add_groundplane(w, (3., .1, 3.))
+            for i in range(8):
+                add_sphere(w, radius=.1, name='Sphere{0}'.format(i))
+            for (i, j) in enumerate(w.getjoints()):
+                j.gpos[0:3,3] = ((i % 4)*.3, .15 + .25*(i//4), (i%3)*.05)
+            w.register(WeightController())
+            if broad_phase:
+                bp = BroadPhase(friction_coeff=.6)
+                w.register(bp)
+            else:
+                contacts = get_all_contacts(w, friction_coeff=.6)
+                for c in contacts:
+                    w.register(c)
+            w.init()
+            simulate(w, arange(0., 0.1, 1e-3))
+            gvels.append(w.gvel)
+        self.assertTrue(len(bp.contacts) < len(contacts))
+        self.assertListsAlmostEqual(gvels[0], gvels[1], 12)
+
+    def testDelassus(self):
+        # the compact assembly gives the same admittance as the dense one
+        from arboris.engines import ArticulatedBodyEngine
+        for engine in (None, ArticulatedBodyEngine()):
+            w = World(engine=engine)
+            add_groundplane(w, (3., .1, 3.))
+            for i in range(4):
+                add_sphere(w, radius=.1, name='Sphere{0}'.format(i))
+            for (i, j) in enumerate(w.getjoints()):
+                j.gpos[0:3,3] = ((i % 2)*.199, .1 + .199*(i//2), 0.)
+            w.register(WeightController())
+            for c in get_all_contacts(w, friction_coeff=.6):
+                w.register(c)
+            w.init()
+            simulate(w, arange(0., 0.002, 1e-3))
+            constraints = w._active_constraints
+            self.assertEqual(len(constraints), 6)
+            jacobians = []
+            for c in constraints:
+                jac = c.jacobian
+                self.assertListsAlmostEqual(jac[:, c.jacobian_dofs],
+                                            c.compact_jacobian)
+                jacobians.append((c.jacobian_dofs, c.compact_jacobian))
+            jac = vstack([c.jacobian for c in constraints])
+            admittance = w._delassus(constraints, jacobians, len(jac))
+            self.assertListsAlmostEqual(admittance, 
+                dot(jac, w._engine.admittance_dot(jac.T)))
+
+    def testIslands(self):
+        from multiprocessing.pool import ThreadPool
+        def spheres():
+            w = World()
+            add_groundplane(w, (3., .1, 3.))
+            for (i, x) in enumerate((0., .2, 1., 2.)):
+                add_sphere(w, radius=.1, name='Sphere{0}'.format(i))
+                w.getjoints()[i].gpos[0:3,3] = (x, .1, 0.)
+            w.register(WeightController())
+            for c in get_all_contacts(w, friction_coeff=.6):
+                w.register(c)
+            w.init()
+            return w
+        # the islands solved by a pool give the same result
+        gvels = []
+        for pool in (None, ThreadPool(2)):
+            w = spheres()
+            w.getjoints()[3].gvel[3] = 1.
+            w.islands_pool = pool
+            simulate(w, arange(0., 0.01, 1e-3))
+            self.assertEqual(w.constraints_islands, (3, 3))
+            gvels.append(w.gvel)
+        self.assertListsAlmostEqual(gvels[0], gvels[1])
+        # the islands at rest fall asleep and wake up when pushed
+        w = spheres()
+        w.sleep_velocity = 1e-6
+        w.sleep_steps = 5
+        simulate(w, arange(0., 0.01, 1e-3))
+        self.assertEqual(w.constraints_islands, (3, 0))
+        self.assertFalse(w.gvel.any())
+        w.getjoints()[3].gvel[3] = 1.
+        simulate(w, arange(0.01, 0.02, 1e-3))
+        self.assertEqual(w.constraints_islands, (3, 1))
+        self.assertTrue(w.getjoints()[3].gpos[0,3] > 2.)
+
 
 ts = unittest.TestSuite()
 ts.addTest(ConstraintsTestCase('testJoinLimits'))
 ts.addTest(ConstraintsTestCase('testBallAndSocketConstraint'))
 ts.addTest(ConstraintsTestCase('testSoftFingerContact'))
-
+ts.addTest(ConstraintsTestCase('testGaussSeidelConvergence'))
+ts.addTest(ConstraintsTestCase('testGaussSeidelStandingHumanoid'))
+ts.addTest(ConstraintsTestCase('testSoftFingerSolveGroup'))
+ts.addTest(ConstraintsTestCase('testBroadPhase'))
+ts.addTest(ConstraintsTestCase('testDelassus'))
+ts.addTest(ConstraintsTestCase('testIslands'))
@@ -4,9 +4,10 @@ from arboris.controllers import WeightController, ProportionalDerivativeControll
 from arboris.core import simplearm
 from abc import ABCMeta, abstractmethod, abstractproperty
 from arboris.core import NamedObject, Controller, World, Joint
-from numpy import array, zeros, dot, ix_, ndarray
+from numpy import array, zeros, dot, ix_, ndarray, arange
 import arboris.homogeneousmatrix
 from arboris.joints import LinearConfigurationSpaceJoint
+from arboris.robots.human36 import add_human36
 
 
 class ControllersTestCase(BaseTest):
@@ -28,8 +29,25 @@ class ControllersTestCase(BaseTest):
         w.update_dynamic() #TODO change for update_kinematic
         self.assertListsAlmostEqual(c.update()[0],
         ([ 7.69376549,  2.49329922,  0.13889997])) #test done!
-        self.assertListsAlmostEqual(c.update()[1],
-        [[ 0.,  0.,  0.],[ 0.,  0.,  0.],[ 0.,  0.,  0.]]) #test done!
+        # the impedance is zero
+        self.assertTrue(c.update()[1] is None)
+
+    def testWeightControllerTree(self):
+        # compare the recursive computation with the bodies jacobians
+        w = World()
+        add_human36(w)
+        for j in w.getjoints():
+            j.integrate(0.1*arange(1., j.ndof+1), 1.)
+        c = WeightController()
+        w.register(c)
+        w.init()
+        w.update_dynamic()
+        gforce = zeros(w.ndof)
+        g = array((0., 0., 0., 0., -9.81, 0.))
+        for b in w.iterbodies():
+            gforce[b.jacobian_dofs] += dot(b.compact_jacobian.T, 
+                dot(b.mass, arboris.homogeneousmatrix.iadjoint_dot(b.pose, g)))
+        self.assertListsAlmostEqual(c.update()[0], gforce)
 
     def testProportionalDerivativeController(self):
         w = simplearm()
@@ -41,11 +59,59 @@ class ControllersTestCase(BaseTest):
         w.register(pdc)
         w.init()
         w.update_dynamic()
-        self.assertListsAlmostEqual(pdc.update(1/2)[0],([ 0.,  0.,  0.]))
-        self.assertListsAlmostEqual(pdc.update(1/2)[1],
+        (dofs, gforce, impedance) = pdc.update(1/2)
+        self.assertEqual(list(dofs), [0, 1, 2])
+        self.assertListsAlmostEqual(gforce, ([ 0.,  0.,  0.]))
+        self.assertListsAlmostEqual(impedance,
         [[ 0.,  0.,  0.],[ 0.,  0.,  0.],[ 0.,  0.,  0.]]) 
 
+    def testSparseImpedance(self):
+        w = simplearm()
+        joints = w.getjoints()
+        pdc0 = ProportionalDerivativeController(joints[0:1], kp=1., kd=2.)
+        pdc1 = ProportionalDerivativeController(joints[2:3], kp=3., kd=4.,
+                                                gpos_des=[1.])
+        w.register(pdc0)
+        w.register(pdc1)
+        w.init()
+        w.update_dynamic()
+        w.update_controllers(0.1)
+        self.assertListsAlmostEqual(w._gforce, [0., 0., 3.])
+        self.assertListsAlmostEqual(w._controller_impedance,
+            [[-2.1, 0., 0.], [0., 0., 0.], [0., 0., -4.3]])
+        # the same blocks are returned, the impedance is not assembled
+        blocks = w._impedance_blocks
+        w.update_controllers(0.1)
+        self.assertTrue(w._impedance_blocks is blocks)
+        # the gains changed
+        pdc1.kd[:] = 5.
+        w.update_controllers(0.1)
+        self.assertListsAlmostEqual(w._controller_impedance,
+            [[-2.1, 0., 0.], [0., 0., 0.], [0., 0., -5.3]])
+
+    def testImpedanceModifiedInPlace(self):
+        class DampingController(Controller):
+            def init(self, world):
+                self.dofs = array([1])
+                self.impedance = zeros((1, 1))
+            def update(self, dt):
+                return (self.dofs, zeros(1), self.impedance)
+        w = simplearm()
+        c = DampingController()
+        w.register(c)
+        w.init()
+        w.update_dynamic()
+        w.update_controllers(0.1)
+        self.assertListsAlmostEqual(w._controller_impedance, zeros((3, 3)))
+        c.impedance[0, 0] = -2.
+        w.update_controllers(0.1)
+        self.assertListsAlmostEqual(w._controller_impedance,
+            [[0., 0., 0.], [0., -2., 0.], [0., 0., 0.]])
+
 ts = unittest.TestSuite()
 ts.addTest(ControllersTestCase('testConstruction'))
 ts.addTest(ControllersTestCase('testWeightController'))
+ts.addTest(ControllersTestCase('testWeightControllerTree'))
+ts.addTest(ControllersTestCase('testSparseImpedance'))
+ts.addTest(ControllersTestCase('testImpedanceModifiedInPlace'))
 ts.addTest(ControllersTestCase('testProportionalDerivativeController'))
\ No newline at end of file
@@ -0,0 +1,163 @@
+import unittest
+from ArborisTests import BaseTest
+from numpy import arange, eye, dot, zeros
+from numpy.random import rand
+from numpy.linalg import inv
+from arboris.core import World, simulate
+from arboris.engines import ArticulatedBodyEngine, TreeFactorizationEngine, \
+    ReusedAdmittanceEngine
+from arboris.controllers import WeightController, ProportionalDerivativeController
+from arboris.constraints import get_all_contacts
+from arboris.robots.simplearm import add_simplearm
+from arboris.robots.human36 import add_human36
+from arboris.robots.simpleshapes import add_groundplane, add_sphere
+import arboris.homogeneousmatrix as Hg
+
+
+def _human36_world(engine=None):
+    w = World(engine=engine)
+    add_groundplane(w, half_extents=(3., 0.01, 2.))
+    add_human36(w)
+    w.ground.childrenjoints[0].gpos = dot(Hg.transl(0, 0.03, 0),
+                                          w.ground.childrenjoints[0].gpos)
+    w.register(WeightController())
+    for c in get_all_contacts(w, friction_coeff=.6):
+        w.register(c)
+    return w
+
+
+class EnginesTestCase(BaseTest):
+
+    def testArticulatedBodyAdmittance(self):
+        w = _human36_world(ArticulatedBodyEngine())
+        w.init()
+        w.update_dynamic()
+        dt = 0.001
+        w.update_controllers(dt)
+        Z = w.mass/dt + w.viscosity + w.nleffects - w._controller_impedance
+        gforce = rand(w.ndof, 2)
+        self.assertListsAlmostEqual(dot(Z, w.engine.admittance_dot(gforce)),
+                                    gforce)
+        self.assertListsAlmostEqual(w.engine.mass_dot(gforce[:,0]),
+                                    dot(w.mass, gforce[:,0]))
+
+    def testArticulatedBodySimulation(self):
+        time = arange(0., 0.02, 0.001)
+        worlds = [_human36_world(), _human36_world(ArticulatedBodyEngine())]
+        for w in worlds:
+            simulate(w, time)
+        self.assertListsAlmostEqual(worlds[0].gvel, worlds[1].gvel)
+
+    def testArticulatedBodyCoupledControllers(self):
+        # a controller coupling several joints makes the engine fall back
+        # to the dense model
+        worlds = []
+        for engine in (None, ArticulatedBodyEngine()):
+            w = World(engine=engine)
+            add_simplearm(w)
+            joints = w.getjoints()
+            joints['Shoulder'].gpos[0] = 0.5
+            w.register(ProportionalDerivativeController(joints, kp=eye(3)+1.,
+                                                        kd=eye(3)))
+            simulate(w, arange(0., 0.02, 0.001))
+            worlds.append(w)
+        self.assertListsAlmostEqual(worlds[0].gvel, worlds[1].gvel)
+
+    def testTreeFactorizationAdmittance(self):
+        w = _human36_world(TreeFactorizationEngine())
+        add_human36(w) # a second, independent, tree
+        w.init()
+        w.update_dynamic()
+        dt = 0.001
+        w.update_controllers(dt)
+        Z = w.mass/dt + w.viscosity + w.nleffects - w._controller_impedance
+        gforce = rand(w.ndof, 2)
+        self.assertListsAlmostEqual(dot(Z, w.engine.admittance_dot(gforce)),
+                                    gforce)
+
+    def testTreeFactorizationSimulation(self):
+        time = arange(0., 0.02, 0.001)
+        worlds = [_human36_world(), _human36_world(TreeFactorizationEngine())]
+        for w in worlds:
+            simulate(w, time)
+        self.assertListsAlmostEqual(worlds[0].gvel, worlds[1].gvel)
+
+    def testTreeFactorizationModel(self):
+        # the dense model is not built, unless a controller couples 
+        # unrelated joints
+        w = _human36_world(TreeFactorizationEngine())
+        joints = w.getjoints()
+        (j0, j1) = (joints[3], joints[14]) # on different branches
+        for j in (j0, j1):
+            w.register(ProportionalDerivativeController([j], kp=eye(j.ndof),
+                                                        kd=eye(j.ndof)))
+        w.init()
+        w.update_dynamic()
+        dt = 0.001
+        w.update_controllers(dt)
+        self.assertTrue(w._model_is_stale)
+        Z = w.mass/dt + w.viscosity + w.nleffects - w._controller_impedance
+        gforce = rand(w.ndof, 2)
+        self.assertListsAlmostEqual(dot(Z, w.engine.admittance_dot(gforce)),
+                                    gforce)
+        self.assertListsAlmostEqual(w.engine.mass_dot(gforce[:,0]),
+                                    dot(w.mass, gforce[:,0]))
+        w.register(ProportionalDerivativeController([j0, j1],
+                                                    kp=eye(j0.ndof+j1.ndof)))
+        w.init()
+        w.update_dynamic()
+        w.update_controllers(dt)
+        Z = w.mass/dt + w.viscosity + w.nleffects - w._controller_impedance
+        self.assertListsAlmostEqual(dot(Z, w.engine.admittance_dot(gforce)),
+                                    gforce)
+
+    def testReusedAdmittance(self):
+        time = arange(0., 0.2, 0.001)
+        engines = (None, ReusedAdmittanceEngine(period=1), 
+                   ReusedAdmittanceEngine(period=10, tolerance=0.01, 
+                                          iterations=2))
+        worlds = []
+        for engine in engines:
+            w = World(engine=engine)
+            add_simplearm(w)
+            w.getjoints()['Shoulder'].gpos[0] = 1.
+            w.register(WeightController())
+            simulate(w, time)
+            worlds.append(w)
+        self.assertEqual(engines[1].inversions, len(time)-1)
+        self.assertListsAlmostEqual(worlds[0].gvel, worlds[1].gvel)
+        self.assertTrue(engines[2].inversions < (len(time)-1)/5)
+        self.assertTrue(engines[2].residual <= 0.01)
+        self.assertTrue(abs(worlds[0].gvel - worlds[2].gvel).max() < 0.1)
+
+
+    def testBlockAdmittance(self):
+        # the default engine inverts the impedance of each set of coupled
+        # subtrees separately
+        w = World()
+        add_simplearm(w, name='arm0')
+        add_simplearm(w, name='arm1')
+        add_sphere(w)
+        joints = w.getjoints()
+        coupled = [joints['arm0Shoulder'], joints['arm1Shoulder']]
+        w.register(WeightController())
+        w.register(ProportionalDerivativeController(coupled, kp=eye(2)+1.,
+                                                    kd=eye(2)))
+        w.init()
+        w.update_dynamic()
+        w.update_controllers(0.001)
+        self.assertEqual([list(d) for d in w._coupled_dofs()], 
+                         [[0, 1, 2, 3, 4, 5], [6, 7, 8, 9, 10, 11]])
+        self.assertListsAlmostEqual(w._admittance, inv(w._impedance))
+        self.assertFalse(w._admittance[0:6, 6:12].any())
+
+
+ts = unittest.TestSuite()
+ts.addTest(EnginesTestCase('testArticulatedBodyAdmittance'))
+ts.addTest(EnginesTestCase('testArticulatedBodySimulation'))
+ts.addTest(EnginesTestCase('testArticulatedBodyCoupledControllers'))
+ts.addTest(EnginesTestCase('testTreeFactorizationAdmittance'))
+ts.addTest(EnginesTestCase('testTreeFactorizationSimulation'))
+ts.addTest(EnginesTestCase('testTreeFactorizationModel'))
+ts.addTest(EnginesTestCase('testReusedAdmittance'))
+ts.addTest(EnginesTestCase('testBlockAdmittance'))
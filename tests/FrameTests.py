@@ -110,13 +110,14 @@ class TestUpdates(BodyTestCase):
               [ 2.6,  1. ,  0. ,  4.7],
               [ 0. ,  0. ,  0. ,  0. ],
               [ 0. ,  9. ,  0. ,  7.5] ])
-        self.assertEqual(forearm.jacobian, None)
+        # the jacobian is not updated, it is computed on demand
+        self.assertEqual(forearm.jacobian.shape, (6, 3))
         self.assertListsAlmostEqual(hand.pose,
             [ [  0. ,   5. ,   0. ,   4.5 ],
               [  2.6,   1. ,   0. ,   5.1 ],
               [  0. ,   0. ,   0. ,   0.  ],
               [  0. ,   9. ,   0. ,  11.1 ] ])
-        self.assertEqual(hand.jacobian, None)
+        self.assertEqual(hand.jacobian.shape, (6, 3))
 
     def testDynamicUpdate(self):
         bodies = self.sarmw.getbodies()
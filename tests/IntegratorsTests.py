@@ -0,0 +1,85 @@
+import unittest
+from ArborisTests import BaseTest
+from numpy import arange, dot, eye
+from arboris.core import World, simulate, EulerIntegrator
+from arboris.integrators import RungeKuttaIntegrator
+from arboris.controllers import WeightController, \
+    ProportionalDerivativeController
+from arboris.constraints import JointLimits
+from arboris.robots.simplearm import add_simplearm
+from arboris.observers import EnergyMonitor, Profiler
+
+
+def _energy_drift(integrator, dt):
+    w = World(integrator=integrator)
+    add_simplearm(w)
+    w.getjoints()['Shoulder'].gpos[0] = 1.
+    w.register(WeightController())
+    energy = EnergyMonitor()
+    simulate(w, arange(0., 0.5+dt/2, dt), [energy])
+    return abs(energy.mechanichal_energy[-1] - energy.mechanichal_energy[0])
+
+
+def _controlled_arm(integrator, dt, observers=()):
+    w = World(integrator=integrator)
+    add_simplearm(w)
+    w.getjoints()['Shoulder'].gpos[0] = 1.
+    w.register(WeightController())
+    # its impedance depends on the time step
+    w.register(ProportionalDerivativeController(w.getjoints(), kp=eye(3),
+                                                kd=0.1*eye(3)))
+    simulate(w, arange(0., 0.5+dt/2, dt), observers)
+    return w
+
+
+class IntegratorsTestCase(BaseTest):
+
+    def testEulerIsDefault(self):
+        w = World()
+        add_simplearm(w)
+        w.init()
+        self.assertTrue(isinstance(w._integrator, EulerIntegrator))
+
+    def testEnergyDrift(self):
+        euler = _energy_drift(None, 0.01)
+        for method in ('midpoint', 'heun', 'rk4'):
+            self.assertTrue(
+                _energy_drift(RungeKuttaIntegrator(method), 0.01) < euler)
+        # the fourth order method with a 10 times larger time step
+        self.assertTrue(_energy_drift(RungeKuttaIntegrator('rk4'), 0.01) <
+                        _energy_drift(None, 0.001))
+
+    def testConvergenceOrder(self):
+        reference = _controlled_arm(RungeKuttaIntegrator('rk4'), 0.001).gvel
+        for (method, order) in (('heun', 2), ('rk4', 4)):
+            (error1, error2) = [
+                abs(_controlled_arm(RungeKuttaIntegrator(method), dt).gvel
+                    - reference).max()
+                for dt in (0.02, 0.01)]
+            self.assertTrue(error1/error2 > 0.75 * 2**order)
+
+    def testAdmittanceNotUpdated(self):
+        profiler = Profiler()
+        _controlled_arm(RungeKuttaIntegrator('rk4'), 0.01, [profiler])
+        stats = profiler.get_stats()
+        self.assertEqual(stats['update_controllers']['count'], 50)
+        # the admittance is never computed
+        self.assertFalse('update_controllers/admittance' in stats)
+
+    def testConstraints(self):
+        w = World(integrator=RungeKuttaIntegrator())
+        add_simplearm(w)
+        w.register(JointLimits(w.getjoints()['Shoulder'], -1., 1.))
+        self.assertRaises(ValueError, w.init)
+
+    def testUnknownMethod(self):
+        self.assertRaises(ValueError, RungeKuttaIntegrator, 'rk5')
+
+
+ts = unittest.TestSuite()
+ts.addTest(IntegratorsTestCase('testEulerIsDefault'))
+ts.addTest(IntegratorsTestCase('testEnergyDrift'))
+ts.addTest(IntegratorsTestCase('testConvergenceOrder'))
+ts.addTest(IntegratorsTestCase('testAdmittanceNotUpdated'))
+ts.addTest(IntegratorsTestCase('testConstraints'))
+ts.addTest(IntegratorsTestCase('testUnknownMethod'))
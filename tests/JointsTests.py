@@ -164,6 +164,27 @@ class JointsTestCase(BaseTest):
         [[1.], [0.], [0.], [0.], [0.], [0.]]))
         self.assertListsAlmostEqual(j.djacobian, zeros((6,1)))
 
+    def testModel(self):
+        for J in (RzRyRxJoint, RzRyJoint, RzRxJoint, RyRxJoint, RzJoint,
+                  RyJoint, RxJoint, FreeJoint):
+            j = J()
+            j.gvel[:] = 0.5
+            if J is not FreeJoint:
+                j.gpos[:] = 0.3
+            model = j.model
+            self.assertTrue(j.model is model)
+            for (value, expected) in zip(model, (j.pose, j.ipose, j.twist,
+                    j.jacobian, j.djacobian, j.idadjoint)):
+                self.assertTrue(norm(value - expected) < 1e-10)
+            # the cache is invalidated by in-place modifications
+            j.gvel[0] = 1.
+            self.assertFalse(j.model is model)
+            self.assertTrue(norm(j.model[2] - j.twist) < 1e-10)
+            self.assertTrue(norm(j.model[5] - j.idadjoint) < 1e-10)
+            # the arrays are reused
+            self.assertTrue(j.model[1] is model[1])
+            self.assertTrue(j.model[5] is model[5])
+
 
 ts = unittest.TestSuite()
 ts.addTest(JointsTestCase('test'))
@@ -175,4 +196,5 @@ ts.addTest(JointsTestCase('testRzRxJoint'))
 ts.addTest(JointsTestCase('testRyRxJoint'))
 ts.addTest(JointsTestCase('testRzJoint'))
 ts.addTest(JointsTestCase('testRyJoint'))
-ts.addTest(JointsTestCase('testRxJoint'))
\ No newline at end of file
+ts.addTest(JointsTestCase('testRxJoint'))
+ts.addTest(JointsTestCase('testModel'))
\ No newline at end of file
@@ -0,0 +1,147 @@
+import unittest
+import os
+from tempfile import mkstemp
+from ArborisTests import BaseTest
+from numpy import arange, array
+from arboris.core import World, simulate, Observer
+from arboris.controllers import WeightController
+from arboris.observers import Hdf5Logger, AsyncObserver
+from time import sleep
+from threading import currentThread
+from arboris.robots.simplearm import add_simplearm
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+class _PoseRecorder(Observer):
+
+    def init(self, world, timeline):
+        self._world = world
+        self.poses = []
+        self.gvels = []
+
+    def update(self, dt):
+        self.poses.append([b.pose for b in self._world.getbodies()[1:]])
+        self.gvels.append(self._world.gvel)
+
+    def finish(self):
+        pass
+
+
+class _FailingRecorder(_PoseRecorder):
+
+    def update(self, dt):
+        _PoseRecorder.update(self, dt)
+        if len(self.poses) == 5:
+            raise RuntimeError('simulation failure')
+
+
+class _SlowGvelLogger(AsyncObserver):
+
+    def setup(self, world, timeline):
+        self._world = world
+        self.gvels = []
+        self.buffers = set()
+        return {'gvel': (world.ndof,)}
+
+    def snapshot(self, buffers, k):
+        self.buffers.add(id(buffers['gvel']))
+        buffers['gvel'][k] = self._world._gvel
+
+    def write(self, start, stop, buffers):
+        self.writer = currentThread()
+        if start >= 6:
+            raise IOError('disk full')
+        sleep(0.01)
+        self.gvels.extend(buffers['gvel'][0:stop-start].copy())
+
+
+class ObserversTestCase(BaseTest):
+
+    def testAsyncObserver(self):
+        w = World()
+        add_simplearm(w)
+        w.register(WeightController())
+        recorder = _PoseRecorder()
+        logger = _SlowGvelLogger(chunk_size=2, nb_buffers=2)
+        self.assertRaises(IOError, simulate, w, arange(0., 0.0105, 0.001), 
+                          [recorder, logger])
+        self.assertEqual(len(logger.buffers), 2)
+        self.assertFalse(logger.writer.isAlive())
+        self.assertListsAlmostEqual(logger.gvels, recorder.gvels[0:6])
+
+    def testAsyncObserverSimulationError(self):
+        # the writer thread is stopped if the simulation fails
+        w = World()
+        add_simplearm(w)
+        w.register(WeightController())
+        logger = _SlowGvelLogger(chunk_size=2, nb_buffers=2)
+        recorder = _FailingRecorder()
+        self.assertRaises(RuntimeError, simulate, w, 
+                          arange(0., 0.0105, 0.001), [logger, recorder])
+        self.assertFalse(logger.writer.isAlive())
+        self.assertListsAlmostEqual(logger.gvels, recorder.gvels)
+        logger.finish() # nothing left to do
+
+    @unittest.skipIf(h5py is None, 'h5py is not available')
+    def testHdf5LoggerSimulationError(self):
+        # the file is closed if the simulation fails
+        w = World()
+        add_simplearm(w)
+        w.register(WeightController())
+        (fd, filename) = mkstemp('.h5')
+        os.close(fd)
+        try:
+            logger = Hdf5Logger(filename, mode='w', chunk_size=2)
+            recorder = _FailingRecorder()
+            self.assertRaises(RuntimeError, simulate, w, 
+                              arange(0., 0.0105, 0.001), [logger, recorder])
+            self.assertFalse(logger._file)
+            f = h5py.File(filename, 'r')
+            self.assertListsAlmostEqual(f['timeline'][0:5], 
+                                        arange(0., 0.0045, 0.001))
+            f.close()
+        finally:
+            os.remove(filename)
+
+    @unittest.skipIf(h5py is None, 'h5py is not available')
+    def testHdf5Logger(self):
+        time = arange(0., 0.0105, 0.001)
+        for (stack_transforms, threaded) in ((False, True), (True, False)):
+            w = World()
+            add_simplearm(w)
+            w.register(WeightController())
+            (fd, filename) = mkstemp('.h5')
+            os.close(fd)
+            try:
+                recorder = _PoseRecorder()
+                logger = Hdf5Logger(filename, 'xp', 'w', save_dyn_model=True,
+                                    chunk_size=4, compression='gzip',
+                                    stack_transforms=stack_transforms,
+                                    threaded=threaded)
+                simulate(w, time, [recorder, logger])
+                f = h5py.File(filename, 'r')
+                root = f['xp']
+                self.assertListsAlmostEqual(root['timeline'][:], time[:-1])
+                self.assertListsAlmostEqual(root['gvel'][:], 
+                                            array(recorder.gvels))
+                poses = array(recorder.poses)
+                if stack_transforms:
+                    self.assertListsAlmostEqual(root['poses'][:], poses)
+                else:
+                    for (i, name) in enumerate(('Arm', 'ForeArm', 'Hand')):
+                        self.assertListsAlmostEqual(
+                            root['transforms'][name][:], poses[:,i])
+                self.assertEqual(root['mass'].chunks, (4, 3, 3))
+                f.close()
+            finally:
+                os.remove(filename)
+
+
+ts = unittest.TestSuite()
+ts.addTest(ObserversTestCase('testAsyncObserver'))
+ts.addTest(ObserversTestCase('testAsyncObserverSimulationError'))
+ts.addTest(ObserversTestCase('testHdf5Logger'))
+ts.addTest(ObserversTestCase('testHdf5LoggerSimulationError'))
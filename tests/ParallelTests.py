@@ -0,0 +1,48 @@
+import unittest
+from ArborisTests import BaseTest
+from numpy import arange
+from arboris.core import World, simulate
+from arboris.parallel import simulate_scenarios
+from arboris.controllers import WeightController
+from arboris.observers import EnergyMonitor
+from arboris.robots.simplearm import add_simplearm
+
+
+def _simplearm(shoulder):
+    w = World()
+    add_simplearm(w)
+    w.getjoints()['Shoulder'].gpos[0] = shoulder
+    w.register(WeightController())
+    return (w, [EnergyMonitor()])
+
+def _energy(world, observers):
+    return observers[0].mechanichal_energy
+
+
+class ParallelTestCase(BaseTest):
+
+    def testSimulateScenarios(self):
+        time = arange(0., 0.01, 0.001)
+        scenarios = [0., 0.5, 1., 1.5]
+        expected = []
+        for shoulder in scenarios:
+            (w, observers) = _simplearm(shoulder)
+            simulate(w, time, observers)
+            expected.append(w.gvel)
+        for processes in (1, 2):
+            results = dict(simulate_scenarios(_simplearm, scenarios, time,
+                                              processes=processes))
+            self.assertEqual(sorted(results.keys()), range(4))
+            for (i, gvel) in enumerate(expected):
+                self.assertListsAlmostEqual(results[i]['gvel'], gvel)
+
+    def testCollect(self):
+        time = arange(0., 0.01, 0.001)
+        results = dict(simulate_scenarios(_simplearm, [0., 1.], time, 
+                                          _energy, processes=2))
+        self.assertEqual(len(results[1]), len(time)-1)
+
+
+ts = unittest.TestSuite()
+ts.addTest(ParallelTestCase('testSimulateScenarios'))
+ts.addTest(ParallelTestCase('testCollect'))
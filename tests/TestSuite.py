@@ -4,10 +4,15 @@
 import unittest
 import ConstraintsTests, JointsTests, HomogeneousmatrixTest
 import Human36Tests, FrameTests, WorldTests, ControllersTests
+import EnginesTests, BatchTests, ParallelTests, BenchmarksTests
+import ObserversTests, IntegratorsTests
 
 tests = unittest.TestSuite([ JointsTests.ts, FrameTests.ts, 
                              ConstraintsTests.ts, ControllersTests.ts,
                              HomogeneousmatrixTest.ts, WorldTests.ts, 
-                             Human36Tests.ts ])
+                             Human36Tests.ts, EnginesTests.ts,
+                             BatchTests.ts, ParallelTests.ts,
+                             BenchmarksTests.ts, ObserversTests.ts,
+                             IntegratorsTests.ts ])
 
 unittest.TextTestRunner(verbosity=2).run(tests)
@@ -1,10 +1,17 @@
 import unittest
 from ArborisTests import BaseTest
-from arboris.core import Body, SubFrame, World
+from arboris.core import Body, SubFrame, World, simulate, itersimulate, \
+    simulate_adaptive, _step, _save_state, _restore_state
 from arboris.homogeneousmatrix import transl
 from arboris.joints import RyJoint, RzRxJoint, RyRxJoint, RzRyRxJoint
 from arboris.robots.simplearm import add_simplearm
-from numpy import eye, zeros
+from arboris.robots.snake import add_snake
+from arboris.robots.simpleshapes import add_sphere, add_groundplane
+from arboris.engines import ArticulatedBodyEngine
+from arboris.controllers import WeightController
+from arboris.constraints import get_all_contacts, BroadPhase
+from arboris.observers import Profiler, EnergyMonitor
+from numpy import eye, zeros, arange
 
 
 class WorldTestCase(BaseTest):
@@ -77,6 +84,32 @@ class TestUpdates(WorldTestCase):
                                                  [ 0. ,  0. ,  1. ,  0. ],
                                                  [ 0. ,  0. ,  0. ,  1. ] ])
 
+    def testGeometricUpdateAfterAddLink(self):
+        w = World()
+        add_simplearm(w)
+        w.init()
+        hand = w.getbodies()['Hand']
+        finger = Body(name='Finger')
+        w.add_link(SubFrame(hand, transl(0., 0.1, 0.)), RyJoint(), finger)
+        w.update_geometric()
+        self.assertListsAlmostEqual(finger.pose, [ [ 1. ,  0. ,  0. ,  0. ],
+                                                   [ 0. ,  1. ,  0. ,  1. ],
+                                                   [ 0. ,  0. ,  1. ,  0. ],
+                                                   [ 0. ,  0. ,  0. ,  1. ] ])
+
+    def testDynamicUpdateAfterAddLink(self):
+        w = World()
+        add_simplearm(w)
+        w.init()
+        hand = w.getbodies()['Hand']
+        finger = Body(name='Finger', mass=eye(6))
+        w.add_link(SubFrame(hand, transl(0., 0.1, 0.)), RyJoint(), finger)
+        w.update_dynamic()
+        self.assertEqual(w.ndof, 4)
+        self.assertEqual(w.mass.shape, (4, 4))
+        self.assertListsAlmostEqual(finger.pose[0:3,3], [0., 1., 0.])
+        self.assertEqual(finger.jacobian.shape, (6, 4))
+
     def testDynamicUpdate(self):
         w = World()
         add_simplearm(w)
@@ -266,10 +299,263 @@ class TestUpdates(WorldTestCase):
              [ 0.27979997,  0.00247348, -0.00494696],
              [ 0.03230564,  0.00742044,  0.        ]])
 
+    def testCompactJacobian(self):
+        w = World()
+        add_simplearm(w)
+        joints = w.getjoints()
+        joints[0].gpos[0] = 0.5
+        joints[1].gvel[0] = -1.0
+        w.update_dynamic()
+        bodies = w.getbodies()
+        self.assertEqual(list(bodies['ground'].jacobian_dofs), [])
+        self.assertEqual(list(bodies['ForeArm'].jacobian_dofs), [0, 1])
+        for b in w.iterbodies():
+            jac = zeros((6, w.ndof))
+            jac[:, b.jacobian_dofs] = b.compact_jacobian
+            self.assertListsAlmostEqual(b.jacobian, jac)
+            djac = zeros((6, w.ndof))
+            djac[:, b.jacobian_dofs] = b.compact_djacobian
+            self.assertListsAlmostEqual(b.djacobian, djac)
+
+    def testDeepTree(self):
+        # deeper than the python recursion limit
+        w = World(engine=ArticulatedBodyEngine())
+        add_snake(w, 1200)
+        w.update_geometric()
+        w.update_dynamic()
+        tail = w.getbodies()[-1]
+        self.assertListsAlmostEqual(tail.pose[0:3,3], [0., 599.5, 0.])
+        self.assertEqual(len(tail.jacobian_dofs), 1200)
+        self.assertEqual(len(list(tail.iter_ancestor_joints())), 1200)
+
+    def testLazyFrames(self):
+        w = World()
+        add_simplearm(w)
+        w.register(WeightController())
+        simulate(w, arange(0., 0.01, 0.001))
+        bodies = w.getbodies()
+        (arm, hand) = (bodies['Arm'], bodies['Hand'])
+        # the hand and its ancestors are computed on demand, at the
+        # current state, the other bodies are left stale
+        pose = hand.pose
+        self.assertEqual(arm._pose_generation, w._generation)
+        self.assertNotEqual(arm._dynamic_generation, w._generation)
+        (twist, jac) = (hand.twist, hand.jacobian)
+        self.assertEqual(arm._dynamic_generation, w._generation)
+        w.update_dynamic()
+        self.assertListsAlmostEqual(pose, hand.pose)
+        self.assertListsAlmostEqual(twist, hand.twist)
+        self.assertListsAlmostEqual(jac, hand.jacobian)
+        # integrate changes the state, hence invalidates the frames
+        w.update_controllers(0.001)
+        w.integrate(0.001)
+        pose = hand.pose
+        self.assertNotEqual(arm._dynamic_generation, w._generation)
+        w.update_geometric()
+        self.assertListsAlmostEqual(pose, hand.pose)
+
+
+class TestProfiler(WorldTestCase):
+
+    def testSimulate(self):
+        w = World()
+        add_groundplane(w)
+        add_sphere(w, radius=.1, name='Ball')
+        w.getjoints()[0].gpos[1,3] = .1
+        w.register(WeightController(name='weight'))
+        contacts = get_all_contacts(w, friction_coeff=.6)
+        for c in contacts:
+            w.register(c)
+        profiler = Profiler()
+        energy = EnergyMonitor()
+        simulate(w, arange(0., 0.005, 0.001), [profiler, energy])
+        self.assertTrue(w.profiler is None)
+        stats = profiler.get_stats()
+        for label in ('step', 'update_dynamic', 'update_controllers',
+                      'update_controllers/weight', 
+                      'update_controllers/admittance', 'update_constraints',
+                      'update_constraints/assembly', 
+                      'update_constraints/sweeps', 'integrate',
+                      'observers/EnergyMonitor', 
+                      'update_constraints/SoftFingerContact'):
+            self.assertEqual(stats[label]['count'], 4)
+            self.assertEqual(sum(stats[label]['histogram']), 4)
+            self.assertTrue(stats[label]['min'] <= stats[label]['mean'] <= 
+                            stats[label]['max'])
+        self.assertEqual(len(stats['step']['histogram']) + 1, 
+                         len(profiler.bin_edges))
+
+    def testManualSteps(self):
+        w = World()
+        add_simplearm(w)
+        w.init()
+        w.profiler = Profiler()
+        for i in range(3):
+            w.update_geometric()
+            w.update_dynamic()
+            w.update_controllers(0.001)
+            w.update_constraints(0.001)
+            w.integrate(0.001)
+        stats = w.profiler.get_stats()
+        self.assertEqual(sorted(stats.keys()), ['integrate', 
+            'update_constraints', 'update_constraints/assembly', 
+            'update_constraints/sweeps', 'update_controllers', 
+            'update_controllers/admittance', 'update_dynamic', 
+            'update_geometric'])
+        self.assertEqual(stats['update_dynamic']['count'], 3)
+        w.profiler.reset()
+        self.assertEqual(w.profiler.get_stats(), {})
+
+
+class TestIterSimulate(WorldTestCase):
+
+    def testSameAsSimulate(self):
+        time = arange(0., 0.01, 0.001)
+        w0 = World()
+        add_simplearm(w0)
+        w0.getjoints()[0].gvel[0] = 1.
+        simulate(w0, time)
+        w = World()
+        add_simplearm(w)
+        w.getjoints()[0].gvel[0] = 1.
+        states = list(itersimulate(w, time, poses=True))
+        self.assertEqual(len(states), len(time)-1)
+        self.assertAlmostEqual(states[-1].time, time[-1])
+        self.assertListsAlmostEqual(states[-1].gvel, w0.gvel)
+        self.assertListsAlmostEqual(states[-1].gpos, 
+                                    [j.gpos for j in w0.iterjoints()])
+        self.assertListsAlmostEqual(states[-1].poses, 
+                                    [b.pose for b in w0.getbodies()[1:]])
+        self.assertTrue(states[0].forces is None)
+        # the snapshots are copies
+        self.assertNotEqual(states[0].gvel[1], states[-1].gvel[1])
+
+    def testEarlyStop(self):
+        w = World()
+        add_groundplane(w)
+        add_sphere(w, radius=.1, name='Ball')
+        w.getjoints()[0].gpos[1,3] = .1
+        w.register(WeightController())
+        contacts = get_all_contacts(w, friction_coeff=.6)
+        for c in contacts:
+            w.register(c)
+        profiler = Profiler()
+        states = itersimulate(w, arange(0., 1., 0.001), [profiler], 
+                              forces=True)
+        for state in states:
+            if len(state.forces):
+                break
+        self.assertTrue(w.profiler is profiler)
+        states.close()
+        self.assertTrue(w.profiler is None)
+        self.assertEqual(state.forces.keys(), contacts)
+        self.assertListsAlmostEqual(state.forces[contacts[0]], 
+                                    contacts[0]._force)
+
+
+class TestSimulateAdaptive(WorldTestCase):
+
+    def _ball(self):
+        w = World()
+        add_groundplane(w)
+        add_sphere(w, radius=.1, name='Ball')
+        w.getjoints()[0].gpos[1,3] = .3
+        w.register(WeightController())
+        for c in get_all_contacts(w, friction_coeff=.6):
+            w.register(c)
+        return w
+
+    def testBouncingBall(self):
+        w0 = self._ball()
+        simulate(w0, arange(0., 0.4001, 0.001))
+        w = self._ball()
+        timeline = arange(0., 0.4001, 0.05)
+        energy = EnergyMonitor()
+        (accepted, rejected) = simulate_adaptive(w, timeline, [energy])
+        # far fewer steps than the 400 fixed ones
+        self.assertTrue(accepted + rejected < 100)
+        self.assertTrue(rejected > 0)
+        self.assertListsAlmostEqual(energy.time, timeline[:-1])
+        self.assertAlmostEqual(w.current_time, timeline[-1])
+        self.assertListsAlmostEqual(w.getjoints()[0].gpos,
+                                    w0.getjoints()[0].gpos)
+        self.assertListsAlmostEqual(w.gvel, w0.gvel)
+
+    def testSameAsFixedSteps(self):
+        def world():
+            w = World()
+            add_groundplane(w)
+            add_sphere(w, radius=.1, name='Ball')
+            w.getjoints()[0].gpos[0:2,3] = (0., .3)
+            w.getjoints()[0].gvel[3] = 1.
+            w.register(WeightController())
+            w.register(BroadPhase(friction_coeff=.6))
+            w.sleep_velocity = 1e-3
+            return w
+        w = world()
+        # record the end time of the steps, dropping the rejected ones
+        times = [0.]
+        integrate = w.integrate
+        def recording_integrate(dt):
+            integrate(dt)
+            while times[-1] >= w.current_time - 1e-12:
+                times.pop()
+            times.append(w.current_time)
+        w.integrate = recording_integrate
+        profiler = Profiler()
+        (accepted, rejected) = simulate_adaptive(w, [0., 0.4], [profiler])
+        self.assertTrue(rejected > 0)
+        self.assertEqual(len(times), accepted + 1)
+        stats = profiler.get_stats()
+        self.assertEqual(stats['step']['count'], accepted + rejected)
+        self.assertEqual(stats['update_constraints/BroadPhase']['count'], 
+                         accepted + rejected)
+        w0 = world()
+        simulate(w0, times)
+        self.assertListsAlmostEqual(w.getjoints()[0].gpos,
+                                    w0.getjoints()[0].gpos)
+        self.assertListsAlmostEqual(w.gvel, w0.gvel)
+
+    def testRestoreState(self):
+        w = World()
+        add_groundplane(w)
+        add_sphere(w, radius=.1, name='Ball')
+        w.getjoints()[0].gpos[1,3] = .3
+        w.getjoints()[0].gvel[4] = -1.
+        bp = BroadPhase(friction_coeff=.6)
+        w.register(WeightController())
+        w.register(bp)
+        w.sleep_velocity = 10.
+        w.init()
+        _step(w, 0.001, ())
+        self.assertEqual(bp.contacts, [])
+        state = _save_state(w)
+        # a long step reaches the ground
+        _step(w, 0.5, ())
+        self.assertEqual(len(bp.contacts), 1)
+        self.assertTrue(bp.contacts[0]._force.any())
+        self.assertEqual(len(w._island_rest), 1)
+        _restore_state(w, state)
+        self.assertEqual(bp.contacts, [])
+        self.assertEqual(w._island_rest, {})
+        self.assertAlmostEqual(w.current_time, 0.001)
+
 
 ts = unittest.TestSuite()
 ts.addTest(WorldTestCase('testConstruction'))
 ts.addTest(TestLinks('testLinksCreation'))
 ts.addTest(TestLinks('testLinksReplacement'))
 ts.addTest(TestUpdates('testGeometricUpdate'))
+ts.addTest(TestUpdates('testGeometricUpdateAfterAddLink'))
+ts.addTest(TestUpdates('testDynamicUpdateAfterAddLink'))
 ts.addTest(TestUpdates('testDynamicUpdate'))
+ts.addTest(TestUpdates('testCompactJacobian'))
+ts.addTest(TestUpdates('testDeepTree'))
+ts.addTest(TestUpdates('testLazyFrames'))
+ts.addTest(TestProfiler('testSimulate'))
+ts.addTest(TestProfiler('testManualSteps'))
+ts.addTest(TestIterSimulate('testSameAsSimulate'))
+ts.addTest(TestIterSimulate('testEarlyStop'))
+ts.addTest(TestSimulateAdaptive('testBouncingBall'))
+ts.addTest(TestSimulateAdaptive('testSameAsFixedSteps'))
+ts.addTest(TestSimulateAdaptive('testRestoreState'))
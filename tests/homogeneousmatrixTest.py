@@ -17,6 +17,43 @@ class HomogeneousMatrixTestCase(BaseTest):
 		(az, ay, ax) = (3.14/6, 3.14/4, 3.14/3)
 		self.assertTrue(norm(rotzyx(az,ay,ax) - dot(rotz(az),dot(roty(ay),rotx(ax)))) < 1e-10)
 
+	def testKernels(self):
+		H = rotzyx(0.3, -0.7, 1.2)
+		H[0:3,3] = (0.5, -2., 1.5)
+		self.assertTrue(norm(dot(inv(H), H) - eye(4)) < 1e-10)
+		Ad = adjoint(H)
+		self.assertTrue(norm(dot(iadjoint(H), Ad) - eye(6)) < 1e-10)
+		J = arange(18.).reshape((6,3))
+		self.assertTrue(norm(adjoint_dot(H, J) - dot(Ad, J)) < 1e-10)
+		self.assertTrue(norm(iadjoint_dot(H, J[:,0]) -
+			dot(iadjoint(H), J[:,0])) < 1e-10)
+
+	def testOut(self):
+		H = rotzyx(0.3, -0.7, 1.2)
+		H[0:3,3] = (0.5, -2., 1.5)
+		out = zeros((6,6))
+		self.assertTrue(adjoint(H, out) is out)
+		self.assertTrue(norm(iadjoint(H, out) - adjoint(inv(H))) < 1e-10)
+		out = zeros((4,4))
+		self.assertTrue(inv(H, out) is out)
+		self.assertTrue(norm(dot(out, H) - eye(4)) < 1e-10)
+
+
+	def testStacks(self):
+		angles = arange(0., 1., 0.25)
+		H = rotzyx(angles, 2*angles, -angles)
+		H[:,0:3,3] = arange(12.).reshape((4,3))
+		J = arange(72.).reshape((4,6,3))
+		for (f, args) in ((inv, ()), (adjoint, ()), (iadjoint, ()),
+				(adjoint_dot, (J,)), (iadjoint_dot, (J[:,:,0],))):
+			stacked = f(H, *args)
+			for i in range(len(H)):
+				self.assertTrue(norm(stacked[i] -
+					f(H[i], *[a[i] for a in args])) < 1e-10)
+
 
 ts = unittest.TestSuite()
-ts.addTest(HomogeneousMatrixTestCase('test'))
\ No newline at end of file
+ts.addTest(HomogeneousMatrixTestCase('test'))
+ts.addTest(HomogeneousMatrixTestCase('testKernels'))
+ts.addTest(HomogeneousMatrixTestCase('testOut'))
+ts.addTest(HomogeneousMatrixTestCase('testStacks'))
\ No newline at end of file